@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
@@ -20,4 +20,14 @@ def init_db():
   """初始化数据库：创建所有表"""
   from app.models import user, wardrobe, conversation
   Base.metadata.create_all(bind=engine)
+  _add_missing_columns()
   print("数据库表初始化完成")
+
+
+def _add_missing_columns():
+  """create_all 不会修改已有的表：为旧数据库补上后来新增的可空列"""
+  columns = {column["name"] for column in inspect(engine).get_columns("wardrobe_items")}
+  if "phash" not in columns:
+    with engine.begin() as conn:
+      conn.execute(text("ALTER TABLE wardrobe_items ADD COLUMN phash BIGINT"))
+    print("已为 wardrobe_items 添加 phash 列")
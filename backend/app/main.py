@@ -9,8 +9,9 @@ backend_dir = Path(__file__).resolve().parent.parent
 project_root = backend_dir.parent
 sys.path.insert(0, str(project_root))
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from app.core.config import settings
 from app.core.database import init_db, SessionLocal
@@ -18,6 +19,7 @@ from app.models.user import User
 from app.models.wardrobe import WardrobeItem
 from app.models.conversation import ConversationSession
 from app.services.conversation_manager import ConversationManager
+from app.services.model_warmup import get_model_warmup
 
 # --- 2. 数据库初始化 ---
 init_db()
@@ -53,6 +55,40 @@ app = FastAPI(
   version="0.1.0",
 )
 
+# --- 模型就绪闸门：预加载期间，所需模型尚未就绪的路由直接返回 503（先于 CORS 注册，503 响应也带 CORS 头）---
+# 按完整路径精确匹配，避免误拦 /clothes/upload-status/{user_id} 这类不依赖模型的查询接口；值为该路由依赖的模型
+MODEL_GATED_PATHS = {
+  "/api/v1/clothes/upload": ("embedding", "qwen"),
+  "/api/v1/clothes/upload-batch": ("embedding", "qwen"),
+  "/api/v1/clothes/upload-batch-stream": ("embedding", "qwen"),
+  "/api/v1/clothes/similar": ("embedding",),
+  "/api/v1/clothes/similar-batch": ("embedding",),
+  "/api/v1/recommend/outfits": ("embedding", "qwen"),
+  "/api/v1/recommend/outfits/stream": ("embedding", "qwen"),
+  "/api/v1/recommend/adjust": ("embedding", "qwen"),
+  "/api/v1/recommend/adjust/stream": ("embedding", "qwen"),
+}
+# mode=fast 的推荐不调用大模型，只需 Embedding 模型
+FAST_MODE_PATHS = frozenset({"/api/v1/recommend/outfits", "/api/v1/recommend/outfits/stream"})
+
+
+@app.middleware("http")
+async def model_readiness_gate(request: Request, call_next):
+  warmup = get_model_warmup()
+  if not warmup.ready and os.getenv("PRELOAD_GATE", "1") != "0":
+    path = request.url.path.rstrip("/")
+    models = MODEL_GATED_PATHS.get(path, ())
+    if path in FAST_MODE_PATHS and request.query_params.get("mode") == "fast":
+      models = ("embedding",)
+    pending = [name for name in models if not warmup.model_ready(name)]
+    if pending:
+      return JSONResponse(
+        status_code=503,
+        content={"detail": "模型加载中，请稍后重试", "waiting_for": pending, **warmup.status()},
+        headers={"Retry-After": "15"}
+      )
+  return await call_next(request)
+
 # --- 3. CORS 设置 ---
 app.add_middleware(
   CORSMiddleware,
@@ -82,7 +118,36 @@ async def root():
 
 @app.get("/health")
 async def health():
-  return {"status": "healthy"}
+  """就绪检查：模型预加载 / 预热完成前返回 503"""
+  readiness = get_model_warmup().status()
+  if not readiness["ready"]:
+    return JSONResponse(status_code=503, content={"status": "starting", "readiness": readiness})
+  return {"status": "healthy", "readiness": readiness}
+
+
+# --- 启动时后台预加载并预热模型（PRELOAD_MODELS=embedding,qwen，0 关闭），
+#     完成后预计算检索查询向量（QUERY_CACHE_PRECOMPUTE=weather / full，默认关闭）---
+@app.on_event("startup")
+def preload_models_event():
+  import threading
+  
+  precompute = None
+  mode = os.getenv("QUERY_CACHE_PRECOMPUTE", "0")
+  if mode in ("weather", "full"):
+    from app.routes.recommendation import precompute_query_cache
+    precompute = lambda: precompute_query_cache(mode)
+  
+  models = os.getenv("PRELOAD_MODELS", "embedding,qwen")
+  models = [name.strip() for name in models.split(",") if name.strip()] if models != "0" else []
+  if models:
+    get_model_warmup().start(models, warmup=os.getenv("MODEL_WARMUP", "1") != "0", after=precompute)
+  elif precompute is not None:
+    threading.Thread(target=precompute, daemon=True, name="query-cache-precompute").start()
+  
+  # 向量化队列只在内存中：上次退出时未完成的任务（数据库中有、向量库中没有的衣物）重新入队
+  if os.getenv("EMBEDDING_BACKFILL", "1") != "0":
+    from app.services.embedding_queue import enqueue_unindexed_items
+    threading.Thread(target=enqueue_unindexed_items, daemon=True, name="embedding-backfill").start()
 
 
 # --- 关闭时停止定时任务 ---
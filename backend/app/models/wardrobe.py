@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime
 from sqlalchemy.sql import func
 from app.core.database import Base
 
@@ -23,4 +23,5 @@ class WardrobeItem(Base):
   category = Column(String, nullable=False)  # e.g., "top", "bottom", "outerwear"
   season = Column(String, nullable=False)  # e.g., "spring,summer"
   image_path = Column(String, nullable=False)  # 本地/云端图片路径
+  phash = Column(BigInteger, nullable=True)  # 图片 64 位感知哈希（dHash，按有符号整数存储），上传查重用
   created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -1,54 +1,165 @@
+import io
+import os
+import uuid
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Body
 from fastapi.responses import StreamingResponse
-from typing import List
+from typing import List, Optional
+import numpy as np
 from sqlalchemy.orm import Session
 from app.core.database import get_db
-from app.services.image_service import analyze_clothing_image
+from app.services.image_service import analyze_clothing_image, analyze_clothing_images, ANALYZE_CHUNK_SIZE
 from app.services.embedding_service import get_embedding_service
+from app.services.embedding_queue import get_embedding_queue
+from app.services.phash_index import get_phash_index, dhash, to_signed, color_signature, file_digest
 from app.models.wardrobe import WardrobeItem
 import json
 
 router = APIRouter()
 
+# 批量上传共享的 AI 分析线程池（避免每个请求各建一个线程池）
+_analysis_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="clothes-analysis")
 
-@router.post("/upload")
-def upload_clothing(
-    user_id: int,
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db)
-):
-  import os
-  import uuid
-  from pathlib import Path
-  
-  upload_dir = "uploads"
-  os.makedirs(upload_dir, exist_ok=True)
-  
-  # 生成唯一文件名，保留原始扩展名，确保不冲突
-  file_ext = Path(file.filename).suffix
+# 上传到近似重复图片时的处理：ask（默认）不保存并返回重复信息 / reuse 沿用已有衣物的属性 / ignore 照常分析
+DUPLICATE_ACTIONS = ("reuse", "ask", "ignore")
+
+
+def _unique_upload_path(upload_dir: str, filename: str) -> str:
+  """生成唯一文件名，保留原始扩展名，确保不冲突"""
+  file_ext = Path(filename).suffix
   max_attempts = 10
   for attempt in range(max_attempts):
     unique_filename = f"{uuid.uuid4().hex}{file_ext}"
     file_path = os.path.join(upload_dir, unique_filename)
     if not os.path.exists(file_path):
-      break
-    pass  # 文件名冲突，重新生成
+      return file_path
+  raise Exception("无法生成唯一文件名")
+
+
+def _check_duplicate_action(on_duplicate: str):
+  if on_duplicate not in DUPLICATE_ACTIONS:
+    raise HTTPException(status_code=400, detail=f"on_duplicate 只能是 {'/'.join(DUPLICATE_ACTIONS)}")
+
+
+def _plan_duplicates(db: Session, user_id: int, file_paths: List[str], on_duplicate: str) -> List[dict]:
+  """
+  上传查重（在 VLM 分析之前）：逐张计算感知哈希，先查该用户衣橱，再查同一批中排在前面的图片；
+  哈希相近的还要颜色签名一致才算重复（dHash 只看灰度，分不出同款不同色）
+  
+  返回每张图片的 {"phash", "action", "source", "same_as", "distance", "identical"}，action 为：
+  analyze 正常分析 / reuse 沿用重复衣物的属性 / skip 跳过（on_duplicate=ask）；
+  identical 表示与重复衣物的图片逐字节相同
+  """
+  phash_index = get_phash_index()
+  plans = []
+  for position, file_path in enumerate(file_paths):
+    plan = {
+      "phash": None, "colors": None, "digest": None, "action": "analyze",
+      "source": None, "same_as": None, "distance": None, "identical": False
+    }
+    plans.append(plan)
+    try:
+      plan["phash"] = dhash(file_path)
+    except Exception as e:
+      continue  # 无法计算哈希时按普通上传处理
+    if on_duplicate == "ignore":
+      continue
+    try:
+      plan["colors"] = color_signature(file_path)
+      plan["digest"] = file_digest(file_path)
+    except Exception as e:
+      continue
+    
+    for item_id, distance in phash_index.find(user_id, plan["phash"]):
+      source = db.query(WardrobeItem).filter(WardrobeItem.id == item_id).first()
+      if source and _confirm_duplicate(plan, source.image_path):
+        plan.update(source=source, distance=distance)
+        break
+    
+    if plan["source"] is None:
+      for earlier in range(position):
+        earlier_plan = plans[earlier]
+        if earlier_plan["action"] != "analyze" or earlier_plan["phash"] is None or earlier_plan["colors"] is None:
+          continue
+        distance = bin(plan["phash"] ^ earlier_plan["phash"]).count("1")
+        if distance <= phash_index.max_distance and phash_index.same_colors(plan["colors"], earlier_plan["colors"]):
+          plan.update(same_as=earlier, distance=distance, identical=plan["digest"] == earlier_plan["digest"])
+          break
+    
+    if plan["source"] is not None or plan["same_as"] is not None:
+      plan["action"] = "reuse" if on_duplicate == "reuse" else "skip"
+  return plans
+
+
+def _confirm_duplicate(plan: dict, image_path: Optional[str]) -> bool:
+  """用颜色签名确认哈希命中的衣物确为同一件，并记录两张图片是否逐字节相同"""
+  if not image_path or not os.path.exists(image_path):
+    return False
+  try:
+    if not get_phash_index().same_colors(plan["colors"], color_signature(image_path)):
+      return False
+    plan["identical"] = plan["digest"] == file_digest(image_path)
+  except Exception as e:
+    return False
+  return True
+
+
+def _duplicate_info(plan: dict, filenames: List[str]) -> dict:
+  source = plan["source"]
+  if source is not None:
+    return {"item_id": source.id, "name": source.name, "image_path": source.image_path, "distance": plan["distance"]}
+  return {"item_id": None, "filename": filenames[plan["same_as"]], "distance": plan["distance"]}
+
+
+def _reuse_duplicate(plan: dict, file_path: str, earlier: dict):
+  """
+  沿用重复衣物的属性（不再调用 VLM）；只有与原图片逐字节相同时才改为引用已有文件并删除刚保存的副本，
+  否则保留用户刚上传的照片
+  
+  earlier 为同一批中已保存的 {序号: (attributes, image_path, item_id)}；返回 (attributes, image_path, 原衣物ID)
+  """
+  source = plan["source"]
+  if source is not None:
+    attributes = {
+      "name": source.name,
+      "category": source.category,
+      "color": source.color,
+      "season": source.season,
+      "material": source.material or "",
+      "name_en": source.name_en or "",
+      "color_en": source.color_en or "",
+      "material_en": source.material_en or ""
+    }
+    shared_path, source_id = source.image_path, source.id
+  elif plan["same_as"] in earlier:
+    attributes, shared_path, source_id = earlier[plan["same_as"]]
   else:
-    raise HTTPException(status_code=500, detail="无法生成唯一文件名")
+    raise Exception("同一批中与之重复的图片上传失败")
   
-  with open(file_path, "wb") as f:
-    f.write(file.file.read())
+  if plan["identical"] and shared_path and shared_path != file_path and os.path.exists(shared_path):
+    os.remove(file_path)
+    file_path = shared_path
+  return dict(attributes), file_path, source_id
 
-  # Analyze image with Qwen model
-  attributes = analyze_clothing_image(file_path)
 
+def _save_wardrobe_item(
+    db: Session,
+    user_id: int,
+    filename: str,
+    file_path: str,
+    attributes: dict,
+    phash: int = None,
+    source_item_id: int = None
+):
+  """写入衣物记录、登记感知哈希并加入向量化队列，返回 (db_item, item_name)"""
   season = attributes["season"]
   if isinstance(season, list):
     season = "/".join(season)
-
-  # Use AI-generated name if available, otherwise use filename
-  item_name = attributes.get("name", file.filename)
-
+  
+  item_name = attributes.get("name", filename)
+  
+  # 保存到数据库
   db_item = WardrobeItem(
     user_id=user_id,
     name=item_name,
@@ -59,16 +170,19 @@ def upload_clothing(
     name_en=attributes.get("name_en", ""),
     color_en=attributes.get("color_en", ""),
     material_en=attributes.get("material_en", ""),
-    image_path=file_path
+    image_path=file_path,
+    phash=to_signed(phash) if phash is not None else None
   )
   db.add(db_item)
   db.commit()
   db.refresh(db_item)
   
-  # 生成并存储向量到ChromaDB（多模态：文本+图像）
+  if phash is not None:
+    get_phash_index().add(user_id, db_item.id, phash)
+  
+  # 向量（多模态：文本+图像）由后台队列批量生成，不阻塞上传；失败不影响上传
   try:
-    embedding_service = get_embedding_service()
-    embedding_service.add_item(db_item.id, {
+    get_embedding_queue().enqueue(db_item.id, {
       "user_id": user_id,
       "name": item_name,
       "name_en": attributes.get("name_en", ""),
@@ -76,21 +190,69 @@ def upload_clothing(
       "material_en": attributes.get("material_en", ""),
       "season": season,
       "category": attributes["category"]
-    }, image_path=file_path)  # 传入图像路径
-  except Exception as e:
-    pass  # 向量生成失败不影响上传
+    }, image_path=file_path, source_item_id=source_item_id)  # 传入图像路径；与原衣物图片逐字节相同时复用其向量
+  except Exception as emb_err:
+    pass  # 入队失败不影响上传
   
-  return {"message": "上传成功！", "item_id": db_item.id}
+  return db_item, item_name
+
+
+@router.post("/upload")
+def upload_clothing(
+    user_id: int,
+    file: UploadFile = File(...),
+    on_duplicate: str = "ask",
+    db: Session = Depends(get_db)
+):
+  _check_duplicate_action(on_duplicate)
+  upload_dir = "uploads"
+  os.makedirs(upload_dir, exist_ok=True)
+  
+  # 生成唯一文件名，保留原始扩展名，确保不冲突
+  file_ext = Path(file.filename).suffix
+  max_attempts = 10
+  for attempt in range(max_attempts):
+    unique_filename = f"{uuid.uuid4().hex}{file_ext}"
+    file_path = os.path.join(upload_dir, unique_filename)
+    if not os.path.exists(file_path):
+      break
+    pass  # 文件名冲突，重新生成
+  else:
+    raise HTTPException(status_code=500, detail="无法生成唯一文件名")
+  
+  with open(file_path, "wb") as f:
+    f.write(file.file.read())
+
+  # 先查重：衣橱中已有近似相同的图片时不再跑 VLM
+  plan = _plan_duplicates(db, user_id, [file_path], on_duplicate)[0]
+  if plan["action"] == "skip":
+    os.remove(file_path)
+    return {"message": "衣橱中已有相同的衣物", "item_id": None, "duplicate": _duplicate_info(plan, [file.filename])}
+  
+  source_item_id = None
+  if plan["action"] == "reuse":
+    attributes, file_path, source_item_id = _reuse_duplicate(plan, file_path, {})
+  else:
+    # Analyze image with Qwen model
+    attributes = analyze_clothing_image(file_path)
+
+  db_item, item_name = _save_wardrobe_item(
+    db, user_id, file.filename, file_path, attributes, plan["phash"],
+    source_item_id if plan["identical"] else None
+  )
+  
+  return {"message": "上传成功！", "item_id": db_item.id, "duplicate_of": source_item_id}
 
 
 @router.post("/upload-batch-stream")
 async def upload_clothing_batch_stream(
     user_id: int,
     files: List[UploadFile] = File(...),
+    on_duplicate: str = "ask",
     db: Session = Depends(get_db)
 ):
-  import uuid
   from app.services.upload_manager import get_upload_manager
+  _check_duplicate_action(on_duplicate)
   
   # 生成任务ID
   task_id = str(uuid.uuid4())
@@ -102,11 +264,6 @@ async def upload_clothing_batch_stream(
   async def generate_progress():
     import os
     import asyncio
-    import sys
-    import uuid
-    from pathlib import Path
-    from starlette.requests import Request
-    from concurrent.futures import ThreadPoolExecutor
     
     upload_dir = "uploads"
     os.makedirs(upload_dir, exist_ok=True)
@@ -114,9 +271,6 @@ async def upload_clothing_batch_stream(
     total = len(files)
     uploaded_ids = []  # 记录已上传的ID，用于回滚
     
-    # 创建线程池用于AI分析，避免阻塞事件循环
-    executor = ThreadPoolExecutor(max_workers=2)
-    
     try:
       message = json.dumps({'type': 'start', 'total': total, 'task_id': task_id})
       yield f"data: {message}\n\n"
@@ -126,110 +280,117 @@ async def upload_clothing_batch_stream(
       failed_count = 0
       success_items = []
       failed_items = []
+      duplicate_items = []
       
-      for idx, file in enumerate(files, 1):
-        file_path = None
-        db_item = None
-        try:
-          # 生成唯一文件名，保留原始扩展名，确保不冲突
-          file_ext = Path(file.filename).suffix
-          max_attempts = 10
-          for attempt in range(max_attempts):
-            unique_filename = f"{uuid.uuid4().hex}{file_ext}"
-            file_path = os.path.join(upload_dir, unique_filename)
-            if not os.path.exists(file_path):
-              break
-          else:
-            raise Exception("无法生成唯一文件名")
-          
-          # 保存文件
-          content = await file.read()
-          with open(file_path, "wb") as f:
-            f.write(content)
-          
-          # AI分析 - 使用线程池异步执行，避免阻塞其他请求
+      def record_failure(idx, file, file_path, error):
+        nonlocal failed_count
+        failed_count += 1
+        failed_item = {
+          "filename": file.filename,
+          "error": str(error)
+        }
+        failed_items.append(failed_item)
+        
+        # 更新任务进度（失败）
+        upload_manager.update_progress(task_id, idx, failed_item=failed_item)
+        
+        # 删除失败文件
+        if file_path and os.path.exists(file_path):
+          try:
+            os.remove(file_path)
+          except:
+            pass
+        
+        message = json.dumps({'type': 'progress', 'current': idx, 'total': total, 'status': 'failed', 'filename': file.filename, 'error': str(error)})
+        return f"data: {message}\n\n"
+      
+      # 按块处理：先保存整块文件，再一次性送入模型批量分析
+      for chunk_start in range(0, total, ANALYZE_CHUNK_SIZE):
+        chunk = list(enumerate(files[chunk_start:chunk_start + ANALYZE_CHUNK_SIZE], chunk_start + 1))
+        file_paths = {}
+        save_errors = {}
+        
+        for idx, file in chunk:
+          try:
+            file_path = _unique_upload_path(upload_dir, file.filename)
+            content = await file.read()
+            with open(file_path, "wb") as f:
+              f.write(content)
+            file_paths[idx] = file_path
+          except Exception as e:
+            save_errors[idx] = e
+        
+        # 查重（在 AI 分析之前）：重复的图片沿用已有衣物的属性，或按 on_duplicate=ask 跳过
+        saved_idx = list(file_paths.keys())
+        filenames = [files[idx - 1].filename for idx in saved_idx]
+        plans = dict(zip(saved_idx, _plan_duplicates(db, user_id, list(file_paths.values()), on_duplicate)))
+        to_analyze = [idx for idx in saved_idx if plans[idx]["action"] == "analyze"]
+        
+        # AI分析 - 整块图片在共享线程池中批量推理，避免阻塞其他请求
+        attributes_by_idx = {}
+        if to_analyze:
           loop = asyncio.get_event_loop()
-          attributes = await loop.run_in_executor(executor, analyze_clothing_image, file_path)
-          
-          season = attributes["season"]
-          if isinstance(season, list):
-            season = "/".join(season)
-          
-          item_name = attributes.get("name", file.filename)
-          
-          # 保存到数据库
-          db_item = WardrobeItem(
-            user_id=user_id,
-            name=item_name,
-            category=attributes["category"],
-            color=attributes["color"],
-            season=season,
-            material=attributes.get("material", ""),
-            name_en=attributes.get("name_en", ""),
-            color_en=attributes.get("color_en", ""),
-            material_en=attributes.get("material_en", ""),
-            image_path=file_path
+          attributes_list = await loop.run_in_executor(
+            _analysis_executor, analyze_clothing_images, [file_paths[idx] for idx in to_analyze]
           )
-          db.add(db_item)
-          db.commit()
-          db.refresh(db_item)
+          attributes_by_idx = dict(zip(to_analyze, attributes_list))
+        
+        earlier = {}
+        for idx, file in chunk:
+          file_path = file_paths.get(idx)
+          if idx in save_errors:
+            yield record_failure(idx, file, file_path, save_errors[idx])
+            await asyncio.sleep(0)
+            continue
           
-          uploaded_ids.append(db_item.id)  # 记录已上传ID
+          plan = plans[idx]
+          if plan["action"] == "skip":
+            os.remove(file_path)
+            duplicate = _duplicate_info(plan, filenames)
+            duplicate_items.append({"filename": file.filename, "duplicate": duplicate})
+            upload_manager.update_progress(task_id, idx)
+            message = json.dumps({'type': 'progress', 'current': idx, 'total': total, 'status': 'duplicate', 'filename': file.filename, 'duplicate': duplicate})
+            yield f"data: {message}\n\n"
+            await asyncio.sleep(0)
+            continue
           
-          # 生成向量（异步，失败不影响上传）
+          image_path = file_path
           try:
-            embedding_service = get_embedding_service()
-            embedding_service.add_item(db_item.id, {
-              "user_id": user_id,
+            source_item_id = None
+            if plan["action"] == "reuse":
+              attributes, image_path, source_item_id = _reuse_duplicate(plan, file_path, earlier)
+            else:
+              attributes = attributes_by_idx[idx]
+            db_item, item_name = _save_wardrobe_item(
+              db, user_id, file.filename, image_path, attributes, plan["phash"],
+              source_item_id if plan["identical"] else None
+            )
+            uploaded_ids.append(db_item.id)  # 记录已上传ID
+            earlier[saved_idx.index(idx)] = (attributes, image_path, db_item.id)
+            
+            success_count += 1
+            success_item = {
+              "filename": file.filename,
               "name": item_name,
-              "name_en": attributes.get("name_en", ""),
-              "color_en": attributes.get("color_en", ""),
-              "material_en": attributes.get("material_en", ""),
-              "season": season,
-              "category": attributes["category"]
-            }, image_path=file_path)  # 传入图像路径
-          except Exception as emb_err:
-            pass  # 向量生成失败不影响上传
-          
-          success_count += 1
-          success_item = {
-            "filename": file.filename,
-            "name": item_name,
-            "item_id": db_item.id
-          }
-          success_items.append(success_item)
-          
-          # 更新任务进度
-          upload_manager.update_progress(task_id, idx, success_item=success_item)
+              "item_id": db_item.id,
+              "duplicate_of": source_item_id
+            }
+            success_items.append(success_item)
+            
+            # 更新任务进度
+            upload_manager.update_progress(task_id, idx, success_item=success_item)
+            
+            message = json.dumps({'type': 'progress', 'current': idx, 'total': total, 'status': 'success', 'filename': file.filename, 'name': item_name, 'item_id': db_item.id})
+            yield f"data: {message}\n\n"
+            await asyncio.sleep(0)
           
-          message = json.dumps({'type': 'progress', 'current': idx, 'total': total, 'status': 'success', 'filename': file.filename, 'name': item_name, 'item_id': db_item.id})
-          yield f"data: {message}\n\n"
-          await asyncio.sleep(0)
-          
-        except Exception as e:
-          failed_count += 1
-          failed_item = {
-            "filename": file.filename,
-            "error": str(e)
-          }
-          failed_items.append(failed_item)
-          
-          # 更新任务进度（失败）
-          upload_manager.update_progress(task_id, idx, failed_item=failed_item)
-          
-          # 删除失败文件
-          if file_path and os.path.exists(file_path):
-            try:
-              os.remove(file_path)
-            except:
-              pass
-          
-          message = json.dumps({'type': 'progress', 'current': idx, 'total': total, 'status': 'failed', 'filename': file.filename, 'error': str(e)})
-          yield f"data: {message}\n\n"
-          await asyncio.sleep(0)
+          except Exception as e:
+            # 已改为引用原衣物图片时不能删除该文件
+            yield record_failure(idx, file, file_path if image_path == file_path else None, e)
+            await asyncio.sleep(0)
       
       # 发送完成消息
-      message = json.dumps({'type': 'complete', 'success': success_items, 'failed': failed_items, 'total': total, 'task_id': task_id})
+      message = json.dumps({'type': 'complete', 'success': success_items, 'failed': failed_items, 'duplicates': duplicate_items, 'total': total, 'task_id': task_id})
       yield f"data: {message}\n\n"
       await asyncio.sleep(0)
       
@@ -244,10 +405,17 @@ async def upload_clothing_batch_stream(
         try:
           item = db.query(WardrobeItem).filter(WardrobeItem.id == item_id).first()
           if item:
-            if item.image_path and os.path.exists(item.image_path):
+            # 重复上传的衣物与原衣物共用图片，仍有其他记录引用时不删除文件
+            shared = db.query(WardrobeItem).filter(
+              WardrobeItem.image_path == item.image_path,
+              WardrobeItem.id != item_id
+            ).count()
+            if item.image_path and not shared and os.path.exists(item.image_path):
               os.remove(item.image_path)
+            get_phash_index().remove(item.user_id, item_id)
             db.delete(item)
             db.commit()
+          get_embedding_queue().cancel(item_id)
         except Exception as del_err:
           pass  # 回滚删除失败
       raise
@@ -267,11 +435,11 @@ async def upload_clothing_batch_stream(
 def upload_clothing_batch(
     user_id: int,
     files: List[UploadFile] = File(...),
+    on_duplicate: str = "ask",
     db: Session = Depends(get_db)
 ):
   import os
-  import uuid
-  from pathlib import Path
+  _check_duplicate_action(on_duplicate)
   
   upload_dir = "uploads"
   os.makedirs(upload_dir, exist_ok=True)
@@ -279,86 +447,75 @@ def upload_clothing_batch(
   results = {
     "success": [],
     "failed": [],
+    "duplicates": [],
     "total": len(files)
   }
   
-  for idx, file in enumerate(files, 1):
-    file_path = None
-    try:
-      # 生成唯一文件名，保留原始扩展名，确保不冲突
-      file_ext = Path(file.filename).suffix
-      max_attempts = 10
-      for attempt in range(max_attempts):
-        unique_filename = f"{uuid.uuid4().hex}{file_ext}"
-        file_path = os.path.join(upload_dir, unique_filename)
-        if not os.path.exists(file_path):
-          break
-      else:
-        raise Exception("无法生成唯一文件名")
-      
-      # 保存文件
-      with open(file_path, "wb") as f:
-        f.write(file.file.read())
-      
-      # AI分析
-      attributes = analyze_clothing_image(file_path)
-      
-      season = attributes["season"]
-      if isinstance(season, list):
-        season = "/".join(season)
-      
-      item_name = attributes.get("name", file.filename)
-      
-      # 保存到数据库
-      db_item = WardrobeItem(
-        user_id=user_id,
-        name=item_name,
-        category=attributes["category"],
-        color=attributes["color"],
-        season=season,
-        material=attributes.get("material", ""),
-        name_en=attributes.get("name_en", ""),
-        color_en=attributes.get("color_en", ""),
-        material_en=attributes.get("material_en", ""),
-        image_path=file_path
-      )
-      db.add(db_item)
-      db.commit()
-      db.refresh(db_item)
+  def record_failure(file, file_path, error):
+    # 删除已保存的文件
+    if file_path and os.path.exists(file_path):
+      try:
+        os.remove(file_path)
+      except:
+        pass
+    
+    results["failed"].append({
+      "filename": file.filename,
+      "error": str(error)
+    })
+  
+  # 按块处理：先保存整块文件，再一次性送入模型批量分析
+  for chunk_start in range(0, len(files), ANALYZE_CHUNK_SIZE):
+    chunk = files[chunk_start:chunk_start + ANALYZE_CHUNK_SIZE]
+    saved = []
+    
+    for file in chunk:
+      file_path = None
+      try:
+        file_path = _unique_upload_path(upload_dir, file.filename)
+        with open(file_path, "wb") as f:
+          f.write(file.file.read())
+        saved.append((file, file_path))
+      except Exception as e:
+        record_failure(file, file_path, e)
+    
+    # 查重（在 AI 分析之前），只分析不重复的图片（整块一次推理）
+    plans = _plan_duplicates(db, user_id, [file_path for _, file_path in saved], on_duplicate)
+    to_analyze = [position for position, plan in enumerate(plans) if plan["action"] == "analyze"]
+    attributes_by_position = {}
+    if to_analyze:
+      attributes_list = analyze_clothing_images([saved[position][1] for position in to_analyze])
+      attributes_by_position = dict(zip(to_analyze, attributes_list))
+    
+    filenames = [file.filename for file, _ in saved]
+    earlier = {}
+    for position, ((file, file_path), plan) in enumerate(zip(saved, plans)):
+      if plan["action"] == "skip":
+        os.remove(file_path)
+        results["duplicates"].append({"filename": file.filename, "duplicate": _duplicate_info(plan, filenames)})
+        continue
       
-      # 生成向量
+      image_path = file_path
       try:
-        embedding_service = get_embedding_service()
-        embedding_service.add_item(db_item.id, {
-          "user_id": user_id,
+        source_item_id = None
+        if plan["action"] == "reuse":
+          attributes, image_path, source_item_id = _reuse_duplicate(plan, file_path, earlier)
+        else:
+          attributes = attributes_by_position[position]
+        db_item, item_name = _save_wardrobe_item(
+          db, user_id, file.filename, image_path, attributes, plan["phash"],
+          source_item_id if plan["identical"] else None
+        )
+        earlier[position] = (attributes, image_path, db_item.id)
+        results["success"].append({
+          "filename": file.filename,
           "name": item_name,
-          "name_en": attributes.get("name_en", ""),
-          "color_en": attributes.get("color_en", ""),
-          "material_en": attributes.get("material_en", ""),
-          "season": season,
-          "category": attributes["category"]
-        }, image_path=file_path)  # 传入图像路径
-      except Exception as emb_err:
-        pass  # 向量生成失败
-      
-      results["success"].append({
-        "filename": file.filename,
-        "name": item_name,
-        "item_id": db_item.id
-      })
-      
-    except Exception as e:
-      # 删除已保存的文件
-      if os.path.exists(file_path):
-        try:
-          os.remove(file_path)
-        except:
-          pass
-      
-      results["failed"].append({
-        "filename": file.filename,
-        "error": str(e)
-      })
+          "item_id": db_item.id,
+          "duplicate_of": source_item_id
+        })
+      except Exception as e:
+        # 已改为引用原衣物图片时不能删除该文件
+        record_failure(file, file_path if image_path == file_path else None, e)
   
   return results
 
@@ -389,6 +546,136 @@ def get_upload_status(user_id: int):
     }
 
 
+@router.get("/analysis-cache/stats")
+def get_analysis_cache_stats():
+  """获取衣物属性分析缓存的命中率与容量"""
+  from app.services.attribute_cache import get_attribute_cache
+  return get_attribute_cache().stats()
+
+
+@router.get("/duplicate-index/stats")
+def get_duplicate_index_stats():
+  """获取上传查重（感知哈希）索引的加载情况与命中次数"""
+  return get_phash_index().stats()
+
+
+@router.get("/index-status/{user_id}")
+def get_index_status(user_id: int):
+  """获取用户的向量索引滞后情况（已上传但尚未完成向量化的衣物）"""
+  return get_embedding_queue().get_user_lag(user_id)
+
+
+@router.get("/embedding-queue/stats")
+def get_embedding_queue_stats():
+  """获取向量化队列的整体状态"""
+  return get_embedding_queue().stats()
+
+
+@router.get("/vector-index/stats")
+def get_vector_index_stats():
+  """获取按用户内存映射向量索引的加载情况"""
+  embedding_service = get_embedding_service()
+  if embedding_service.vector_index is None:
+    return {"enabled": False}
+  return {"enabled": True, **embedding_service.vector_index.stats()}
+
+
+@router.post("/similar")
+def find_similar_clothing(
+    user_id: int,
+    item_id: Optional[int] = None,
+    top_k: int = 10,
+    min_score: float = 0.0,
+    file: Optional[UploadFile] = File(None),
+    db: Session = Depends(get_db)
+):
+  """
+  以图搜图：上传一张照片或指定已有衣物，返回该用户衣橱中视觉最相似的衣物
+  
+  已有衣物直接复用入库时的 CLIP 图像向量（不重新跑 CLIP）；上传的照片只在内存中编码一次，不落盘
+  """
+  if item_id is None and file is None:
+    raise HTTPException(status_code=400, detail="请上传图片或指定 item_id")
+  
+  embedding_service = get_embedding_service()
+  if not embedding_service.model_available:
+    raise HTTPException(status_code=503, detail="向量模型不可用")
+  
+  if item_id is not None:
+    query = embedding_service.stored_image_embeddings(user_id, [item_id]).get(item_id)
+    if query is None:
+      # 尚未向量化（仍在队列中）：从衣物图片现算
+      item = db.query(WardrobeItem).filter(WardrobeItem.id == item_id, WardrobeItem.user_id == user_id).first()
+      if not item:
+        raise HTTPException(status_code=404, detail="未找到该衣物")
+      if item.image_path and os.path.exists(item.image_path):
+        query = embedding_service.generate_image_embedding(item.image_path)
+  else:
+    query = embedding_service.generate_image_embedding(io.BytesIO(file.file.read()))
+  
+  if query is None:
+    raise HTTPException(status_code=400, detail="无法生成图像向量（衣物没有图片或图片无法读取）")
+  
+  matches = embedding_service.search_visually_similar(user_id, query[None, :], top_k, [item_id], min_score)[0]
+  items = {}
+  if matches:
+    matched_ids = [match_id for match_id, _ in matches]
+    items = {item.id: item for item in db.query(WardrobeItem).filter(WardrobeItem.id.in_(matched_ids)).all()}
+  
+  return {
+    "query_item_id": item_id,
+    "results": [
+      {
+        "item_id": match_id,
+        "score": round(score, 4),
+        "name": items[match_id].name,
+        "category": items[match_id].category,
+        "image_path": items[match_id].image_path
+      }
+      for match_id, score in matches if match_id in items
+    ]
+  }
+
+
+@router.post("/similar-batch")
+def find_similar_clothing_batch(
+    user_id: int,
+    item_ids: List[int] = Body(default=[]),
+    top_k: int = 5,
+    min_score: float = 0.0,
+    db: Session = Depends(get_db)
+):
+  """
+  批量以图搜图 / 衣橱查重：item_ids 为空时对整个衣橱逐件检索
+  
+  全部查询合并成一次矩阵乘（复用入库的图像向量）；min_score 设为 0.9 左右即可找出疑似重复上传的衣物。
+  尚未向量化或没有图片的衣物列在 missing 中。
+  """
+  embedding_service = get_embedding_service()
+  if not embedding_service.model_available:
+    raise HTTPException(status_code=503, detail="向量模型不可用")
+  
+  if not item_ids:
+    item_ids = [item_id for (item_id,) in db.query(WardrobeItem.id).filter(WardrobeItem.user_id == user_id)]
+  
+  stored = embedding_service.stored_image_embeddings(user_id, item_ids)
+  query_ids = [item_id for item_id in item_ids if item_id in stored]
+  results = []
+  if query_ids:
+    queries = np.stack([stored[item_id] for item_id in query_ids])
+    all_matches = embedding_service.search_visually_similar(user_id, queries, top_k, query_ids, min_score)
+    for query_id, matches in zip(query_ids, all_matches):
+      results.append({
+        "item_id": query_id,
+        "matches": [{"item_id": match_id, "score": round(score, 4)} for match_id, score in matches]
+      })
+  
+  return {
+    "results": results,
+    "missing": [item_id for item_id in item_ids if item_id not in stored]
+  }
+
+
 @router.delete("/{item_id}")
 def delete_clothing_item(item_id: int, db: Session = Depends(get_db)):
   item = db.query(WardrobeItem).filter(WardrobeItem.id == item_id).first()
@@ -411,13 +698,16 @@ def delete_clothing_item(item_id: int, db: Session = Depends(get_db)):
       except Exception as e:
         pass  # 删除图片文件失败
 
+  owner_id = item.user_id
   db.delete(item)
   db.commit()
+  get_phash_index().remove(owner_id, item_id)
   
-  # 删除ChromaDB中的向量
+  # 删除ChromaDB中的向量（尚未向量化的取消队列任务）
   try:
+    get_embedding_queue().cancel(item_id)
     embedding_service = get_embedding_service()
-    embedding_service.delete_item(item_id)
+    embedding_service.delete_item(item_id, owner_id)
   except Exception as e:
     pass  # 向量删除失败不影响主流程
   
@@ -455,13 +745,16 @@ def delete_clothing_batch(item_ids: List[int] = Body(...), db: Session = Depends
             pass  # 删除图片失败
       
       # 删除数据库记录
+      owner_id = item.user_id
       db.delete(item)
       db.commit()
+      get_phash_index().remove(owner_id, item_id)
       
-      # 删除向量
+      # 删除向量（尚未向量化的取消队列任务）
       try:
+        get_embedding_queue().cancel(item_id)
         embedding_service = get_embedding_service()
-        embedding_service.delete_item(item_id)
+        embedding_service.delete_item(item_id, owner_id)
       except Exception as emb_err:
         pass  # 向量删除失败
       
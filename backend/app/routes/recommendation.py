@@ -1,9 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, Body
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import Optional, Literal, List
+import itertools
+import json
 from app.core.database import get_db
 from app.services.weather_api import get_weather_by_city
-from app.services.recommendation_service import generate_outfit_recommendations, adjust_outfit_with_conversation
+from app.services.recommendation_service import (
+  fast_outfit_recommendations,
+  generate_outfit_recommendations,
+  adjust_outfit_with_conversation,
+  stream_outfit_recommendations,
+  stream_adjust_outfit_with_conversation
+)
 from app.services.embedding_service import get_embedding_service
 from app.services.conversation_manager import ConversationManager
 from app.models.user import User
@@ -11,34 +20,47 @@ from app.models.wardrobe import WardrobeItem
 
 router = APIRouter()
 
+# 中文天气状况映射回英文（用于向量检索）
+WEATHER_CN_TO_EN = {
+  '晴': 'sunny',
+  '多云': 'cloudy',
+  '阴': 'overcast',
+  '小雨': 'light rain',
+  '中雨': 'rain',
+  '大雨': 'heavy rain',
+  '暴雨': 'rainstorm',
+  '雷阵雨': 'thunderstorm',
+  '小雪': 'light snow',
+  '中雪': 'snow',
+  '大雪': 'heavy snow',
+  '暴雪': 'snowstorm',
+  '雾': 'foggy',
+  '霾': 'hazy',
+  '沙尘': 'dusty'
+}
 
-@router.get("/outfits")
-def get_outfit_recommendations(
-    user_id: int,
-    occasion: Optional[str] = Query(None),
-    style: Optional[str] = Query(None),
-    color_preference: Optional[str] = Query(None),
-    db: Session = Depends(get_db)
-):
-  user = db.query(User).filter(User.id == user_id).first()
-  if not user:
-    raise HTTPException(status_code=404, detail="用户不存在")
-
-  # 检查必填字段
-  if not user.gender or not user.age:
-    raise HTTPException(status_code=400, detail="请先完善个人资料")
-  
-  # 检查身高体重必填项
-  if not user.height or not user.weight:
-    raise HTTPException(status_code=400, detail="请先完善个人资料")
+# 规范查询集合的取值（与天气服务输出、前端偏好选项一致），用于预计算查询向量缓存
+CANONICAL_AVG_TEMPS = [30, 24, 15, 5]  # 四个温度档位各取一个代表值
+CANONICAL_CONDITIONS = [
+  'Sunny', 'Cloudy', 'Rainy', 'Thunderstorm', 'Foggy', 'Hazy', 'Dusty', 'Extreme',
+  'Light Rain', 'Moderate Rain', 'Heavy Rain', 'Rainstorm',
+  'Light Snow', 'Moderate Snow', 'Heavy Snow', 'Snowstorm'
+] + list(WEATHER_CN_TO_EN.keys())
+CANONICAL_OCCASIONS = [None, 'Daily', 'Work', 'Business', 'Formal', 'Party', 'Date', 'Travel', 'Outdoor', 'Home']
+CANONICAL_STYLES = [
+  None, 'Classic', 'Modern', 'Minimalist', 'Elegant', 'Casual',
+  'Street', 'Trendy', 'Vintage', 'Athletic', 'Preppy'
+]
+CANONICAL_COLOR_TONES = [None, 'Neutral', 'Warm', 'Cool']
 
-  # 获取天气信息（根据用户城市）
-  city = user.city or "北京"  # 默认北京
-  weather = get_weather_by_city(city)
 
-  # ===== RAG向量检索优化（分类平衡策略）=====
-  # 1. 构建查询文本（天气 + 场合 + 风格）- 简化为核心特征
-  
+def _build_outfit_query(
+    weather: dict,
+    occasion: Optional[str],
+    style: Optional[str],
+    color_preference: Optional[str]
+) -> str:
+  """构建初始推荐的检索查询文本（天气 + 场合 + 风格）- 简化为核心特征"""
   temp_max = weather.get('temp_max', 25)
   temp_min = weather.get('temp_min', 15)
   avg_temp = (temp_max + temp_min) // 2
@@ -58,24 +80,7 @@ def get_outfit_recommendations(
   # 核心特征2：天气状况（处理趋势并映射为英文）
   condition = weather.get('condition', 'clear')
   
-  # 中文天气状况映射回英文（用于向量检索）
-  cn_to_en_map = {
-    '晴': 'sunny',
-    '多云': 'cloudy',
-    '阴': 'overcast',
-    '小雨': 'light rain',
-    '中雨': 'rain',
-    '大雨': 'heavy rain',
-    '暴雨': 'rainstorm',
-    '雷阵雨': 'thunderstorm',
-    '小雪': 'light snow',
-    '中雪': 'snow',
-    '大雪': 'heavy snow',
-    '暴雪': 'snowstorm',
-    '雾': 'foggy',
-    '霾': 'hazy',
-    '沙尘': 'dusty'
-  }
+  cn_to_en_map = WEATHER_CN_TO_EN
   
   if '转' in condition:  # 如"多云转晴"
     parts = condition.split('转')
@@ -138,57 +143,114 @@ def get_outfit_recommendations(
     elif color_lower in ['cool', 'cool-tone', 'cool-tones']:
       query_parts.append('cool-tone')
   
-  query_text = " ".join(query_parts)
+  return " ".join(query_parts)
+
+
+def canonical_outfit_queries(include_preferences: bool = False) -> List[str]:
+  """
+  枚举 _build_outfit_query 可能生成的规范查询文本（温度档位 × 天气 × 降水 × 湿度 [× 场合 × 风格 × 色调]）
+
+  只含天气部分时约三百条；包含全部偏好组合时约十四万条，需相应调大 QUERY_CACHE_SIZE。
+  """
+  preference_sets = (
+    itertools.product(CANONICAL_OCCASIONS, CANONICAL_STYLES, CANONICAL_COLOR_TONES)
+    if include_preferences else [(None, None, None)]
+  )
+  weathers = [
+    {'temp_max': temp, 'temp_min': temp, 'condition': condition, 'rain_prob': rain_prob, 'humidity': humidity}
+    for temp, condition, rain_prob, humidity in itertools.product(
+      CANONICAL_AVG_TEMPS, CANONICAL_CONDITIONS, [0, 80], [60, 80]
+    )
+  ]
+  queries = [
+    _build_outfit_query(weather, occasion, style, color_preference)
+    for occasion, style, color_preference in preference_sets
+    for weather in weathers
+  ]
+  return list(dict.fromkeys(queries))
+
+
+def precompute_query_cache(mode: str) -> int:
+  """启动时预计算规范查询的文本向量（mode: weather / full），返回新写入缓存的数量"""
+  queries = canonical_outfit_queries(include_preferences=(mode == 'full'))
+  count = get_embedding_service().precompute_query_embeddings(queries)
+  print(f"查询向量缓存预计算完成：{count} 条（规范查询共 {len(queries)} 条）")
+  return count
+
+
+def _build_adjust_query(adjustment_request: str, weather: dict) -> str:
+  """构建多轮调整的检索查询（结合调整请求和天气）"""
+  query_parts = [adjustment_request]
+  
+  temp_max = weather.get('temp_max', 25)
+  temp_min = weather.get('temp_min', 15)
+  avg_temp = (temp_max + temp_min) // 2
+  
+  if avg_temp >= 28:
+    query_parts.extend(['hot', 'lightweight'])
+  elif avg_temp >= 20:
+    query_parts.append('warm')
+  elif avg_temp >= 10:
+    query_parts.append('cool')
+  else:
+    query_parts.extend(['cold', 'warm'])
   
-  # 2. 使用分类平衡检索策略
+  return " ".join(query_parts)
+
+
+# 按类别检索，确保每类都有代表
+# 新分类体系：上身3层 + 下身 + 全身 + 鞋子 + 配饰（排除内衣和袜子）
+RECOMMEND_CATEGORIES = [
+  'inner_top',    # 内层上衣（打底衫、背心、T恤）
+  'mid_top',      # 中层上衣（衬衫、毛衣、卫衣）
+  'outer_top',    # 外层上衣（夹克、外套、大衣）
+  'bottom',       # 裤子、短裤、裙子
+  'full_body',    # 连衣裙、连体裤
+  'shoes',        # 鞋子
+  'accessories'   # 包、帽子、围巾、首饰等
+]
+ITEMS_PER_CATEGORY = 3  # 每类最多3件
+
+
+def _retrieve_wardrobe(db: Session, user_id: int, query_text: str) -> list:
+  """分类平衡向量检索；检索失败或无结果时降级为全量查询"""
   try:
     embedding_service = get_embedding_service()
-    
-    # 按类别检索，确保每类都有代表
-    # 新分类体系：上身3层 + 下身 + 全身 + 鞋子 + 配饰（排除内衣和袜子）
-    categories = [
-      'inner_top',    # 内层上衣（打底衫、背心、T恤）
-      'mid_top',      # 中层上衣（衬衫、毛衣、卫衣）
-      'outer_top',    # 外层上衣（夹克、外套、大衣）
-      'bottom',       # 裤子、短裤、裙子
-      'full_body',    # 连衣裙、连体裤
-      'shoes',        # 鞋子
-      'accessories'   # 包、帽子、围巾、首饰等
+    # 查询只编码一次、一次取回该用户向量，按类别各取前 ITEMS_PER_CATEGORY 件
+    balanced = embedding_service.search_balanced(
+      query_text=query_text,
+      user_id=user_id,
+      categories=RECOMMEND_CATEGORIES,
+      per_category=ITEMS_PER_CATEGORY
+    )
+    selected_items = [
+      item_id
+      for category in RECOMMEND_CATEGORIES
+      for item_id, _ in balanced.get(category, [])
     ]
-    selected_items = []
-    items_per_category = 3  # 每类最多3件
-    
-    for category in categories:
-      category_items = embedding_service.search_similar_items(
-        query_text=query_text,
-        user_id=user_id,
-        top_k=items_per_category,
-        category_filter=category
-      )
-      if category_items:
-        selected_items.extend(category_items)
     
     # 去重（不限制总数）
     relevant_item_ids = list(dict.fromkeys(selected_items))
     
     if not relevant_item_ids:
       # 降级方案：向量检索失败时使用全量查询
-      wardrobe = db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
-    else:
-      # 从数据库批量查询检索到的衣物
-      wardrobe = db.query(WardrobeItem).filter(
-        WardrobeItem.id.in_(relevant_item_ids)
-      ).all()
-      # 按向量检索的相关性排序
-      id_to_item = {item.id: item for item in wardrobe}
-      wardrobe = [id_to_item[item_id] for item_id in relevant_item_ids if item_id in id_to_item]
+      return db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
+    
+    # 从数据库批量查询检索到的衣物
+    wardrobe = db.query(WardrobeItem).filter(
+      WardrobeItem.id.in_(relevant_item_ids)
+    ).all()
+    # 按向量检索的相关性排序
+    id_to_item = {item.id: item for item in wardrobe}
+    return [id_to_item[item_id] for item_id in relevant_item_ids if item_id in id_to_item]
   
   except Exception as e:
     # 向量检索异常降级处理
-    wardrobe = db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
-  
-  # ===== 构建衣物列表 =====
-  wardrobe_list = [
+    return db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
+
+
+def _wardrobe_to_list(wardrobe: list) -> list:
+  return [
     {
       "id": item.id,
       "name": item.name,
@@ -204,6 +266,80 @@ def get_outfit_recommendations(
     for item in wardrobe
   ]
 
+
+def _user_profile(user: User) -> dict:
+  return {
+    "id": user.id,
+    "gender": user.gender,
+    "age": user.age,
+    "height": user.height,
+    "weight": user.weight,
+    "city": user.city
+  }
+
+
+def _conversation_items_map(db: Session, conversation_history: list) -> dict:
+  """批量查询对话中涉及的所有衣物信息"""
+  all_item_ids = set()
+  for msg in conversation_history or []:
+    if "outfit_ids" in msg:
+      all_item_ids.update(msg["outfit_ids"])
+  
+  items_map = {}
+  if all_item_ids:
+    items = db.query(WardrobeItem).filter(WardrobeItem.id.in_(all_item_ids)).all()
+    items_map = {
+      item.id: {
+        "id": item.id,
+        "name": item.name,
+        "category": item.category,
+        "color": item.color,
+        "image_path": item.image_path
+      }
+      for item in items
+    }
+  return items_map
+
+
+def _sse(event: dict) -> str:
+  return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {
+  "Cache-Control": "no-cache",
+  "Connection": "keep-alive",
+  "X-Accel-Buffering": "no"
+}
+
+
+def _prepare_outfit_recommendation(
+    db: Session,
+    user_id: int,
+    occasion: Optional[str],
+    style: Optional[str],
+    color_preference: Optional[str]
+):
+  """校验用户、获取天气、检索衣物并创建会话，返回 (user, weather, wardrobe_list, preferences, session_id)"""
+  user = db.query(User).filter(User.id == user_id).first()
+  if not user:
+    raise HTTPException(status_code=404, detail="用户不存在")
+
+  # 检查必填字段
+  if not user.gender or not user.age:
+    raise HTTPException(status_code=400, detail="请先完善个人资料")
+  
+  # 检查身高体重必填项
+  if not user.height or not user.weight:
+    raise HTTPException(status_code=400, detail="请先完善个人资料")
+
+  # 获取天气信息（根据用户城市）
+  city = user.city or "北京"  # 默认北京
+  weather = get_weather_by_city(city)
+
+  # ===== RAG向量检索优化（分类平衡策略）=====
+  query_text = _build_outfit_query(weather, occasion, style, color_preference)
+  wardrobe_list = _wardrobe_to_list(_retrieve_wardrobe(db, user_id, query_text))
+
   preferences = {}
   if occasion:
     preferences["occasion"] = occasion
@@ -215,20 +351,38 @@ def get_outfit_recommendations(
   # 创建新的对话会话
   session_id = ConversationManager.create_session(db, user_id, preferences)
   
-  result = generate_outfit_recommendations(
-    user_profile={
-      "id": user.id,
-      "gender": user.gender,
-      "age": user.age,
-      "height": user.height,
-      "weight": user.weight,
-      "city": user.city
-    },
-    wardrobe_items=wardrobe_list,
-    weather=weather,
-    preferences=preferences if preferences else None
+  return user, weather, wardrobe_list, preferences, session_id
+
+
+@router.get("/outfits")
+def get_outfit_recommendations(
+    user_id: int,
+    occasion: Optional[str] = Query(None),
+    style: Optional[str] = Query(None),
+    color_preference: Optional[str] = Query(None),
+    mode: Literal["fast", "llm"] = Query("llm"),
+    db: Session = Depends(get_db)
+):
+  """
+  生成穿搭推荐
+  
+  mode=fast：直接用检索候选组合打分（不调用大模型，毫秒级）；
+  mode=llm：由 Qwen 生成方案和描述，模型失败或无可用方案时退回 fast 结果
+  """
+  user, weather, wardrobe_list, preferences, session_id = _prepare_outfit_recommendation(
+    db, user_id, occasion, style, color_preference
   )
   
+  if mode == "fast":
+    result = fast_outfit_recommendations(wardrobe_list, weather, preferences)
+  else:
+    result = generate_outfit_recommendations(
+      user_profile=_user_profile(user),
+      wardrobe_items=wardrobe_list,
+      weather=weather,
+      preferences=preferences if preferences else None
+    )
+  
   # 不自动保存推荐到会话历史，等用户选择后再保存
   # 用户需要调用 /select-outfit 接口来选择某组推荐
 
@@ -240,6 +394,47 @@ def get_outfit_recommendations(
   }
 
 
+@router.get("/outfits/stream")
+def stream_outfit_recommendations_sse(
+    user_id: int,
+    occasion: Optional[str] = Query(None),
+    style: Optional[str] = Query(None),
+    color_preference: Optional[str] = Query(None),
+    mode: Literal["fast", "llm"] = Query("llm"),
+    db: Session = Depends(get_db)
+):
+  """流式推荐（SSE）：start → 每套穿搭生成完即推送 outfit → complete（推送过 outfit 后模型出错则以 error 结束）"""
+  user, weather, wardrobe_list, preferences, session_id = _prepare_outfit_recommendation(
+    db, user_id, occasion, style, color_preference
+  )
+  
+  def generate_events():
+    yield _sse({"type": "start", "session_id": session_id, "weather": weather})
+    if mode == "fast":
+      result = fast_outfit_recommendations(wardrobe_list, weather, preferences)
+      for index, outfit in enumerate(result["outfits"]):
+        yield _sse({"type": "outfit", "index": index, "outfit": outfit})
+      yield _sse({"type": "complete", **result, "session_id": session_id})
+      return
+    for event in stream_outfit_recommendations(
+        user_profile=_user_profile(user),
+        wardrobe_items=wardrobe_list,
+        weather=weather,
+        preferences=preferences if preferences else None
+    ):
+      if event["type"] == "complete":
+        event = {**event, "session_id": session_id}
+      yield _sse(event)
+  
+  return StreamingResponse(generate_events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/query-cache/stats")
+def get_query_cache_stats():
+  """获取检索查询向量缓存的命中率"""
+  return get_embedding_service().query_cache_stats()
+
+
 @router.post("/select-outfit")
 def select_outfit(
     payload: dict = Body(...),
@@ -305,12 +500,8 @@ def select_outfit(
   }
 
 
-@router.post("/adjust")
-def adjust_outfit(
-    payload: dict = Body(...),
-    db: Session = Depends(get_db)
-):
-  """根据用户反馈调整穿搭方案（多轮对话）"""
+def _prepare_adjustment(payload: dict, db: Session):
+  """校验会话、记录用户请求并检索衣物，返回 (session, user, weather, wardrobe_list)"""
   session_id = payload.get("session_id")
   adjustment_request = payload.get("adjustment_request")
   user_id = payload.get("user_id")
@@ -347,86 +538,40 @@ def adjust_outfit(
   weather = get_weather_by_city(city)
   
   # 向量检索相关衣物
-  try:
-    embedding_service = get_embedding_service()
-    
-    # 构建检索查询（结合调整请求和天气）
-    query_parts = [adjustment_request]
-    
-    temp_max = weather.get('temp_max', 25)
-    temp_min = weather.get('temp_min', 15)
-    avg_temp = (temp_max + temp_min) // 2
-    
-    if avg_temp >= 28:
-      query_parts.extend(['hot', 'lightweight'])
-    elif avg_temp >= 20:
-      query_parts.append('warm')
-    elif avg_temp >= 10:
-      query_parts.append('cool')
-    else:
-      query_parts.extend(['cold', 'warm'])
-    
-    query_text = " ".join(query_parts)
-    
-    categories = [
-      'inner_top', 'mid_top', 'outer_top', 'bottom',
-      'full_body', 'shoes', 'accessories'
-    ]
-    selected_items = []
-    
-    for category in categories:
-      category_items = embedding_service.search_similar_items(
-        query_text=query_text,
-        user_id=user_id,
-        top_k=3,
-        category_filter=category
-      )
-      if category_items:
-        selected_items.extend(category_items)
-    
-    relevant_item_ids = list(dict.fromkeys(selected_items))
-    
-    if not relevant_item_ids:
-      wardrobe = db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
-    else:
-      wardrobe = db.query(WardrobeItem).filter(
-        WardrobeItem.id.in_(relevant_item_ids)
-      ).all()
-      id_to_item = {item.id: item for item in wardrobe}
-      wardrobe = [id_to_item[item_id] for item_id in relevant_item_ids if item_id in id_to_item]
+  query_text = _build_adjust_query(adjustment_request, weather)
+  wardrobe_list = _wardrobe_to_list(_retrieve_wardrobe(db, user_id, query_text))
   
-  except Exception as e:
-    wardrobe = db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id).all()
-  
-  # 构建衣物列表
-  wardrobe_list = [
-    {
-      "id": item.id,
-      "name": item.name,
-      "name_en": item.name_en,
-      "category": item.category,
-      "color": item.color,
-      "color_en": item.color_en,
-      "season": item.season,
-      "material": item.material,
-      "material_en": item.material_en,
-      "image_path": item.image_path
-    }
-    for item in wardrobe
-  ]
+  return session, user, weather, wardrobe_list
+
+
+def _save_adjustment_result(db: Session, session_id: str, outfits: list):
+  """保存调整结果（第一套方案）到会话历史"""
+  if outfits and len(outfits) > 0:
+    first_outfit = outfits[0]
+    outfit_ids = [item["id"] for item in first_outfit.get("items", [])]
+    
+    ConversationManager.add_message(
+      db, session_id, "assistant",
+      first_outfit.get("description", "调整了推荐方案"),
+      outfit_ids
+    )
+    ConversationManager.update_current_outfit(db, session_id, outfit_ids)
+
+
+@router.post("/adjust")
+def adjust_outfit(
+    payload: dict = Body(...),
+    db: Session = Depends(get_db)
+):
+  """根据用户反馈调整穿搭方案（多轮对话）"""
+  session, user, weather, wardrobe_list = _prepare_adjustment(payload, db)
+  session_id = session.session_id
   
   # 调用AI调整服务
   result = adjust_outfit_with_conversation(
     session_id=session_id,
-    adjustment_request=adjustment_request,
-    user_profile={
-      "id": user.id,
-      "gender": user.gender,
-      "age": user.age,
-      "height": user.height,
-      "weight": user.weight,
-      "city": user.city
-    },
+    adjustment_request=payload.get("adjustment_request"),
+    user_profile=_user_profile(user),
     wardrobe_items=wardrobe_list,
     weather=weather,
     preferences=session.preferences,
@@ -436,48 +581,54 @@ def adjust_outfit(
   )
   
   # 保存调整结果
-  if result.get("outfits") and len(result["outfits"]) > 0:
-    first_outfit = result["outfits"][0]
-    outfit_ids = [item["id"] for item in first_outfit.get("items", [])]
-    
-    ConversationManager.add_message(
-      db, session_id, "assistant",
-      first_outfit.get("description", "调整了推荐方案"),
-      outfit_ids
-    )
-    ConversationManager.update_current_outfit(db, session_id, outfit_ids)
+  _save_adjustment_result(db, session_id, result.get("outfits"))
   
   # 获取更新后的会话历史和衣物映射
   updated_session = ConversationManager.get_session(db, session_id)
   
-  all_item_ids = set()
-  for msg in updated_session.conversation_history or []:
-    if "outfit_ids" in msg:
-      all_item_ids.update(msg["outfit_ids"])
-  
-  # 批量查询衣物信息
-  items_map = {}
-  if all_item_ids:
-    items = db.query(WardrobeItem).filter(WardrobeItem.id.in_(all_item_ids)).all()
-    items_map = {
-      item.id: {
-        "id": item.id,
-        "name": item.name,
-        "category": item.category,
-        "color": item.color,
-        "image_path": item.image_path
-      }
-      for item in items
-    }
-  
   return {
     "session_id": session_id,
     "outfits": result.get("outfits", []),
     "conversation_history": updated_session.conversation_history,
-    "items_map": items_map
+    "items_map": _conversation_items_map(db, updated_session.conversation_history)
   }
 
 
+@router.post("/adjust/stream")
+def adjust_outfit_stream(
+    payload: dict = Body(...),
+    db: Session = Depends(get_db)
+):
+  """流式调整穿搭方案（SSE）：每套方案生成完即推送，结束后推送更新后的会话历史"""
+  session, user, weather, wardrobe_list = _prepare_adjustment(payload, db)
+  session_id = session.session_id
+  
+  def generate_events():
+    yield _sse({"type": "start", "session_id": session_id})
+    for event in stream_adjust_outfit_with_conversation(
+        session_id=session_id,
+        adjustment_request=payload.get("adjustment_request"),
+        user_profile=_user_profile(user),
+        wardrobe_items=wardrobe_list,
+        weather=weather,
+        preferences=session.preferences,
+        conversation_history=session.conversation_history,
+        current_outfit=session.current_outfit
+    ):
+      if event["type"] == "complete":
+        _save_adjustment_result(db, session_id, event.get("outfits"))
+        updated_session = ConversationManager.get_session(db, session_id)
+        event = {
+          **event,
+          "session_id": session_id,
+          "conversation_history": updated_session.conversation_history,
+          "items_map": _conversation_items_map(db, updated_session.conversation_history)
+        }
+      yield _sse(event)
+  
+  return StreamingResponse(generate_events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @router.get("/sessions")
 def get_user_sessions(
     user_id: int = Query(...),
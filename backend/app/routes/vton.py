@@ -1,5 +1,5 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from typing import List
 import httpx
 import logging
@@ -10,6 +10,8 @@ logger = logging.getLogger(__name__)
 # 指向你刚才启动的 ML 服务地址
 ML_SERVICE_URL = "http://127.0.0.1:8001/process_tryon"
 ML_BATCH_URL = "http://127.0.0.1:8001/batch_tryon"
+# 异步任务接口：提交后立即返回 job_id，通过轮询或 SSE 获取进度，完成后取结果图
+ML_JOBS_URL = "http://127.0.0.1:8001/jobs"
 
 @router.post("/try-on")
 async def try_on_proxy(
@@ -88,4 +90,103 @@ async def batch_try_on_proxy(
             
         except httpx.RequestError as exc:
             logger.error(f"无法连接到 ML 批量服务: {exc}")
-            raise HTTPException(status_code=500, detail="无法连接到 AI 推理服务，请检查服务是否启动")
\ No newline at end of file
+            raise HTTPException(status_code=500, detail="无法连接到 AI 推理服务，请检查服务是否启动")
+
+
+def _ml_error(response: httpx.Response, default: str) -> HTTPException:
+    """把 ML 服务的错误原样透传（保留 429 的 Retry-After）"""
+    try:
+        detail = response.json().get("detail", default)
+    except ValueError:
+        detail = default
+    headers = {"Retry-After": response.headers["Retry-After"]} if "Retry-After" in response.headers else None
+    return HTTPException(status_code=response.status_code, detail=detail, headers=headers)
+
+
+async def _forward_job_request(method: str, path: str = "", **kwargs) -> httpx.Response:
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        try:
+            return await client.request(method, f"{ML_JOBS_URL}{path}", **kwargs)
+        except httpx.RequestError as exc:
+            logger.error(f"无法连接到 ML 服务: {exc}")
+            raise HTTPException(status_code=500, detail="无法连接到 AI 推理服务，请检查服务是否启动")
+
+
+@router.post("/jobs", status_code=202)
+async def submit_try_on_job(
+    person_img: UploadFile = File(...),
+    cloth_imgs: List[UploadFile] = File(...),
+    categories: str = Form(...)
+):
+    """
+    提交试穿任务，立即返回 {job_id, status, position, ...}，不再占用连接等待推理完成
+    """
+    logger.info(f"收到试衣任务: categories={categories}, 衣服数量={len(cloth_imgs)}")
+    files = [('person_img', (person_img.filename, await person_img.read(), person_img.content_type))]
+    for cloth in cloth_imgs:
+        files.append(('cloth_imgs', (cloth.filename, await cloth.read(), cloth.content_type)))
+
+    response = await _forward_job_request("POST", files=files, data={'categories': categories})
+    if response.status_code != 202:
+        logger.error(f"ML 任务提交失败: {response.text}")
+        raise _ml_error(response, "试穿任务提交失败，请稍后重试")
+    return response.json()
+
+
+@router.get("/jobs/{job_id}")
+async def get_try_on_job(job_id: str):
+    """查询任务状态与进度"""
+    response = await _forward_job_request("GET", f"/{job_id}")
+    if response.status_code != 200:
+        raise _ml_error(response, "任务查询失败")
+    return response.json()
+
+
+@router.get("/jobs/{job_id}/events")
+async def try_on_job_events(job_id: str):
+    """SSE 透传任务进度事件"""
+    client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=None))
+    try:
+        response = await client.send(client.build_request("GET", f"{ML_JOBS_URL}/{job_id}/events"), stream=True)
+    except httpx.RequestError as exc:
+        await client.aclose()
+        logger.error(f"无法连接到 ML 服务: {exc}")
+        raise HTTPException(status_code=500, detail="无法连接到 AI 推理服务，请检查服务是否启动")
+
+    if response.status_code != 200:
+        await response.aread()
+        await response.aclose()
+        await client.aclose()
+        raise _ml_error(response, "任务查询失败")
+
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+            await client.aclose()
+
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_try_on_job_result(job_id: str):
+    """获取任务结果图（任务未完成时返回 409）"""
+    response = await _forward_job_request("GET", f"/{job_id}/result")
+    if response.status_code != 200:
+        raise _ml_error(response, "任务结果获取失败")
+    return Response(content=response.content, media_type="image/png")
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_try_on_job(job_id: str):
+    """取消排队中或推理中的任务"""
+    response = await _forward_job_request("DELETE", f"/{job_id}")
+    if response.status_code != 200:
+        raise _ml_error(response, "任务取消失败")
+    return response.json()
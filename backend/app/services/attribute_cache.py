@@ -0,0 +1,162 @@
+"""
+衣物属性分析缓存 - 按图片内容哈希 + prompt 版本持久化 VLM 解析结果
+
+同一张图片重复上传或批量重新导入时，直接返回已解析的属性 JSON，无需再次运行 8B 视觉模型。
+存储使用 SQLite（单文件、进程重启后仍有效），按最近访问时间做 LRU 淘汰，总条目数和总字节数均有上限。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+def hash_image_file(image_path: str) -> str:
+    """计算图片文件内容的 SHA-256（内容寻址，与文件名无关）"""
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AttributeCache:
+    """衣物属性磁盘缓存（线程安全，LRU + 容量上限）"""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_entries: int = 50000,
+        max_bytes: int = 64 * 1024 * 1024
+    ):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attribute_cache (
+                cache_key TEXT PRIMARY KEY,
+                attributes TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_attribute_cache_last_access ON attribute_cache(last_access)"
+        )
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(content_hash: str, prompt_version: str) -> str:
+        return f"{content_hash}:{prompt_version}"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，命中时刷新最近访问时间"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT attributes FROM attribute_cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE attribute_cache SET last_access = ? WHERE cache_key = ?",
+                (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, attributes: Dict[str, Any]):
+        """写入缓存，超出容量时淘汰最久未访问的条目"""
+        payload = json.dumps(attributes, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO attribute_cache (cache_key, attributes, size, last_access, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (key, payload, len(payload.encode("utf-8")), now, now)
+            )
+            self.stores += 1
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count, total_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM attribute_cache"
+        ).fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        # 从最久未访问的条目开始淘汰，直到满足两个上限
+        to_delete = []
+        for cache_key, size in self._conn.execute(
+            "SELECT cache_key, size FROM attribute_cache ORDER BY last_access ASC"
+        ):
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            to_delete.append((cache_key,))
+            count -= 1
+            total_bytes -= size
+
+        self._conn.executemany("DELETE FROM attribute_cache WHERE cache_key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM attribute_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM attribute_cache"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "entries": count,
+                "bytes": total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions
+            }
+
+
+# 全局单例
+_attribute_cache: Optional[AttributeCache] = None
+_attribute_cache_lock = threading.Lock()
+
+
+def get_attribute_cache() -> AttributeCache:
+    """获取属性缓存单例"""
+    global _attribute_cache
+    if _attribute_cache is None:
+        with _attribute_cache_lock:
+            if _attribute_cache is None:
+                _attribute_cache = AttributeCache(
+                    db_path=os.path.join(os.getcwd(), "attribute_cache", "attributes.db"),
+                    max_entries=int(os.getenv("ATTRIBUTE_CACHE_MAX_ENTRIES", "50000")),
+                    max_bytes=int(os.getenv("ATTRIBUTE_CACHE_MAX_MB", "64")) * 1024 * 1024
+                )
+    return _attribute_cache
@@ -120,6 +120,12 @@ class ConversationManager:
     
     return True
   
+  @staticmethod
+  def release_kv_cache(session_id: str):
+    """释放会话在模型侧的 KV 缓存（多轮调整时按会话复用，删除会话时一并释放）"""
+    from app.services.recommendation_service import release_conversation_cache
+    release_conversation_cache(session_id)
+  
   @staticmethod
   def delete_session(db: Session, session_id: str):
     """删除会话"""
@@ -127,6 +133,7 @@ class ConversationManager:
     if session:
       db.delete(session)
       db.commit()
+    ConversationManager.release_kv_cache(session_id)
   
   @staticmethod
   def delete_all_user_sessions(db: Session, user_id: int) -> int:
@@ -136,12 +143,16 @@ class ConversationManager:
     ).all()
     
     count = len(sessions)
+    session_ids = [session.session_id for session in sessions]
     for session in sessions:
       db.delete(session)
     
     if count > 0:
       db.commit()
     
+    for session_id in session_ids:
+      ConversationManager.release_kv_cache(session_id)
+    
     return count
   
   @staticmethod
@@ -160,10 +171,14 @@ class ConversationManager:
     ).all()
     
     count = len(old_sessions)
+    session_ids = [session.session_id for session in old_sessions]
     for session in old_sessions:
       db.delete(session)
     
     if count > 0:
       db.commit()
     
+    for session_id in session_ids:
+      ConversationManager.release_kv_cache(session_id)
+    
     return count
@@ -0,0 +1,293 @@
+"""
+衣物向量化后台队列 - 上传请求只入队，文本 / CLIP 向量由后台工作线程批量生成
+
+上传接口在数据库提交后调用 enqueue 立即返回，不再在请求内同步跑 CLIP。
+工作线程把短时间内积压的任务合并成一批，走 EmbeddingService.batch_add_items 的批量路径。
+get_user_lag 返回某个用户尚未完成向量化的衣物数量和最久等待时间（索引滞后）。
+
+失败的任务延迟后重试（最多 max_retries 次，间隔逐次加倍），仍失败的记入 failed_item_ids，
+不会被当成已入库；队列只在内存中，启动时 enqueue_unindexed_items 把数据库中还没有向量的衣物重新入队。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+
+
+@dataclass
+class EmbeddingJob:
+    item_id: int
+    user_id: int
+    attributes: Dict[str, Any]
+    image_path: Optional[str]
+    enqueued_at: float
+    source_item_id: Optional[int] = None  # 重复上传时沿用其向量的已有衣物
+    attempts: int = 0  # 已失败的次数
+    retry_at: float = 0.0  # 等待重试的任务最早何时重新入队
+
+
+class EmbeddingQueue:
+    """向量化任务队列（线程安全，工作线程数有上限，按批合并）"""
+
+    def __init__(
+        self,
+        num_workers: int = 1,
+        max_batch: int = 32,
+        linger_seconds: float = 0.2,
+        max_retries: int = 3,
+        retry_delay: float = 5.0
+    ):
+        self.num_workers = max(1, num_workers)
+        self.max_batch = max(1, max_batch)
+        self.linger_seconds = linger_seconds
+        self.max_retries = max(0, max_retries)
+        self.retry_delay = retry_delay
+
+        self._cond = threading.Condition()
+        self._pending: "OrderedDict[int, EmbeddingJob]" = OrderedDict()
+        self._in_progress: Dict[int, EmbeddingJob] = {}
+        self._retrying: Dict[int, EmbeddingJob] = {}  # 失败后等待重试
+        self._failed: Dict[int, EmbeddingJob] = {}  # 重试用尽仍失败（重新入队前一直可见）
+        self._cancelled: Set[int] = set()
+        self._last_indexed: Dict[int, float] = {}
+        self._workers: List[threading.Thread] = []
+
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+
+    def _ensure_workers(self):
+        """首次入队时启动工作线程（模型也在工作线程中加载，不占用请求）"""
+        if self._workers:
+            return
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self._run, name=f"embedding-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def enqueue(
+        self,
+        item_id: int,
+        attributes: Dict[str, Any],
+        image_path: Optional[str] = None,
+        source_item_id: Optional[int] = None
+    ):
+        """
+        加入向量化任务；同一衣物重复入队时以最新属性为准
+
+        source_item_id 为重复上传的原衣物：其向量已入库时直接复制，不再编码
+        """
+        job = EmbeddingJob(
+            item_id=item_id,
+            user_id=int(attributes.get("user_id", 0)),
+            attributes=attributes,
+            image_path=image_path,
+            enqueued_at=time.time(),
+            source_item_id=source_item_id
+        )
+        with self._cond:
+            self._ensure_workers()
+            self._cancelled.discard(item_id)
+            self._pending.pop(item_id, None)
+            self._retrying.pop(item_id, None)
+            self._failed.pop(item_id, None)
+            self._pending[item_id] = job
+            self.enqueued += 1
+            self._cond.notify()
+
+    def cancel(self, item_id: int):
+        """衣物被删除时取消其任务；正在处理的任务完成后会删除已写入的向量"""
+        with self._cond:
+            self._retrying.pop(item_id, None)
+            self._failed.pop(item_id, None)
+            if self._pending.pop(item_id, None) is None and item_id in self._in_progress:
+                self._cancelled.add(item_id)
+
+    def _promote_retries(self) -> Optional[float]:
+        """到期的重试任务移回待处理队列，返回距下一个重试任务到期的秒数（没有则为 None）"""
+        now = time.time()
+        wait = None
+        for item_id, job in list(self._retrying.items()):
+            if job.retry_at <= now:
+                del self._retrying[item_id]
+                self._pending[item_id] = job
+            else:
+                wait = job.retry_at - now if wait is None else min(wait, job.retry_at - now)
+        return wait
+
+    def _take_batch(self) -> List[EmbeddingJob]:
+        with self._cond:
+            while True:
+                wait = self._promote_retries()
+                if self._pending:
+                    break
+                self._cond.wait(wait)
+            # 稍等片刻，让同一批上传的其他衣物一起入队（每次入队都会唤醒，直到凑满一批或等满 linger）
+            deadline = time.time() + self.linger_seconds
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                _, job = self._pending.popitem(last=False)
+                self._in_progress[job.item_id] = job
+                batch.append(job)
+            return batch
+
+    def _run(self):
+        from app.services.embedding_service import get_embedding_service
+
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                continue
+            try:
+                embedding_service = get_embedding_service()
+                # 重复上传的衣物优先复制原衣物的向量，复制不了的再批量编码
+                to_encode = [
+                    job for job in batch
+                    if job.source_item_id is None
+                    or not embedding_service.copy_item(job.source_item_id, job.item_id, job.attributes)
+                ]
+                failed_ids = set()
+                if to_encode:
+                    result = embedding_service.batch_add_items(
+                        [
+                            {**job.attributes, "id": job.item_id, "image_path": job.image_path}
+                            for job in to_encode
+                        ],
+                        batch_size=len(to_encode),
+                        num_workers=0,  # 批次很小，在当前线程解码图片即可
+                        progress_callback=lambda done, total: None
+                    )
+                    failed_ids = set(result.get("failed_ids", []))
+            except Exception as e:
+                print(f"[EmbeddingQueue] 批量向量化失败: {e}")
+                embedding_service = None
+                failed_ids = {job.item_id for job in batch}
+
+            with self._cond:
+                cancelled = [job for job in batch if job.item_id in self._cancelled]
+                now = time.time()
+                for job in batch:
+                    self._in_progress.pop(job.item_id, None)
+                    was_cancelled = job.item_id in self._cancelled
+                    self._cancelled.discard(job.item_id)
+                    if job.item_id not in failed_ids:
+                        self._last_indexed[job.user_id] = now
+                        self.completed += 1
+                    elif was_cancelled or job.item_id in self._pending:
+                        continue  # 已删除，或处理期间又重新入队（以新任务为准）
+                    elif job.attempts < self.max_retries:
+                        job.attempts += 1
+                        job.retry_at = now + self.retry_delay * 2 ** (job.attempts - 1)
+                        self._retrying[job.item_id] = job
+                        self.retries += 1
+                    else:
+                        print(f"[EmbeddingQueue] 衣物 {job.item_id} 重试 {job.attempts} 次后仍向量化失败")
+                        self._failed[job.item_id] = job
+                        self.failed += 1
+                self.batches += 1
+                if self._retrying:
+                    self._cond.notify()  # 让空闲的工作线程按重试时间等待
+
+            # 处理期间被删除的衣物，清理刚写入的向量
+            for job in cancelled:
+                try:
+                    if embedding_service is not None:
+                        embedding_service.delete_item(job.item_id, job.user_id)
+                except Exception as e:
+                    pass
+
+    def get_user_lag(self, user_id: int) -> Dict[str, Any]:
+        """
+        某个用户的索引滞后：待处理 / 处理中 / 等待重试的衣物数、最久等待秒数、最近一次成功时间，
+        以及重试用尽仍失败的衣物（failed_item_ids，这些衣物不在向量索引中）
+        """
+        with self._cond:
+            queues = (self._pending, self._in_progress, self._retrying)
+            jobs = [job for jobs in queues for job in jobs.values() if job.user_id == user_id]
+            failed = [job.item_id for job in self._failed.values() if job.user_id == user_id]
+            pending = sum(1 for job in jobs if job.item_id in self._pending)
+            retrying = sum(1 for job in jobs if job.item_id in self._retrying)
+            oldest = min((job.enqueued_at for job in jobs), default=None)
+            return {
+                "user_id": user_id,
+                "pending": pending,
+                "in_progress": len(jobs) - pending - retrying,
+                "retrying": retrying,
+                "failed": len(failed),
+                "lag_seconds": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+                "pending_item_ids": [job.item_id for job in jobs],
+                "failed_item_ids": failed,
+                "last_indexed_at": self._last_indexed.get(user_id)
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "workers": len(self._workers),
+                "max_batch": self.max_batch,
+                "pending": len(self._pending),
+                "in_progress": len(self._in_progress),
+                "retrying": len(self._retrying),
+                "failed_items": len(self._failed),
+                "max_retries": self.max_retries,
+                "enqueued": self.enqueued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "batches": self.batches
+            }
+
+
+# 全局单例
+_embedding_queue = EmbeddingQueue(
+    num_workers=int(os.getenv("EMBEDDING_QUEUE_WORKERS", "1")),
+    max_batch=int(os.getenv("EMBEDDING_QUEUE_BATCH", "32")),
+    linger_seconds=float(os.getenv("EMBEDDING_QUEUE_LINGER_MS", "200")) / 1000,
+    max_retries=int(os.getenv("EMBEDDING_QUEUE_RETRIES", "3")),
+    retry_delay=float(os.getenv("EMBEDDING_QUEUE_RETRY_DELAY", "5"))
+)
+
+
+def get_embedding_queue() -> EmbeddingQueue:
+    """获取向量化队列实例"""
+    return _embedding_queue
+
+
+def enqueue_unindexed_items() -> int:
+    """启动时补齐：数据库中有、ChromaDB 中没有向量的衣物重新入队（上次退出时还在队列中的任务），返回入队数量"""
+    from app.core.database import SessionLocal
+    from app.models.wardrobe import WardrobeItem
+    from app.services.embedding_service import get_embedding_service
+
+    embedding_service = get_embedding_service()
+    if not embedding_service.model_available or embedding_service.wardrobe_collection is None:
+        return 0
+    indexed = set(embedding_service.wardrobe_collection.get(include=[])["ids"])
+
+    db = SessionLocal()
+    try:
+        items = [item for item in db.query(WardrobeItem) if str(item.id) not in indexed]
+        for item in items:
+            _embedding_queue.enqueue(item.id, {
+                "user_id": item.user_id,
+                "name": item.name,
+                "name_en": item.name_en or "",
+                "color_en": item.color_en or "",
+                "material_en": item.material_en or "",
+                "season": item.season,
+                "category": item.category
+            }, image_path=item.image_path)
+    finally:
+        db.close()
+    if items:
+        print(f"[EmbeddingQueue] {len(items)} 件衣物尚无向量，已重新入队")
+    return len(items)
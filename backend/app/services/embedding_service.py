@@ -2,16 +2,52 @@
 向量化服务模块 - 负责生成和管理衣物的语义向量（多模态：文本+图像）
 """
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterator
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 import threading
+from collections import OrderedDict
 import torch
 from PIL import Image
+from torch.utils.data import Dataset, DataLoader
 from transformers import CLIPModel, CLIPProcessor
 import numpy as np
 
+from app.services.vector_index import VectorIndex
+
+# 衣橱向量集合名（更换Embedding模型时可先用 reindex 写入新集合，再切换此变量重启服务）
+WARDROBE_COLLECTION = os.getenv("WARDROBE_COLLECTION", "wardrobe_items")
+
+
+def chroma_data_path() -> str:
+    """ChromaDB 数据目录（相对服务启动目录）"""
+    return os.path.join(os.getcwd(), "chroma_data")
+
+
+class _ClipImageDataset(Dataset):
+    """批量入库用：在 DataLoader 工作进程中并行解码图片并做 CLIP 预处理"""
+    
+    def __init__(self, image_paths: List[Optional[str]], processor: CLIPProcessor):
+        self.image_paths = image_paths
+        self.processor = processor
+        size = processor.image_processor.crop_size
+        self.blank = torch.zeros(3, size["height"], size["width"])
+    
+    def __len__(self):
+        return len(self.image_paths)
+    
+    def __getitem__(self, index: int):
+        image_path = self.image_paths[index]
+        if not image_path or not os.path.exists(image_path):
+            return self.blank, False
+        try:
+            image = Image.open(image_path).convert("RGB")
+            pixel_values = self.processor(images=image, return_tensors="pt")["pixel_values"][0]
+            return pixel_values, True
+        except Exception as e:
+            return self.blank, False
+
 
 class EmbeddingService:
     """衣橱向量化服务（单例模式）"""
@@ -32,8 +68,20 @@ class EmbeddingService:
         if self._initialized:
             return
         
+        # 查询文本向量 LRU 缓存（推荐查询由少量固定词汇组合而成，大量请求的查询文本完全相同）
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.query_cache_size = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        
+        # 后融合权重：同时给出文本和图像查询时各模态余弦相似度的加权系数
+        self.fusion_weights = {
+            "text": float(os.getenv("FUSION_TEXT_WEIGHT", "0.5")),
+            "image": float(os.getenv("FUSION_IMAGE_WEIGHT", "0.5"))
+        }
+        
         # 设置完全离线模式（在加载任何模型之前）
-        import os
         from pathlib import Path
         
         os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
@@ -116,37 +164,76 @@ class EmbeddingService:
         
         # 初始化ChromaDB客户端（仅当模型可用时）
         if self.model_available:
-            chroma_data_path = os.path.join(os.getcwd(), "chroma_data")
-            os.makedirs(chroma_data_path, exist_ok=True)
+            data_path = chroma_data_path()
+            os.makedirs(data_path, exist_ok=True)
             
             self.chroma_client = chromadb.PersistentClient(
-                path=chroma_data_path,
+                path=data_path,
                 settings=Settings(anonymized_telemetry=False)
             )
             
             # 创建或获取衣橱向量集合
             self.wardrobe_collection = self.chroma_client.get_or_create_collection(
-                name="wardrobe_items",
+                name=WARDROBE_COLLECTION,
                 metadata={"description": "用户衣橱语义向量存储（多模态1536维）"}
             )
             
-            print(f"ChromaDB初始化成功，数据路径: {chroma_data_path}")
+            print(f"ChromaDB初始化成功，数据路径: {data_path}，集合: {WARDROBE_COLLECTION}")
             print(f"当前向量库中已有 {self.wardrobe_collection.count()} 条记录")
+            
+            # 按用户、按模态的内存映射向量索引（ChromaDB 为持久数据源，索引按需从中重建）
+            self.vector_index = VectorIndex(
+                root_dir=os.path.join(os.getcwd(), "vector_index", WARDROBE_COLLECTION),
+                dims={"text": self.text_dim, "image": self.image_dim},
+                loader=self._load_user_vectors,
+                max_users=int(os.getenv("VECTOR_INDEX_MAX_USERS", "256")),
+                precision=os.getenv("VECTOR_INDEX_PRECISION", "float32"),
+                rescore=int(os.getenv("VECTOR_INDEX_RESCORE", "64"))
+            )
         else:
             self.chroma_client = None
             self.wardrobe_collection = None
+            self.vector_index = None
             print(f"ChromaDB未初始化，向量检索功能不可用")
         
         self._initialized = True
     
-    def generate_text_embedding(self, item: Dict[str, Any]) -> List[float]:
+    def warmup(self) -> float:
         """
-        生成文本语义向量
+        编码一条文本和一张合成图片（分配推理缓冲、触发算子首次初始化），返回耗时（秒）
+        
+        不经过查询向量缓存，不影响缓存命中统计
         """
         if not self.model_available:
-            return []  # 模型不可用时返回空向量
+            return 0.0
+        import time
+        started = time.time()
+        self._encode_text("warm up clothing item")
+        inputs = self.clip_processor(images=Image.new("RGB", (224, 224), (200, 200, 200)), return_tensors="pt")
+        with torch.no_grad():
+            self.clip_model.get_image_features(**inputs)
+        return time.time() - started
+    
+    def generate_text_embedding(self, item: Dict[str, Any], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        生成文本语义向量（float32），传入 out 时直接写入 out 并返回 out
+        """
+        if not self.model_available:
+            return np.empty(0, dtype=np.float32)  # 模型不可用时返回空向量
         
-        # 构建语义文本（使用英文字段，模型对英文理解更准确）
+        # 生成向量（CPU推理约50-100ms）
+        return self._encode_text(self._semantic_text(item), out)
+    
+    def _encode_text(self, text: str, out: Optional[np.ndarray] = None) -> np.ndarray:
+        embedding = self.text_encoder.encode(text, convert_to_numpy=True)
+        if out is None:
+            return np.ascontiguousarray(embedding, dtype=np.float32)
+        out[:] = embedding
+        return out
+    
+    @staticmethod
+    def _semantic_text(item: Dict[str, Any]) -> str:
+        """构建语义文本（使用英文字段，模型对英文理解更准确）"""
         text_parts = [
             item.get("name_en", item.get("name", "")),
             item.get("color_en", item.get("color", "")),
@@ -157,20 +244,16 @@ class EmbeddingService:
         
         # 过滤空值，拼接成语义文本
         semantic_text = " ".join([part for part in text_parts if part]).strip()
-        
-        if not semantic_text:
-            semantic_text = "unknown clothing item"
-        
-        # 生成向量（CPU推理约50-100ms）
-        embedding = self.text_encoder.encode(semantic_text, convert_to_numpy=True)
-        return embedding.tolist()
+        return semantic_text or "unknown clothing item"
     
-    def generate_image_embedding(self, image_path: str) -> List[float]:
+    def generate_image_embedding(self, image_path: str, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
         """
-        生成图像语义向量（使用CLIP）
+        生成图像语义向量（使用CLIP，float32），传入 out 时直接写入 out 并返回 out；失败返回 None
+        
+        image_path 也可以是已打开的文件对象（如上传文件的内容，无需先落盘）
         """
         if not self.model_available or not self.clip_model:
-            return []  # 模型不可用时返回空向量
+            return None  # 模型不可用
         
         try:
             # 加载图像
@@ -183,24 +266,31 @@ class EmbeddingService:
             with torch.no_grad():
                 outputs = self.clip_model.get_image_features(**inputs)
             
-            # 提取tensor数据
-            if hasattr(outputs, 'last_hidden_state'):
-                image_features = outputs.last_hidden_state[:, 0, :]
-            elif hasattr(outputs, 'pooler_output'):
-                image_features = outputs.pooler_output
-            else:
-                image_features = outputs
-            
-            # 归一化向量
-            norm = torch.norm(image_features, p=2, dim=-1, keepdim=True)
-            image_features = image_features / norm
-            
-            return image_features.squeeze().cpu().numpy().tolist()
+            features = self._normalize_image_features(outputs)[0].cpu().numpy()
+            if out is None:
+                return np.ascontiguousarray(features, dtype=np.float32)
+            out[:] = features
+            return out
             
         except Exception as e:
-            return []
+            return None
+    
+    @staticmethod
+    def _normalize_image_features(outputs: Any) -> torch.Tensor:
+        """从 get_image_features 的输出中取出特征并做 L2 归一化，形状 (batch, dim)"""
+        # 提取tensor数据
+        if hasattr(outputs, 'last_hidden_state'):
+            image_features = outputs.last_hidden_state[:, 0, :]
+        elif hasattr(outputs, 'pooler_output'):
+            image_features = outputs.pooler_output
+        else:
+            image_features = outputs
+        
+        # 归一化向量
+        norm = torch.norm(image_features, p=2, dim=-1, keepdim=True)
+        return image_features / norm
     
-    def generate_embedding(self, item: Dict[str, Any], image_path: Optional[str] = None) -> List[float]:
+    def generate_embedding(self, item: Dict[str, Any], image_path: Optional[str] = None) -> np.ndarray:
         """
         生成多模态融合向量（文本 + 图像）
         
@@ -209,28 +299,29 @@ class EmbeddingService:
             image_path: 衣物图像路径（可选）
         
         Returns:
-            融合向量 (768维文本 + 768维图像 = 1536维)
+            融合向量 float32 (768维文本 + 768维图像 = 1536维)
         """
         if not self.model_available:
-            return []  # 模型不可用时返回空向量
+            return np.empty(0, dtype=np.float32)  # 模型不可用时返回空向量
         
-        # 生成文本向量
-        text_vec = self.generate_text_embedding(item)
+        return self._fuse(self._semantic_text(item), image_path)
+    
+    def _fuse(self, text: Optional[str], image_path: Optional[str], cache_text: bool = False) -> np.ndarray:
+        """
+        预分配融合向量，文本 / 图像两半直接原地写入
         
-        # 生成图像向量（如果提供了图像路径）
+        无文本或无图像（或图像向量生成失败）时对应一半保持为零：
+        图像向量经过L2归一化、均值约为0，零向量对纯文本查询的距离影响最小
+        """
+        fused = np.zeros(self.total_dim, dtype=np.float32)
+        if text and cache_text:
+            fused[:self.text_dim] = self._cached_text_embedding(text)
+        elif text:
+            self._encode_text(text, fused[:self.text_dim])
         if image_path and os.path.exists(image_path):
-            image_vec = self.generate_image_embedding(image_path)
-            if not image_vec:
-                # 图像向量生成失败，使用零向量填充
-                image_vec = [0.0] * self.image_dim
-        else:
-            # 无图像，使用零向量
-            image_vec = [0.0] * self.image_dim
-        
-        # 拼接融合向量
-        fused_embedding = text_vec + image_vec
-        
-        return fused_embedding
+            if self.generate_image_embedding(image_path, fused[self.text_dim:]) is None:
+                fused[self.text_dim:] = 0.0  # 写入中途失败时清零
+        return fused
     
     def add_item(self, item_id: int, item: Dict[str, Any], image_path: Optional[str] = None) -> bool:
         """将衣物向量添加到ChromaDB"""
@@ -240,40 +331,97 @@ class EmbeddingService:
         try:
             # 生成多模态融合向量
             embedding = self.generate_embedding(item, image_path)
-            
-            # 构建元数据（用于混合检索的精确过滤）
-            metadata = {
-                "category": item.get("category", "unknown"),
-                "season": item.get("season", "all"),
-                "color_en": item.get("color_en", ""),
-                "material_en": item.get("material_en", ""),
-                "style": item.get("style", ""),
-                "user_id": str(item.get("user_id", 0))
-            }
-            
-            # 添加到ChromaDB
-            self.wardrobe_collection.add(
-                ids=[str(item_id)],
-                embeddings=[embedding],
-                metadatas=[metadata],
-                documents=[item.get("name_en", item.get("name", "Unknown"))]
-            )
+            self._store_item(item_id, item, embedding)
             return True
             
         except Exception as e:
             return False
     
-    def delete_item(self, item_id: int) -> bool:
-        """从ChromaDB删除衣物向量"""
+    def copy_item(self, source_item_id: int, item_id: int, item: Dict[str, Any]) -> bool:
+        """
+        复用已入库衣物的融合向量（重复上传同一件衣物、属性也沿用时，不再跑文本模型和 CLIP）
+        
+        源衣物尚未向量化时返回 False，由调用方改走向量化队列
+        """
+        if not self.model_available:
+            return False
+        
+        try:
+            existing = self.wardrobe_collection.get(ids=[str(source_item_id)], include=["embeddings"])
+            if not existing["ids"]:
+                return False
+            self._store_item(item_id, item, np.asarray(existing["embeddings"][0], dtype=np.float32))
+            return True
+        except Exception as e:
+            return False
+    
+    def _store_item(self, item_id: int, item: Dict[str, Any], embedding: np.ndarray):
+        """写入 ChromaDB 并增量更新用户索引"""
+        # 构建元数据（用于混合检索的精确过滤）
+        metadata = self._build_metadata(item)
+        
+        # 添加到ChromaDB（只在这一边界转换为列表）
+        self.wardrobe_collection.add(
+            ids=[str(item_id)],
+            embeddings=[embedding.tolist()],
+            metadatas=[metadata],
+            documents=[item.get("name_en", item.get("name", "Unknown"))]
+        )
+        
+        # 增量更新用户索引（失败时丢弃索引文件，下次检索从ChromaDB重建）
+        user_id = int(item.get("user_id", 0))
+        try:
+            self.vector_index.add(user_id, [item_id], embedding[None, :], [metadata])
+        except Exception as e:
+            self.vector_index.invalidate(user_id)
+    
+    @staticmethod
+    def _build_metadata(item: Dict[str, Any]) -> Dict[str, str]:
+        """ChromaDB 元数据（用于混合检索的精确过滤）"""
+        return {
+            "category": item.get("category", "unknown"),
+            "season": item.get("season", "all"),
+            "color_en": item.get("color_en", ""),
+            "material_en": item.get("material_en", ""),
+            "style": item.get("style", ""),
+            "user_id": str(item.get("user_id", 0))
+        }
+    
+    def delete_item(self, item_id: int, user_id: Optional[int] = None) -> bool:
+        """从ChromaDB和用户索引删除衣物向量"""
         if not self.model_available:
             return True  # 模型不可用时静默返回成功
             
         try:
+            if user_id is None:
+                # 索引未加载该衣物时，从ChromaDB元数据查出所属用户
+                existing = self.wardrobe_collection.get(ids=[str(item_id)], include=["metadatas"])
+                if existing["ids"] and existing["metadatas"][0]:
+                    user_id = int(existing["metadatas"][0].get("user_id", 0))
+            
             self.wardrobe_collection.delete(ids=[str(item_id)])
+            
+            if user_id is not None:
+                try:
+                    self.vector_index.remove(item_id, user_id)
+                except Exception as e:
+                    self.vector_index.invalidate(user_id)
             return True
         except Exception as e:
             return False
     
+    def _load_user_vectors(self, user_id: int) -> Tuple[List[int], List[List[float]], List[Dict[str, Any]]]:
+        """从ChromaDB读取某个用户的全部向量（用户索引缺失或损坏时重建用）"""
+        results = self.wardrobe_collection.get(
+            where={"user_id": str(user_id)},
+            include=["embeddings", "metadatas"]
+        )
+        return (
+            [int(id_str) for id_str in results["ids"]],
+            results["embeddings"] if len(results["ids"]) else [],
+            results["metadatas"] or []
+        )
+    
     def search_similar_items(
         self,
         query_text: str = None,
@@ -284,11 +432,16 @@ class EmbeddingService:
         category_filter: Optional[str] = None,
         color_filter: Optional[str] = None,
         material_filter: Optional[str] = None,
-        min_score: float = 0.0
+        min_score: float = 0.0,
+        text_weight: Optional[float] = None,
+        image_weight: Optional[float] = None
     ) -> List[int]:
         """
         混合检索策略：向量相似度 + 精确过滤 + 重排序
         
+        指定 user_id 时在用户索引上做后融合检索（文本 / 图像余弦相似度加权，纯文本查询不读图像矩阵）；
+        否则在 ChromaDB 中按拼接向量的 L2 距离检索。
+        
         Args:
             query_text: 文本查询（可选）
             query_image_path: 图像查询路径（可选）
@@ -299,70 +452,57 @@ class EmbeddingService:
             color_filter: 颜色过滤（模糊匹配）
             material_filter: 材质过滤（模糊匹配）
             min_score: 最低相似度阈值（0-1）
+            text_weight / image_weight: 后融合权重（默认取 FUSION_TEXT_WEIGHT / FUSION_IMAGE_WEIGHT）
         """
         if not self.model_available:
             return []  # 模型不可用时返回空列表，触发降级查询
         
         try:
-            # 生成查询向量
-            query_embedding = []
-            
-            # 文本向量
-            if query_text:
-                text_vec = self.text_encoder.encode(query_text, convert_to_numpy=True).tolist()
-            else:
-                text_vec = [0.0] * self.text_dim
-            
-            # 图像向量
-            if query_image_path and os.path.exists(query_image_path):
-                image_vec = self.generate_image_embedding(query_image_path)
-                if not image_vec:
-                    image_vec = [0.0] * self.image_dim
+            if user_id:
+                # 用户索引后融合检索：该用户全部衣物都是候选，按得分降序
+                queries = self.encode_query_parts(query_text, query_image_path)
+                if not queries:
+                    return []
+                weights = dict(self.fusion_weights)
+                if text_weight is not None:
+                    weights["text"] = text_weight
+                if image_weight is not None:
+                    weights["image"] = image_weight
+                item_ids, scores, metadatas = self.vector_index.search(user_id, queries, weights)
+                order = np.argsort(-scores, kind="stable")
+                if category_filter:
+                    order = [i for i in order if metadatas[i].get("category") == category_filter]
+                item_ids = [item_ids[i] for i in order]
+                metadatas = [metadatas[i] for i in order]
+                similarities = [float(scores[i]) for i in order]
             else:
-                # 纯文本查询：图像维度填充中间值，降低对相似度的影响
-                # 假设图像向量的平均值约为0（经过L2归一化），使用零向量最小化距离差异
-                image_vec = [0.0] * self.image_dim
-            
-            # 融合查询向量
-            query_embedding = text_vec + image_vec
-            
-            # 构建过滤条件（ChromaDB要求多条件使用$and操作符）
-            if category_filter and user_id:
-                where_filter = {
-                    "$and": [
-                        {"user_id": str(user_id)},
-                        {"category": category_filter}
-                    ]
-                }
-            elif user_id:
-                where_filter = {"user_id": str(user_id)}
-            else:
-                where_filter = None
-            
-            # 向量检索（多取2倍，用于后续过滤和重排序）
-            results = self.wardrobe_collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k * 3,  # 增加候选集
-                where=where_filter,
-                include=["metadatas", "distances"]  # 返回元数据和距离
-            )
-            
-            if not results["ids"] or not results["ids"][0]:
-                return []
-            
-            # 提取结果
-            item_ids = [int(id_str) for id_str in results["ids"][0]]
-            metadatas = results["metadatas"][0]
-            distances = results["distances"][0] if "distances" in results else [0] * len(item_ids)
+                # 融合查询向量（纯文本查询时图像一半为零）
+                query_embedding = self.encode_query(query_text, query_image_path)
+                
+                # 向量检索（多取2倍，用于后续过滤和重排序）
+                results = self.wardrobe_collection.query(
+                    query_embeddings=[query_embedding.tolist()],
+                    n_results=top_k * 3,  # 增加候选集
+                    where={"category": category_filter} if category_filter else None,
+                    include=["metadatas", "distances"]  # 返回元数据和距离
+                )
+                
+                if not results["ids"] or not results["ids"][0]:
+                    return []
+                
+                # 提取结果
+                item_ids = [int(id_str) for id_str in results["ids"][0]]
+                metadatas = results["metadatas"][0]
+                distances = results["distances"][0] if "distances" in results else [0] * len(item_ids)
+                similarities = [1.0 - min(distance / 2.0, 1.0) for distance in distances]
             
             # 混合过滤 + 重排序
             scored_items = []
             for i, item_id in enumerate(item_ids):
                 metadata = metadatas[i]
-                distance = distances[i]
                 
-                # 计算相似度得分
-                similarity_score = 1.0 - min(distance / 2.0, 1.0)
+                # 相似度得分
+                similarity_score = similarities[i]
                 
                 # 季节过滤
                 if season_filter:
@@ -402,40 +542,292 @@ class EmbeddingService:
         except Exception as e:
             return []
     
-    def batch_add_items(self, items: List[Dict[str, Any]]) -> Dict[str, int]:
+    def encode_query(self, query_text: Optional[str], query_image_path: Optional[str] = None) -> np.ndarray:
+        """查询向量（float32），与入库的融合向量同维度；纯文本查询时图像维度为零，文本部分走 LRU 缓存"""
+        return self._fuse(query_text, query_image_path, cache_text=True)
+    
+    def encode_query_parts(self, query_text: Optional[str], query_image_path: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """分模态查询向量 {"text": ..., "image": ...}，只包含实际给出的模态（后融合检索用）"""
+        queries = {}
+        if query_text:
+            queries["text"] = self._cached_text_embedding(query_text)
+        if query_image_path and os.path.exists(query_image_path):
+            image_vec = self.generate_image_embedding(query_image_path)
+            if image_vec is not None:
+                queries["image"] = image_vec
+        return queries
+    
+    def _cached_text_embedding(self, text: str) -> np.ndarray:
+        """查询文本向量（只读），命中缓存时只是一次字典查找"""
+        with self._query_cache_lock:
+            cached = self._query_cache.get(text)
+            if cached is not None:
+                self._query_cache.move_to_end(text)
+                self.query_cache_hits += 1
+                return cached
+            self.query_cache_misses += 1
+        
+        embedding = self._encode_text(text)
+        self._store_query_embeddings([text], embedding[None, :])
+        return embedding
+    
+    def _store_query_embeddings(self, texts: List[str], embeddings: np.ndarray):
+        with self._query_cache_lock:
+            for text, embedding in zip(texts, embeddings):
+                embedding = np.array(embedding, dtype=np.float32)
+                embedding.flags.writeable = False
+                self._query_cache[text] = embedding
+                self._query_cache.move_to_end(text)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+    
+    def precompute_query_embeddings(self, texts: List[str], batch_size: int = 128) -> int:
+        """
+        批量预计算查询文本向量写入缓存（启动时对规范查询集合调用），返回新写入的数量
+        
+        超出缓存容量的部分不再计算，避免预热时把自身刚写入的条目挤出。
         """
-        批量添加衣物向量（用于数据迁移）
+        if not self.model_available:
+            return 0
+        with self._query_cache_lock:
+            missing = [text for text in dict.fromkeys(texts) if text not in self._query_cache]
+            room = max(0, self.query_cache_size - len(self._query_cache))
+        if len(missing) > room:
+            print(f"查询缓存容量不足：待预计算 {len(missing)} 条，仅计算前 {room} 条（可调大 QUERY_CACHE_SIZE）")
+            missing = missing[:room]
+        
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            embeddings = self.text_encoder.encode(batch, batch_size=batch_size, convert_to_numpy=True)
+            self._store_query_embeddings(batch, embeddings)
+        return len(missing)
+    
+    def query_cache_stats(self) -> Dict[str, Any]:
+        with self._query_cache_lock:
+            lookups = self.query_cache_hits + self.query_cache_misses
+            return {
+                "entries": len(self._query_cache),
+                "max_entries": self.query_cache_size,
+                "hits": self.query_cache_hits,
+                "misses": self.query_cache_misses,
+                "hit_rate": self.query_cache_hits / lookups if lookups else 0.0
+            }
+    
+    def search_balanced(
+        self,
+        query_text: str,
+        user_id: int,
+        categories: List[str],
+        per_category: int = 3
+    ) -> Dict[str, List[Tuple[int, float]]]:
+        """
+        分类平衡检索：查询只编码一次，只对用户的文本矩阵做一次精确检索，在 NumPy 中按类别分组排序
+        
+        代替对每个类别分别调用 search_similar_items（每次都重新编码并单独检索）。
+        
+        Returns:
+            {类别: [(item_id, 相似度), ...]}，每类最多 per_category 个，按相似度降序；
+            没有候选的类别不出现在结果中
+        """
+        if not self.model_available:
+            return {}
+        
+        try:
+            queries = self.encode_query_parts(query_text)
+            if not queries:
+                return {}
+            item_ids, similarity, metadatas = self.vector_index.search(user_id, queries, self.fusion_weights)
+            if not item_ids:
+                return {}
+            
+            item_categories = np.array([metadata.get("category", "unknown") for metadata in metadatas])
+            
+            balanced = {}
+            for category in categories:
+                candidates = np.flatnonzero(item_categories == category)
+                if candidates.size == 0:
+                    continue
+                k = min(per_category, candidates.size)
+                top = candidates[np.argpartition(-similarity[candidates], k - 1)[:k]]
+                top = top[np.argsort(-similarity[top], kind="stable")]
+                balanced[category] = [(int(item_ids[i]), float(similarity[i])) for i in top]
+            return balanced
+            
+        except Exception as e:
+            return {}
+    
+    def stored_image_embeddings(self, user_id: int, item_ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        已入库衣物的 CLIP 图像向量，直接从用户索引读取，不重新跑 CLIP
+        
+        尚未向量化（仍在队列中）或没有图片的衣物不在返回结果中
+        """
+        if not self.model_available or not item_ids:
+            return {}
+        try:
+            return self.vector_index.vectors(user_id, "image", item_ids)
+        except Exception as e:
+            return {}
+    
+    def search_visually_similar(
+        self,
+        user_id: int,
+        image_embeddings: np.ndarray,
+        top_k: int = 10,
+        exclude_ids: Optional[List[Optional[int]]] = None,
+        min_score: float = 0.0
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        以图搜图（批量）：每个图像向量在该用户衣橱的图像索引上检索，返回 [(item_id, 余弦相似度)] 降序列表
+        
+        多个查询合并成一次矩阵乘，可用于整个衣橱的重复衣物检测；exclude_ids[i] 为第 i 个查询要排除的衣物
+        """
+        if not self.model_available or len(image_embeddings) == 0:
+            return [[] for _ in range(len(image_embeddings))]
+        try:
+            return self.vector_index.nearest(user_id, "image", image_embeddings, top_k, exclude_ids, min_score)
+        except Exception as e:
+            return [[] for _ in range(len(image_embeddings))]
+    
+    def encode_items(
+        self,
+        items: List[Dict[str, Any]],
+        batch_size: int = 64,
+        num_workers: Optional[int] = None
+    ) -> Iterator[Tuple[List[Dict[str, Any]], Optional[np.ndarray]]]:
+        """
+        批量生成融合向量（不写入 ChromaDB），按 batch_size 分块逐块产出
+        
+        文本一次批量编码，图片由 DataLoader 多进程并行解码、CLIP 批量前向。
+        
+        Yields:
+            (该块衣物, 融合向量矩阵 float32 [块大小, total_dim])；该块编码失败时矩阵为 None
+        """
+        if num_workers is None:
+            num_workers = min(4, os.cpu_count() or 1)
+        loader = DataLoader(
+            _ClipImageDataset([item.get("image_path") for item in items], self.clip_processor),
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers
+        )
+        
+        done = 0
+        for pixel_values, has_image in loader:
+            chunk = items[done:done + len(has_image)]
+            done += len(chunk)
+            try:
+                # 预分配整块融合向量，文本 / 图像两半原地写入
+                fused = np.zeros((len(chunk), self.total_dim), dtype=np.float32)
+                
+                # 文本向量批量编码
+                fused[:, :self.text_dim] = self.text_encoder.encode(
+                    [self._semantic_text(item) for item in chunk],
+                    batch_size=batch_size,
+                    convert_to_numpy=True
+                )
+                
+                # 图像向量：只对成功解码的图片做 CLIP 前向，其余保持为零
+                if bool(has_image.any()):
+                    with torch.no_grad():
+                        outputs = self.clip_model.get_image_features(pixel_values=pixel_values[has_image])
+                    fused[has_image.numpy(), self.text_dim:] = self._normalize_image_features(outputs).cpu().numpy()
+                
+                yield chunk, fused
+            except Exception as e:
+                print(f"批量向量化失败（{done - len(chunk) + 1}-{done}/{len(items)}）: {e}")
+                yield chunk, None
+    
+    @classmethod
+    def upsert_embeddings(cls, collection: Any, items: List[Dict[str, Any]], embeddings: np.ndarray) -> List[Dict[str, str]]:
+        """一次 upsert 写入一块衣物向量（重复导入时覆盖旧向量），返回写入的元数据"""
+        metadatas = [cls._build_metadata(item) for item in items]
+        collection.upsert(
+            ids=[str(item["id"]) for item in items],
+            embeddings=embeddings.tolist(),
+            metadatas=metadatas,
+            documents=[item.get("name_en", item.get("name", "Unknown")) for item in items]
+        )
+        return metadatas
+    
+    def batch_add_items(
+        self,
+        items: List[Dict[str, Any]],
+        batch_size: int = 64,
+        num_workers: Optional[int] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        批量添加衣物向量（用于数据迁移 / 后台向量化队列）
+        
+        按 batch_size 分块批量编码（见 encode_items），每块只做一次 ChromaDB upsert。
         
         Args:
-            items: 衣物列表，每个必须包含 'id' 字段
+            items: 衣物列表，每个必须包含 'id' 字段；包含 'image_path' 时同时生成图像向量
+            batch_size: 每块衣物数量
+            num_workers: 图片解码进程数（默认 min(4, CPU核数)）
+            progress_callback: 每完成一块调用一次 progress_callback(已处理数量, 总数)
         
         Returns:
-            {"success": 成功数量, "failed": 失败数量}
+            {"success": 成功数量, "failed": 失败数量, "failed_ids": 失败衣物的 id 列表}
         """
-        success_count = 0
-        failed_count = 0
+        valid_items = [item for item in items if item.get("id")]
+        failed_count = len(items) - len(valid_items)
+        failed_ids = []
+        if not self.model_available:
+            # 模型不可用时静默返回成功
+            return {"success": len(valid_items), "failed": failed_count, "failed_ids": failed_ids}
         
-        for item in items:
-            item_id = item.get("id")
-            if not item_id:
-                failed_count += 1
-                continue
+        success_count = 0
+        total = len(valid_items)
+        done = 0
+        for chunk, embeddings in self.encode_items(valid_items, batch_size, num_workers):
+            done += len(chunk)
+            try:
+                if embeddings is None:
+                    raise ValueError("向量编码失败")
+                metadatas = self.upsert_embeddings(self.wardrobe_collection, chunk, embeddings)
+                success_count += len(chunk)
+                self._add_to_user_indexes(chunk, embeddings, metadatas)
+            except Exception as e:
+                print(f"批量写入失败（{done - len(chunk) + 1}-{done}/{total}）: {e}")
+                failed_count += len(chunk)
+                failed_ids.extend(item["id"] for item in chunk)
             
-            if self.add_item(item_id, item):
-                success_count += 1
+            if progress_callback:
+                progress_callback(done, total)
             else:
-                failed_count += 1
+                print(f"批量向量化进度: {done}/{total}")
         
-        return {"success": success_count, "failed": failed_count}
+        return {"success": success_count, "failed": failed_count, "failed_ids": failed_ids}
+    
+    def _add_to_user_indexes(self, items: List[Dict[str, Any]], embeddings: np.ndarray, metadatas: List[Dict[str, str]]):
+        """按用户分组增量更新用户索引（失败时丢弃该用户索引，下次检索从ChromaDB重建）"""
+        rows_by_user: Dict[int, List[int]] = {}
+        for row, item in enumerate(items):
+            rows_by_user.setdefault(int(item.get("user_id", 0)), []).append(row)
+        for user_id, rows in rows_by_user.items():
+            try:
+                self.vector_index.add(
+                    user_id,
+                    [int(items[row]["id"]) for row in rows],
+                    embeddings[rows],
+                    [metadatas[row] for row in rows]
+                )
+            except Exception as e:
+                self.vector_index.invalidate(user_id)
 
 
 # 全局单例
 _embedding_service: Optional[EmbeddingService] = None
+_embedding_service_lock = threading.Lock()
 
 
 def get_embedding_service() -> EmbeddingService:
-    """获取向量化服务单例"""
+    """获取向量化服务单例（启动预加载线程与请求线程可能同时调用，加载期间其他调用方在锁上等待）"""
     global _embedding_service
     if _embedding_service is None:
-        _embedding_service = EmbeddingService()
+        with _embedding_service_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
     return _embedding_service
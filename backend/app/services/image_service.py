@@ -1,5 +1,71 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+import os
 import traceback
+from app.services.attribute_cache import get_attribute_cache, hash_image_file
+
+# 批量上传时每次送入模型的图片数量（与 Qwen 微批调度器的批大小保持一致）
+ANALYZE_CHUNK_SIZE = int(os.getenv('QWEN_BATCH_SIZE', '4'))
+
+
+def _normalize_attributes(result: Dict[str, Any]) -> Dict[str, Any]:
+  if isinstance(result.get("season"), list):
+    result["season"] = ",".join(result["season"])
+
+  # 统一材质标注：棉 -> 棉质
+  if result.get("material") == "棉":
+    result["material"] = "棉质"
+  return result
+
+
+def _default_attributes() -> Dict[str, Any]:
+  return {
+    "category": "top",
+    "color": "blue",
+    "season": "spring,summer",
+    "material": "cotton"
+  }
+
+
+def _cache_key(image_path: str) -> Optional[str]:
+  """图片内容哈希 + prompt 版本；读取失败时返回 None（不使用缓存）"""
+  try:
+    from ml.inference import ANALYSIS_PROMPT_VERSION
+    return get_attribute_cache().make_key(hash_image_file(image_path), ANALYSIS_PROMPT_VERSION)
+  except Exception as e:
+    print(f"属性缓存不可用: {e}")
+    return None
+
+
+def _cache_lookup(cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+  if cache_key is None:
+    return None
+  try:
+    return get_attribute_cache().get(cache_key)
+  except Exception as e:
+    print(f"属性缓存读取失败: {e}")
+    return None
+
+
+def _cache_store(cache_key: Optional[str], result: Dict[str, Any]):
+  # 解析失败的兜底结果不缓存，下次上传仍会重新分析
+  if cache_key is None or result.get("category") == "unknown":
+    return
+  try:
+    get_attribute_cache().put(cache_key, result)
+  except Exception as e:
+    print(f"属性缓存写入失败: {e}")
+
+
+def _print_failure(e: Exception):
+  error_type = type(e).__name__
+  print(f"\n{'='*60}")
+  print(f"ML 推理失败")
+  print(f"{'='*60}")
+  print(f"错误类型: {error_type}")
+  print(f"错误信息: {str(e)}")
+  print(f"\n详细堆栈:")
+  print(traceback.format_exc())
+  print(f"{'='*60}\n")
 
 
 def analyze_clothing_image(image_path: str) -> Dict[str, Any]:
@@ -7,36 +73,55 @@ def analyze_clothing_image(image_path: str) -> Dict[str, Any]:
     print(f"\n{'='*60}")
     print(f"开始分析衣服图片: {image_path}")
     print(f"{'='*60}")
-    
+
+    cache_key = _cache_key(image_path)
+    cached = _cache_lookup(cache_key)
+    if cached is not None:
+      print(f"命中属性缓存: {cached}")
+      return cached
+
     from ml.inference import predict
-    result = predict(image_path)
-    
-    if isinstance(result.get("season"), list):
-      result["season"] = ",".join(result["season"])
-    
-    # 统一材质标注：棉 -> 棉质
-    if result.get("material") == "棉":
-      result["material"] = "棉质"
-    
+    result = _normalize_attributes(predict(image_path))
+    _cache_store(cache_key, result)
+
     print(f"\n分析成功: {result}")
     print(f"{'='*60}\n")
     return result
-    
+
   except Exception as e:
-    error_type = type(e).__name__
+    _print_failure(e)
+    print("返回默认值，所有衣服将显示相同标签")
+    return _default_attributes()
+
+
+def analyze_clothing_images(image_paths: List[str]) -> List[Dict[str, Any]]:
+  """批量分析衣服图片（一次 generate 处理整批），返回顺序与输入一致"""
+  if not image_paths:
+    return []
+
+  try:
     print(f"\n{'='*60}")
-    print(f"ML 推理失败")
+    print(f"开始批量分析 {len(image_paths)} 张衣服图片")
     print(f"{'='*60}")
-    print(f"错误类型: {error_type}")
-    print(f"错误信息: {str(e)}")
-    print(f"\n详细堆栈:")
-    print(traceback.format_exc())
+
+    cache_keys = [_cache_key(image_path) for image_path in image_paths]
+    results = [_cache_lookup(cache_key) for cache_key in cache_keys]
+
+    # 只把未命中缓存的图片送入模型
+    miss_indices = [i for i, result in enumerate(results) if result is None]
+    if miss_indices:
+      from ml.inference import predict_batch
+      predicted = predict_batch([image_paths[i] for i in miss_indices])
+      for i, result in zip(miss_indices, predicted):
+        results[i] = _normalize_attributes(result)
+        _cache_store(cache_keys[i], results[i])
+
+    print(f"\n批量分析成功: {len(results)} 张（缓存命中 {len(image_paths) - len(miss_indices)} 张）")
     print(f"{'='*60}\n")
-    
-    print("返回默认值，所有衣服将显示相同标签")
-    return {
-      "category": "top",
-      "color": "blue",
-      "season": "spring,summer",
-      "material": "cotton"
-    }
+    return results
+
+  except Exception as e:
+    _print_failure(e)
+    # 整批失败时逐张重试，避免一张坏图拖垮整个批次
+    print("批量分析失败，退回逐张分析")
+    return [analyze_clothing_image(image_path) for image_path in image_paths]
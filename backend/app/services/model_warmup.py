@@ -0,0 +1,140 @@
+"""
+启动时模型预加载与预热 - 部署后第一个请求不再承担 1-2 分钟的模型加载和首次推理开销
+
+后台线程依次加载 Embedding 模型（文本 + CLIP）与 Qwen3-VL，并各跑一次合成输入的推理
+（分配显存、选择 CUDA kernel、编译 JSON 约束）。/health 在全部完成前返回 503；
+依赖模型的路由按各自需要的模型分别放行（如 mode=fast 推荐只等 Embedding 模型），
+所需模型尚未加载完成时直接返回 503 + Retry-After，由负载均衡或前端稍后重试。
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def _load_embedding() -> Tuple[Any, bool]:
+    from app.services.embedding_service import get_embedding_service
+    service = get_embedding_service()
+    return service, service.model_available
+
+
+def _warmup_embedding(service: Any) -> float:
+    return service.warmup()
+
+
+def _load_qwen() -> Tuple[Any, bool]:
+    from ml.inference import get_model
+    return get_model(), True
+
+
+def _warmup_qwen(model: Any) -> float:
+    return model.warmup()
+
+
+# 模型名 → (加载函数：返回 (实例, 是否可用), 预热函数：返回耗时秒数)
+MODEL_LOADERS: Dict[str, Tuple[Callable[[], Tuple[Any, bool]], Callable[[Any], float]]] = {
+    "embedding": (_load_embedding, _warmup_embedding),
+    "qwen": (_load_qwen, _warmup_qwen)
+}
+
+
+class ModelWarmup:
+    """后台预加载状态（线程安全）；未启动预加载时视为就绪，保持按需加载的旧行为"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._done = threading.Event()
+        self._done.set()
+        self.components: Dict[str, Dict[str, Any]] = {}
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def start(self, models: List[str], warmup: bool = True, after: Optional[Callable[[], Any]] = None):
+        """启动后台加载线程；after 在全部模型就绪后于同一线程中执行（如预计算查询向量缓存）"""
+        unknown = [name for name in models if name not in MODEL_LOADERS]
+        if unknown:
+            print(f"[ModelWarmup] 忽略未知模型: {unknown}，可选 {list(MODEL_LOADERS)}")
+            models = [name for name in models if name in MODEL_LOADERS]
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.components = {
+                name: {"status": "pending", "load_seconds": None, "warmup_seconds": None, "error": None}
+                for name in models
+            }
+            self.started_at = time.time()
+            self._done.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(models, warmup, after), daemon=True, name="model-warmup"
+            )
+            self._thread.start()
+
+    def _set(self, name: str, **fields):
+        with self._lock:
+            self.components[name].update(fields)
+
+    def _run(self, models: List[str], warmup: bool, after: Optional[Callable[[], Any]]):
+        for name in models:
+            load, warm = MODEL_LOADERS[name]
+            self._set(name, status="loading")
+            started = time.time()
+            try:
+                instance, available = load()
+                self._set(name, load_seconds=round(time.time() - started, 1))
+                if not available:
+                    self._set(name, status="unavailable")  # 服务自身已降级运行
+                    continue
+                if warmup:
+                    self._set(name, status="warming")
+                    self._set(name, warmup_seconds=round(warm(instance), 2))
+                self._set(name, status="ready")
+                print(f"[ModelWarmup] {name} 就绪：加载 {self.components[name]['load_seconds']} 秒，"
+                      f"预热 {self.components[name]['warmup_seconds']} 秒")
+            except Exception as e:
+                print(f"[ModelWarmup] {name} 加载失败: {e}")
+                self._set(name, status="failed", error=str(e))
+
+        with self._lock:
+            self.finished_at = time.time()
+        self._done.set()
+
+        if after is not None:
+            try:
+                after()
+            except Exception as e:
+                print(f"[ModelWarmup] 就绪后任务失败: {e}")
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    def model_ready(self, name: str) -> bool:
+        """该模型是否已加载结束（不可用 / 失败也算结束，服务自身走降级路径）；不在预加载列表中的模型视为就绪"""
+        with self._lock:
+            component = self.components.get(name)
+            return component is None or component["status"] not in ("pending", "loading", "warming")
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            if not self.ready:
+                status = "starting"
+            elif any(component["status"] != "ready" for component in self.components.values()):
+                status = "degraded"  # 加载完成但有模型不可用，相关功能走降级路径
+            else:
+                status = "ready"
+            end = self.finished_at or time.time()
+            return {
+                "status": status,
+                "ready": self.ready,
+                "elapsed_seconds": round(end - self.started_at, 1) if self.started_at else None,
+                "models": {name: dict(component) for name, component in self.components.items()}
+            }
+
+
+# 全局单例
+_model_warmup = ModelWarmup()
+
+
+def get_model_warmup() -> ModelWarmup:
+    """获取模型预加载状态实例"""
+    return _model_warmup
@@ -0,0 +1,255 @@
+"""
+衣物图片感知哈希索引 - 上传时在调用 VLM 之前发现同一件衣物的重复照片
+
+属性缓存（attribute_cache）只能命中字节完全相同的图片；同一件衣物重新拍照、截图或压缩后
+内容哈希不同，但 64 位 dHash 的汉明距离很小。哈希持久化在 wardrobe_items.phash 列，
+每个用户在内存中是一张紧凑的 uint64 数组，检索为一次 XOR + 查表 popcount，几千件衣物也在毫秒以内。
+
+dHash 只看灰度明暗，同款不同色的衣物哈希几乎相同；命中后还要用颜色签名（4x4 网格的 RGB 均值）确认，
+颜色差异超过阈值的不算重复。
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8  # 8 x 8 = 64 位
+COLOR_GRID = 4  # 颜色签名：4 x 4 网格 x RGB = 48 维
+
+# 每个字节的置位数，用于向量化 popcount
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+# 从数据库读取某个用户的全部哈希：返回 [(item_id, 有符号 64 位哈希)]
+HashLoader = Callable[[int], List[Tuple[int, int]]]
+
+
+def dhash(image: Any) -> int:
+    """
+    64 位差值哈希（dHash）：灰度缩放到 9x8，比较每行相邻像素的明暗
+
+    image 为图片路径、文件对象或 PIL.Image；返回无符号整数
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    pixels = np.asarray(
+        image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS),
+        dtype=np.int16
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def color_signature(image: Any) -> np.ndarray:
+    """颜色签名：整图缩放到 4x4 后的 RGB 均值（0~1），用于区分 dHash 相同的同款不同色衣物"""
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    small = image.convert("RGB").resize((COLOR_GRID, COLOR_GRID), Image.BOX)
+    return np.asarray(small, dtype=np.float32).reshape(-1) / 255.0
+
+
+def color_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """两个颜色签名的平均绝对差（0~1）"""
+    return float(np.abs(a - b).mean())
+
+
+def file_digest(path: str) -> str:
+    """文件内容哈希，判断两张图片是否逐字节相同"""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def to_signed(value: int) -> int:
+    """无符号 64 位哈希 → SQLite INTEGER（有符号 64 位）"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """uint64 数组中每个哈希与 value 的汉明距离"""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class UserHashes:
+    """单个用户的哈希表：item_id 与哈希两列紧凑数组（不可变，更新时整体替换）"""
+
+    def __init__(self, item_ids: np.ndarray, hashes: np.ndarray):
+        self.item_ids = item_ids  # int64
+        self.hashes = hashes  # uint64
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[int, int]]) -> "UserHashes":
+        return cls(
+            np.array([item_id for item_id, _ in rows], dtype=np.int64),
+            np.array([to_unsigned(value) for _, value in rows], dtype=np.uint64)
+        )
+
+    def with_item(self, item_id: int, value: int) -> "UserHashes":
+        keep = self.item_ids != item_id
+        return UserHashes(
+            np.append(self.item_ids[keep], np.int64(item_id)),
+            np.append(self.hashes[keep], np.uint64(value))
+        )
+
+    def without_item(self, item_id: int) -> "UserHashes":
+        keep = self.item_ids != item_id
+        return UserHashes(self.item_ids[keep], self.hashes[keep])
+
+
+class PerceptualHashIndex:
+    """按用户懒加载的感知哈希索引（线程安全，已加载的用户数有上限）"""
+
+    def __init__(
+        self,
+        loader: HashLoader,
+        max_distance: int = 6,
+        max_users: int = 1024,
+        max_color_distance: float = 0.08
+    ):
+        self.loader = loader
+        self.max_distance = max_distance
+        self.max_color_distance = max_color_distance
+        self.max_users = max(1, max_users)
+
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[int, UserHashes]" = OrderedDict()
+        # 正在从数据库加载的用户：[加载中的线程数, 加载期间到达的 add / remove]，加载完成后补上
+        self._loading: Dict[int, List[Any]] = {}
+
+        self.checks = 0
+        self.duplicates = 0
+
+    def _get(self, user_id: int) -> UserHashes:
+        with self._lock:
+            hashes = self._users.get(user_id)
+            if hashes is not None:
+                self._users.move_to_end(user_id)
+                return hashes
+            loading = self._loading.setdefault(user_id, [0, []])
+            loading[0] += 1
+
+        # 数据库读取（可能顺带补算旧衣物的哈希）在锁外进行
+        try:
+            hashes = UserHashes.from_rows(self.loader(user_id))
+        except Exception:
+            with self._lock:
+                self._finish_loading(user_id, loading)
+            raise
+        with self._lock:
+            self._finish_loading(user_id, loading)
+            current = self._users.get(user_id)
+            if current is not None:
+                # 其他线程已先加载完成（并已补上加载期间的变更），以它为准
+                self._users.move_to_end(user_id)
+                return current
+            for op, item_id, value in loading[1]:
+                hashes = hashes.with_item(item_id, value) if op == "add" else hashes.without_item(item_id)
+            self._users[user_id] = hashes
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return hashes
+
+    def _finish_loading(self, user_id: int, loading: List[Any]):
+        loading[0] -= 1
+        if loading[0] == 0 and self._loading.get(user_id) is loading:
+            del self._loading[user_id]
+
+    def _record(self, user_id: int, op: str, item_id: int, value: int = 0):
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1].append((op, item_id, value))
+
+    def find(self, user_id: int, value: int, max_distance: Optional[int] = None) -> List[Tuple[int, int]]:
+        """该用户衣橱中与 value 汉明距离不超过阈值的衣物，返回 [(item_id, 距离)]，按距离升序"""
+        if max_distance is None:
+            max_distance = self.max_distance
+        hashes = self._get(user_id)
+        matches = []
+        if len(hashes.hashes):
+            distances = hamming_distances(hashes.hashes, value)
+            rows = np.flatnonzero(distances <= max_distance)
+            rows = rows[np.argsort(distances[rows], kind="stable")]
+            matches = [(int(hashes.item_ids[row]), int(distances[row])) for row in rows]
+        with self._lock:
+            self.checks += 1
+            if matches:
+                self.duplicates += 1
+        return matches
+
+    def same_colors(self, a: np.ndarray, b: np.ndarray) -> bool:
+        """哈希相近的两张图片颜色是否也一致（确认为同一件衣物）"""
+        return color_distance(a, b) <= self.max_color_distance
+
+    def add(self, user_id: int, item_id: int, value: int):
+        """新衣物入库后登记其哈希（该用户尚未加载时跳过，下次从数据库加载；正在加载时加载完成后补上）"""
+        with self._lock:
+            hashes = self._users.get(user_id)
+            if hashes is not None:
+                self._users[user_id] = hashes.with_item(item_id, value)
+            self._record(user_id, "add", item_id, value)
+
+    def remove(self, user_id: int, item_id: int):
+        with self._lock:
+            hashes = self._users.get(user_id)
+            if hashes is not None:
+                self._users[user_id] = hashes.without_item(item_id)
+            self._record(user_id, "remove", item_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded_users": len(self._users),
+                "loaded_items": sum(len(hashes.hashes) for hashes in self._users.values()),
+                "max_distance": self.max_distance,
+                "max_color_distance": self.max_color_distance,
+                "checks": self.checks,
+                "duplicates": self.duplicates
+            }
+
+
+def _load_user_hashes(user_id: int) -> List[Tuple[int, int]]:
+    """从 wardrobe_items 读取某个用户的哈希；旧衣物没有哈希时从图片补算并写回"""
+    from app.core.database import SessionLocal
+    from app.models.wardrobe import WardrobeItem
+
+    db = SessionLocal()
+    try:
+        rows = []
+        backfilled = 0
+        for item in db.query(WardrobeItem).filter(WardrobeItem.user_id == user_id):
+            if item.phash is None and item.image_path and os.path.exists(item.image_path):
+                try:
+                    item.phash = to_signed(dhash(item.image_path))
+                    backfilled += 1
+                except Exception as e:
+                    continue
+            if item.phash is not None:
+                rows.append((item.id, item.phash))
+        if backfilled:
+            db.commit()
+            print(f"[PerceptualHashIndex] 用户{user_id}补算 {backfilled} 件衣物的感知哈希")
+        return rows
+    finally:
+        db.close()
+
+
+# 全局单例
+_phash_index = PerceptualHashIndex(
+    loader=_load_user_hashes,
+    max_distance=int(os.getenv("DUPLICATE_MAX_DISTANCE", "6")),
+    max_color_distance=float(os.getenv("DUPLICATE_MAX_COLOR_DISTANCE", "0.08")),
+    max_users=int(os.getenv("DUPLICATE_INDEX_MAX_USERS", "1024"))
+)
+
+
+def get_phash_index() -> PerceptualHashIndex:
+    """获取感知哈希索引实例"""
+    return _phash_index
@@ -1,4 +1,14 @@
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, List, Any, Optional, Iterator
+
+
+def fast_outfit_recommendations(
+    wardrobe_items: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+  """不调用大模型的快速推荐：按槽位规则组合候选衣物并向量化打分，毫秒级返回"""
+  from recommendation.fast_engine import recommend_outfits
+  return recommend_outfits(wardrobe_items, weather, preferences)
 
 
 def generate_outfit_recommendations(
@@ -15,18 +25,21 @@ def generate_outfit_recommendations(
       weather=weather,
       preferences=preferences
     )
+    if not result.get("outfits"):
+      # 模型没有给出可用方案时退回快速推荐
+      fast_result = fast_outfit_recommendations(wardrobe_items, weather, preferences)
+      if fast_result["outfits"]:
+        return fast_result
     return result
   except ImportError:
-    return {
-      "outfits": [
-        {"items": [1, 2], "reason": "适合当前天气"},
-      ],
-      "missing_items": ["thick jacket"]
-    }
+    return fast_outfit_recommendations(wardrobe_items, weather, preferences)
   except Exception as e:
     print(f"Error in recommendation service: {e}")
     import traceback
     traceback.print_exc()
+    fast_result = fast_outfit_recommendations(wardrobe_items, weather, preferences)
+    if fast_result["outfits"]:
+      return fast_result
     return {
       "outfits": [
         {"items": wardrobe_items[:2] if len(wardrobe_items) >= 2 else wardrobe_items,
@@ -77,3 +90,135 @@ def adjust_outfit_with_conversation(
       ],
       "missing_items": []
     }
+
+
+def _degraded_result(wardrobe_items: List[Dict[str, Any]], description: str, missing_items: List[Dict[str, Any]]) -> Dict[str, Any]:
+  return {
+    "outfits": [
+      {"items": wardrobe_items[:2] if len(wardrobe_items) >= 2 else wardrobe_items,
+       "description": description},
+    ],
+    "missing_items": missing_items
+  }
+
+
+def _stream_fallback(result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+  """把非流式的降级结果按流式协议逐套产出"""
+  for index, outfit in enumerate(result.get("outfits", [])):
+    yield {"type": "outfit", "index": index, "outfit": outfit}
+  yield {"type": "complete", **result}
+
+
+def _stream_with_fallback(
+    events: Iterator[Dict[str, Any]],
+    fallback: Callable[[], Dict[str, Any]],
+    label: str,
+    fallback_on_empty: bool = False
+) -> Iterator[Dict[str, Any]]:
+  """
+  透传模型的流式事件；出错时：
+    还没有产出任何 outfit -> 改用 fallback() 的结果（与非流式接口一致）
+    已经产出过 outfit     -> 发送 error 事件结束，不再追加与前面矛盾的 complete
+  fallback_on_empty 为真时，模型最终没有给出任何方案也改用 fallback() 的结果
+  """
+  streamed = False
+  try:
+    for event in events:
+      if fallback_on_empty and event.get("type") == "complete" and not event.get("outfits") and not streamed:
+        # 模型没有给出可用方案时退回降级结果
+        yield from _stream_fallback(fallback())
+        return
+      if event.get("type") == "outfit":
+        streamed = True
+      yield event
+  except Exception as e:
+    print(f"Error in streaming {label} service: {e}")
+    import traceback
+    traceback.print_exc()
+    if streamed:
+      yield {"type": "error", "message": "推荐生成中断，请重试"}
+    else:
+      yield from _stream_fallback(fallback())
+  finally:
+    if hasattr(events, "close"):
+      events.close()  # 客户端断开时立即通知模型侧停止生成
+
+
+def stream_outfit_recommendations(
+    user_profile: Dict[str, Any],
+    wardrobe_items: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+  """流式生成穿搭推荐，产出 outfit / complete 事件（中途出错时为 error 事件）"""
+  try:
+    from recommendation.logic import stream_recommendations
+  except ImportError:
+    result = generate_outfit_recommendations(user_profile, wardrobe_items, weather, preferences)
+    yield {"type": "complete", **result}
+    return
+
+  def fallback() -> Dict[str, Any]:
+    fast_result = fast_outfit_recommendations(wardrobe_items, weather, preferences)
+    if fast_result["outfits"]:
+      return fast_result
+    return _degraded_result(
+      wardrobe_items, "系统降级推荐（模型错误）",
+      [{"category": "accessories", "reason": "丰富你的衣橱"}]
+    )
+
+  events = stream_recommendations(
+    user=user_profile,
+    wardrobe=wardrobe_items,
+    weather=weather,
+    preferences=preferences
+  )
+  yield from _stream_with_fallback(events, fallback, "recommendation", fallback_on_empty=True)
+
+
+def stream_adjust_outfit_with_conversation(
+    session_id: str,
+    adjustment_request: str,
+    user_profile: Dict[str, Any],
+    wardrobe_items: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]],
+    conversation_history: List[Dict[str, Any]],
+    current_outfit: List[int]
+) -> Iterator[Dict[str, Any]]:
+  """流式调整穿搭方案，产出 outfit / complete 事件（中途出错时为 error 事件）"""
+  try:
+    from recommendation.logic import stream_adjust_recommendations_with_conversation
+  except ImportError:
+    # 降级方案：返回重新生成的推荐
+    result = generate_outfit_recommendations(
+      user_profile, wardrobe_items, weather, preferences
+    )
+    yield {"type": "complete", **result}
+    return
+
+  def fallback() -> Dict[str, Any]:
+    return _degraded_result(wardrobe_items, "系统降级推荐（调整失败）", [])
+
+  events = stream_adjust_recommendations_with_conversation(
+    session_id=session_id,
+    adjustment_request=adjustment_request,
+    user=user_profile,
+    wardrobe=wardrobe_items,
+    weather=weather,
+    preferences=preferences,
+    conversation_history=conversation_history,
+    current_outfit=current_outfit
+  )
+  yield from _stream_with_fallback(events, fallback, "adjustment")
+
+
+def release_conversation_cache(session_id: str):
+  """释放会话在模型侧的 KV 缓存（会话删除或过期时调用）"""
+  try:
+    from recommendation.logic import release_session_cache
+    release_session_cache(session_id)
+  except ImportError:
+    pass
+  except Exception as e:
+    print(f"Error releasing conversation cache: {e}")
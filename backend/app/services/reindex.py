@@ -0,0 +1,331 @@
+"""
+全量重建衣橱向量库 - 从 fashion.db 读取衣物，批量生成向量并 upsert 到 ChromaDB
+
+用法（在 backend 目录下执行，与服务共用 chroma_data / vector_index）：
+    python -m app.services.reindex                          # 重建到新集合（有断点时续跑断点中的集合）
+    python -m app.services.reindex --restart                # 忽略断点，从头开始
+    python -m app.services.reindex --collection wardrobe_items_v2 --workers 4
+    python -m app.services.reindex --allow-live             # 服务已停止时，原地重建当前集合
+
+按 id 做 keyset 分页，每次只读一块 WardrobeItem；每块完成 upsert 后写入断点文件，
+中断后再次运行会从上次完成的 id 之后继续。服务无需停机：默认重建到新集合（服务正在写入的集合
+需显式 --allow-live），完成后把 WARDROBE_COLLECTION 指向新集合并重启服务即可。
+重建结束后只把该集合的索引代数加一，不删除用户索引文件：服务下次访问时自行从 ChromaDB 重建。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+def _item_to_dict(item: Any) -> Dict[str, Any]:
+    return {
+        "id": item.id,
+        "user_id": item.user_id,
+        "name": item.name,
+        "name_en": item.name_en or "",
+        "color_en": item.color_en or "",
+        "material_en": item.material_en or "",
+        "season": item.season,
+        "category": item.category,
+        "image_path": item.image_path
+    }
+
+
+def iter_item_chunks(chunk_size: int, after_id: int = 0, user_id: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+    """按 id 做 keyset 分页，逐块读取衣物（每块一个短会话，不长时间占用数据库）"""
+    from app.core.database import SessionLocal
+    from app.models.wardrobe import WardrobeItem
+
+    last_id = after_id
+    while True:
+        db = SessionLocal()
+        try:
+            query = db.query(WardrobeItem).filter(WardrobeItem.id > last_id)
+            if user_id is not None:
+                query = query.filter(WardrobeItem.user_id == user_id)
+            rows = query.order_by(WardrobeItem.id).limit(chunk_size).all()
+            chunk = [_item_to_dict(row) for row in rows]
+        finally:
+            db.close()
+        if not chunk:
+            return
+        last_id = chunk[-1]["id"]
+        yield chunk
+
+
+def all_item_ids() -> set:
+    from app.core.database import SessionLocal
+    from app.models.wardrobe import WardrobeItem
+
+    db = SessionLocal()
+    try:
+        return {str(item_id) for (item_id,) in db.query(WardrobeItem.id)}
+    finally:
+        db.close()
+
+
+def count_items(after_id: int = 0, user_id: Optional[int] = None) -> int:
+    from app.core.database import SessionLocal
+    from app.models.wardrobe import WardrobeItem
+
+    db = SessionLocal()
+    try:
+        query = db.query(WardrobeItem).filter(WardrobeItem.id > after_id)
+        if user_id is not None:
+            query = query.filter(WardrobeItem.user_id == user_id)
+        return query.count()
+    finally:
+        db.close()
+
+
+class Checkpoint:
+    """断点文件：记录已完成的最大 id 与累计计数（原子替换写入）"""
+
+    def __init__(self, path: str, collection: str, user_id: Optional[int]):
+        self.path = path
+        self.collection = collection
+        self.user_id = user_id
+        self.last_id = 0
+        self.success = 0
+        self.failed = 0
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("collection") != self.collection or data.get("user_id") != self.user_id:
+            print(f"断点文件属于集合 {data.get('collection')} / 用户 {data.get('user_id')}，忽略")
+            return False
+        self.last_id = data.get("last_id", 0)
+        self.success = data.get("success", 0)
+        self.failed = data.get("failed", 0)
+        return True
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "collection": self.collection,
+                "user_id": self.user_id,
+                "last_id": self.last_id,
+                "success": self.success,
+                "failed": self.failed,
+                "updated_at": time.time()
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# ---------- 工作进程 ----------
+
+_worker_service = None
+_worker_loader_workers = 0
+
+
+def _init_worker(torch_threads: int, loader_workers: int):
+    """工作进程初始化：各自加载一份编码模型"""
+    global _worker_service, _worker_loader_workers
+    import torch
+    from app.services.embedding_service import EmbeddingService
+
+    torch.set_num_threads(torch_threads)
+    _worker_service = EmbeddingService()
+    _worker_loader_workers = loader_workers
+
+
+def _encode_chunk(args: Tuple[List[Dict[str, Any]], int]) -> Tuple[List[Dict[str, Any]], List[Tuple[List[Dict[str, Any]], np.ndarray]], int]:
+    """编码一块衣物，返回 (整块衣物, [(子块, 向量)], 失败数量)；写入由主进程统一完成"""
+    chunk, encode_batch = args
+    if not _worker_service.model_available:
+        raise RuntimeError("Embedding模型不可用")
+    encoded = []
+    failed = 0
+    for sub_chunk, embeddings in _worker_service.encode_items(chunk, encode_batch, _worker_loader_workers):
+        if embeddings is None:
+            failed += len(sub_chunk)
+        else:
+            encoded.append((sub_chunk, embeddings))
+    return chunk, encoded, failed
+
+
+# ---------- 主流程 ----------
+
+def reindex(
+    collection_name: str,
+    chunk_size: int = 512,
+    encode_batch: int = 64,
+    workers: int = 1,
+    loader_workers: Optional[int] = None,
+    checkpoint_path: str = "reindex_checkpoint.json",
+    restart: bool = False,
+    user_id: Optional[int] = None,
+    prune: bool = False
+) -> Dict[str, Any]:
+    """
+    重建向量库，返回 {"success", "failed", "pruned", "seconds", "items_per_second"}
+
+    workers > 1 时启动多个编码进程（每个进程各自加载模型），主进程按块顺序写入 ChromaDB 和断点，
+    因此断点之前的块一定都已写入。
+    """
+    import chromadb
+    from chromadb.config import Settings
+    from app.services.embedding_service import EmbeddingService, chroma_data_path
+
+    checkpoint = Checkpoint(checkpoint_path, collection_name, user_id)
+    if restart:
+        checkpoint.remove()
+    elif checkpoint.load():
+        print(f"从断点继续：id > {checkpoint.last_id}（已完成 {checkpoint.success} 件，失败 {checkpoint.failed} 件）")
+
+    total = count_items(checkpoint.last_id, user_id)
+    print(f"待处理 {total} 件衣物 → 集合 {collection_name}（{workers} 个编码进程）")
+
+    client = chromadb.PersistentClient(path=chroma_data_path(), settings=Settings(anonymized_telemetry=False))
+    collection = client.get_or_create_collection(
+        name=collection_name,
+        metadata={"description": "用户衣橱语义向量存储（多模态1536维）"}
+    )
+
+    cpu_count = os.cpu_count() or 1
+    if loader_workers is None:
+        loader_workers = min(4, cpu_count) if workers == 1 else 0  # 进程池中的工作进程不能再创建子进程
+    tasks = ((chunk, encode_batch) for chunk in iter_item_chunks(chunk_size, checkpoint.last_id, user_id))
+
+    pool = None
+    if total == 0:
+        results = iter(())
+    elif workers > 1:
+        pool = multiprocessing.get_context("spawn").Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(max(1, cpu_count // workers), loader_workers)
+        )
+        results = pool.imap(_encode_chunk, tasks)  # 按提交顺序返回，保证断点单调
+    else:
+        _init_worker(cpu_count, loader_workers)
+        results = map(_encode_chunk, tasks)
+
+    started = time.time()
+    processed = 0
+    try:
+        for chunk, encoded, failed in results:
+            for sub_chunk, embeddings in encoded:
+                try:
+                    EmbeddingService.upsert_embeddings(collection, sub_chunk, embeddings)
+                    checkpoint.success += len(sub_chunk)
+                except Exception as e:
+                    print(f"写入失败（id {sub_chunk[0]['id']}-{sub_chunk[-1]['id']}）: {e}")
+                    failed += len(sub_chunk)
+
+            checkpoint.failed += failed
+            checkpoint.last_id = chunk[-1]["id"]
+            checkpoint.save()
+
+            processed += len(chunk)
+            elapsed = time.time() - started
+            print(
+                f"进度 {processed}/{total}（{processed / total:.1%}）"
+                f" | {processed / elapsed:.1f} 件/秒 | 失败 {checkpoint.failed} | 断点 id={checkpoint.last_id}"
+            )
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.time() - started
+    checkpoint.remove()
+
+    # 删除数据库中已不存在的衣物向量
+    pruned = 0
+    if prune and user_id is None:
+        live_ids = all_item_ids()
+        stale_ids = [item_id for item_id in collection.get(include=[])["ids"] if item_id not in live_ids]
+        for start in range(0, len(stale_ids), 1000):
+            collection.delete(ids=stale_ids[start:start + 1000])
+        pruned = len(stale_ids)
+
+    # 用户索引由该集合派生：代数加一后服务丢弃已加载的索引并按需重建（旧文件仍可被已发出的快照读取）
+    from app.services.vector_index import bump_generation
+    bump_generation(os.path.join(os.getcwd(), "vector_index", collection_name))
+
+    return {
+        "success": checkpoint.success,
+        "failed": checkpoint.failed,
+        "pruned": pruned,
+        "seconds": round(elapsed, 1),
+        "items_per_second": round(processed / elapsed, 1) if processed and elapsed > 0 else 0.0
+    }
+
+
+def _default_collection(live: str, checkpoint_path: str, restart: bool) -> str:
+    """未指定集合时：续跑断点中的集合，否则新建一个带时间戳的集合"""
+    if not restart and os.path.exists(checkpoint_path):
+        try:
+            with open(checkpoint_path, encoding="utf-8") as f:
+                collection = json.load(f).get("collection")
+        except (OSError, ValueError):
+            collection = None
+        if collection and collection != live:
+            return collection
+    return f"{live}_{time.strftime('%Y%m%d%H%M%S')}"
+
+
+def main():
+    from app.services.embedding_service import WARDROBE_COLLECTION
+
+    parser = argparse.ArgumentParser(description="从 fashion.db 全量重建衣橱向量库（支持断点续跑）")
+    parser.add_argument("--collection", default=None, help="目标 ChromaDB 集合（默认新建集合，不写服务正在使用的集合）")
+    parser.add_argument("--allow-live", action="store_true", help="允许写入服务当前使用的集合（仅在服务停止时使用）")
+    parser.add_argument("--chunk-size", type=int, default=512, help="每次从数据库读取并写入断点的衣物数量")
+    parser.add_argument("--encode-batch", type=int, default=64, help="文本 / CLIP 批量编码大小")
+    parser.add_argument("--workers", type=int, default=1, help="编码进程数（每个进程各加载一份模型）")
+    parser.add_argument("--loader-workers", type=int, default=None, help="单进程模式下的图片解码进程数")
+    parser.add_argument("--checkpoint", default="reindex_checkpoint.json", help="断点文件路径")
+    parser.add_argument("--restart", action="store_true", help="忽略已有断点，从头开始")
+    parser.add_argument("--user-id", type=int, default=None, help="只重建某个用户的衣物")
+    parser.add_argument("--prune", action="store_true", help="完成后删除数据库中已不存在的衣物向量")
+    args = parser.parse_args()
+
+    collection_name = args.collection
+    if args.user_id is not None and collection_name is None and not args.allow_live:
+        # 新建的集合里只会有这一个用户的衣物，不能拿来替换服务正在使用的集合
+        parser.error("--user-id 只重建部分衣物，需用 --collection 指定已有的完整集合，或停止服务后加 --allow-live")
+    if collection_name is None:
+        collection_name = WARDROBE_COLLECTION if args.allow_live else _default_collection(
+            WARDROBE_COLLECTION, args.checkpoint, args.restart
+        )
+    elif collection_name == WARDROBE_COLLECTION and not args.allow_live:
+        parser.error(
+            f"集合 {WARDROBE_COLLECTION} 正在被服务使用，请重建到新集合后切换 WARDROBE_COLLECTION，"
+            f"或停止服务后加 --allow-live"
+        )
+
+    result = reindex(
+        collection_name=collection_name,
+        chunk_size=args.chunk_size,
+        encode_batch=args.encode_batch,
+        workers=max(1, args.workers),
+        loader_workers=args.loader_workers,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart,
+        user_id=args.user_id,
+        prune=args.prune
+    )
+    print(
+        f"重建完成：成功 {result['success']} 件，失败 {result['failed']} 件，清理 {result['pruned']} 件，"
+        f"耗时 {result['seconds']} 秒，平均 {result['items_per_second']} 件/秒"
+    )
+    if collection_name != WARDROBE_COLLECTION and args.user_id is None:
+        print(f"切换到新集合：WARDROBE_COLLECTION={collection_name}，然后重启服务")
+
+
+if __name__ == "__main__":
+    main()
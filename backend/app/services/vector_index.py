@@ -0,0 +1,565 @@
+"""
+按用户划分的进程内向量索引 - 每个用户、每种模态（文本 / 图像）一块连续的 float32 矩阵（内存映射），精确检索
+
+单个用户的衣橱只有几十到几百件，对这一小块矩阵做一次矩阵-向量乘即可得到全部精确得分，
+比带 user_id 元数据过滤的 HNSW 近似检索更快也更准。ChromaDB 仍是持久化的数据源（存拼接后的融合向量）：
+索引文件缺失或损坏时从 ChromaDB 重建，add_item / delete_item 时增量更新。
+
+检索为后融合：各模态分别计算余弦相似度，再按权重加权求和。纯文本查询只计算文本矩阵，
+不会像拼接向量的 L2 距离那样被衣物图像部分的范数（有图为1、无图为0）干扰。
+
+磁盘格式（每个用户每种模态一个向量文件，外加一个元数据文件）：
+  user_<id>.<模态>.f32   行优先的 float32 向量，N x 该模态维度
+  user_<id>.json         {"dims", "rows", "generation", "ids", "metadatas"}，最后写入（原子替换），行数与向量文件大小不一致时视为损坏
+  generation             集合级索引代数；离线重建集合后加一，代数不符的用户索引视为过期并从 ChromaDB 重建
+                         （不删除文件，已发出的快照仍可读取原来的内存映射）
+
+precision 为 float16 / int8 时，常驻内存的是量化后的矩阵（int8 为逐维对称缩放），占用降为 1/2 / 1/4；
+先用量化矩阵粗排，再对得分最高的 rescore 行从 float32 内存映射文件中读出原始向量精确重算。
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# 从 ChromaDB 读取某个用户的全部向量：返回 (item_ids, 融合向量, metadatas)
+UserLoader = Callable[[int], Tuple[List[int], List[List[float]], List[Dict[str, Any]]]]
+
+PRECISIONS = ("float32", "float16", "int8")
+GENERATION_FILE = "generation"
+
+
+def read_generation(root_dir: str) -> int:
+    """读取集合的索引代数（文件不存在为 0）"""
+    try:
+        with open(os.path.join(root_dir, GENERATION_FILE), encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def bump_generation(root_dir: str) -> int:
+    """索引代数加一（原子替换写入），运行中的服务在下次访问时丢弃已加载的用户索引"""
+    os.makedirs(root_dir, exist_ok=True)
+    generation = read_generation(root_dir) + 1
+    path = os.path.join(root_dir, GENERATION_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(str(generation))
+    os.replace(tmp_path, path)
+    return generation
+
+# 批量近邻检索时每次矩阵乘的查询数（限制 m x n 得分矩阵的内存）
+NEAREST_CHUNK = 256
+
+
+def quantize(vectors: np.ndarray, precision: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """返回 (量化矩阵, 逐维缩放系数)；float32 原样返回，float16 无缩放系数"""
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    if precision == "int8":
+        scales = np.abs(vectors).max(axis=0) / 127.0 if len(vectors) else np.ones(vectors.shape[1], dtype=np.float32)
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+        return codes, scales
+    return vectors, None
+
+
+class ModalityBlock:
+    """单一模态的向量矩阵：float32 原始向量（内存映射）+ 可选的量化副本 + 行范数"""
+
+    def __init__(self, vectors: np.ndarray, precision: str = "float32"):
+        self.vectors = vectors  # float32（内存映射），用于精排
+        self.precision = precision
+        self.norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+        self.codes, self.scales = quantize(vectors, precision)
+        # int8 各维度的绝对值上界：增量更新的行超出时才需要整体重新量化
+        self.limits = np.abs(vectors).max(axis=0) if precision == "int8" and len(vectors) else None
+
+    def updated(self, vectors: np.ndarray, rows: np.ndarray) -> "ModalityBlock":
+        """
+        新的完整矩阵 vectors 只在 rows 行（及末尾截断）上与当前块不同：沿用其余行的范数和量化码，
+        只重算这些行；int8 新行超出原缩放范围时整体重新量化
+        """
+        if self.limits is None and self.precision == "int8":
+            return ModalityBlock(vectors, self.precision)
+        touched = np.asarray(vectors[rows], dtype=np.float32)
+        if self.limits is not None and len(touched):
+            limits = np.maximum(self.limits, np.abs(touched).max(axis=0))
+            if np.any(limits > self.limits):
+                return ModalityBlock(vectors, self.precision)
+
+        block = ModalityBlock.__new__(ModalityBlock)
+        block.vectors = vectors
+        block.precision = self.precision
+        block.limits = self.limits
+        block.scales = self.scales
+        count = len(vectors)
+        keep = min(len(self.norms), count)
+        block.norms = np.empty(count, dtype=self.norms.dtype)
+        block.norms[:keep] = self.norms[:keep]
+        block.norms[rows] = np.sqrt(np.einsum("ij,ij->i", touched, touched))
+        if not self.quantized:
+            block.codes = vectors
+            return block
+        block.codes = np.empty((count, vectors.shape[1]), dtype=self.codes.dtype)
+        block.codes[:keep] = self.codes[:keep]
+        if self.scales is not None:
+            block.codes[rows] = np.clip(np.rint(touched / self.scales), -127, 127).astype(np.int8)
+        else:
+            block.codes[rows] = touched.astype(self.codes.dtype)
+        return block
+
+    @property
+    def quantized(self) -> bool:
+        return self.codes is not self.vectors
+
+    @property
+    def resident_bytes(self) -> int:
+        """常驻内存字节数（float32 时矩阵只是内存映射，按矩阵大小计）"""
+        total = self.codes.nbytes + self.norms.nbytes
+        if self.scales is not None:
+            total += self.scales.nbytes
+        return total
+
+    def cosine(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        余弦相似度；rows 为空时用（可能量化的）常驻矩阵估算全部行，否则用 float32 原始向量精确计算指定行。
+        零向量（如没有图片的衣物）的相似度为 0。
+        """
+        query_norm = float(np.sqrt(query @ query))
+        if rows is not None:
+            dots = self.vectors[rows] @ query
+            norms = self.norms[rows]
+        else:
+            if not self.quantized:
+                dots = self.vectors @ query
+            elif self.scales is not None:
+                # x ≈ codes * scales  =>  x·q ≈ codes·(scales * q)
+                dots = self.codes.astype(np.float32) @ (self.scales * query)
+            else:
+                dots = self.codes.astype(np.float32) @ query
+            norms = self.norms
+        denominator = norms * query_norm
+        return np.divide(dots, denominator, out=np.zeros_like(dots), where=denominator > 0)
+
+    def cosine_batch(self, queries: np.ndarray) -> np.ndarray:
+        """一批查询 (m, dim) 对全部行的精确余弦相似度 (m, n)，用 float32 原始向量做一次矩阵乘"""
+        dots = queries @ self.vectors.T
+        denominator = np.sqrt(np.einsum("ij,ij->i", queries, queries))[:, None] * self.norms[None, :]
+        return np.divide(dots, denominator, out=np.zeros_like(dots), where=denominator > 0)
+
+
+class IndexSnapshot:
+    """某一时刻的用户索引（不可变）；增量更新时整体替换，检索可在锁外进行"""
+
+    def __init__(
+        self,
+        ids: List[int],
+        metadatas: List[Dict[str, Any]],
+        blocks: Dict[str, Any],
+        precision: str = "float32"
+    ):
+        """blocks 为各模态的 float32 矩阵（或已构建好的 ModalityBlock）"""
+        self.ids = ids
+        self.metadatas = metadatas
+        self.rows = {item_id: row for row, item_id in enumerate(ids)}
+        self.blocks = {
+            name: vectors if isinstance(vectors, ModalityBlock) else ModalityBlock(vectors, precision)
+            for name, vectors in blocks.items()
+        }
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(block.resident_bytes for block in self.blocks.values())
+
+    def scores(self, queries: Dict[str, np.ndarray], weights: Dict[str, float], rescore: int = 64) -> np.ndarray:
+        """
+        后融合得分：Σ 权重 × 该模态余弦相似度，只计算 queries 中给出的模态（权重按参与的模态归一化）。
+
+        量化索引先用量化矩阵估算全部得分，再对最高的 rescore 个用 float32 原始向量精确重算。
+        """
+        active = [name for name in queries if name in self.blocks and weights.get(name, 0) > 0]
+        total_weight = sum(weights[name] for name in active)
+        fused = np.zeros(len(self.ids), dtype=np.float32)
+        if not active:
+            return fused
+        for name in active:
+            fused += (weights[name] / total_weight) * self.blocks[name].cosine(queries[name])
+
+        if rescore > 0 and any(self.blocks[name].quantized for name in active):
+            k = min(rescore, len(fused))
+            top = np.sort(np.argpartition(-fused, k - 1)[:k])  # 升序读取内存映射的行
+            fused[top] = sum(
+                (weights[name] / total_weight) * self.blocks[name].cosine(queries[name], top)
+                for name in active
+            )
+        return fused
+
+    def nearest(
+        self,
+        name: str,
+        queries: np.ndarray,
+        top_k: int,
+        exclude_ids: Optional[List[Optional[int]]] = None,
+        min_score: float = 0.0
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        批量单模态近邻：queries 为 (m, dim) 查询矩阵，每个查询返回得分降序的 [(item_id, 余弦相似度)]。
+
+        exclude_ids[i] 为第 i 个查询要排除的衣物（如查询衣物本身）；该模态为零向量的衣物（如没有图片）不参与排序。
+        """
+        block = self.blocks[name]
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, block.vectors.shape[1])
+        empty_rows = block.norms == 0
+        results = []
+        for start in range(0, len(queries), NEAREST_CHUNK):
+            similarities = block.cosine_batch(queries[start:start + NEAREST_CHUNK])
+            similarities[:, empty_rows] = -np.inf
+            for offset, row_scores in enumerate(similarities):
+                exclude = exclude_ids[start + offset] if exclude_ids else None
+                if exclude in self.rows:
+                    row_scores[self.rows[exclude]] = -np.inf
+                k = min(top_k, len(row_scores))
+                if k <= 0:
+                    results.append([])
+                    continue
+                top = np.argpartition(-row_scores, k - 1)[:k]
+                top = top[np.argsort(-row_scores[top], kind="stable")]
+                results.append([
+                    (self.ids[row], float(row_scores[row])) for row in top if row_scores[row] >= min_score
+                ])
+        return results
+
+
+class UserVectorIndex:
+    """单个用户的分模态向量矩阵（只读内存映射，写入通过文件追加/替换完成）"""
+
+    def __init__(self, dims: Dict[str, int], base_path: str, precision: str = "float32", generation: int = 0):
+        self.dims = dims
+        self.offsets = {}
+        offset = 0
+        for name, dim in dims.items():
+            self.offsets[name] = (offset, offset + dim)
+            offset += dim
+        self.total_dim = offset
+        self.paths = {name: f"{base_path}.{name}.f32" for name in dims}
+        self.meta_path = base_path + ".json"
+        self.precision = precision
+        self.generation = generation
+        self.ids: List[int] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.blocks = {name: np.empty((0, dim), dtype=np.float32) for name, dim in dims.items()}
+        self.snapshot = IndexSnapshot([], [], self.blocks, precision)
+        self._rows: Dict[int, int] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def load(self) -> bool:
+        """从磁盘加载；文件缺失、维度 / 代数不符或行数不一致时返回 False"""
+        if not os.path.exists(self.meta_path) or not all(os.path.exists(path) for path in self.paths.values()):
+            return False
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        rows = meta.get("rows", -1)
+        if (
+            meta.get("dims") != self.dims
+            or meta.get("generation", 0) != self.generation
+            or rows != len(meta.get("ids", []))
+            or any(os.path.getsize(self.paths[name]) != rows * dim * 4 for name, dim in self.dims.items())
+        ):
+            return False
+
+        self.ids = [int(item_id) for item_id in meta["ids"]]
+        self.metadatas = meta.get("metadatas") or [{} for _ in self.ids]
+        self._remap()
+        return True
+
+    def rebuild(self, item_ids: List[int], embeddings: List[List[float]], metadatas: List[Dict[str, Any]]):
+        """用 ChromaDB 中的全量数据重写索引文件"""
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.total_dim)
+        self.ids = [int(item_id) for item_id in item_ids]
+        self.metadatas = [dict(metadata or {}) for metadata in metadatas]
+        for name, (start, end) in self.offsets.items():
+            self._replace_vectors(name, vectors[:, start:end])
+        self._write_meta()
+        self._remap()
+
+    def add(self, item_ids: List[int], embeddings: Any, metadatas: List[Dict[str, Any]]):
+        """
+        新衣物一次性追加到末尾（旧快照映射的区域不变）；item_id 已存在时替换该行，
+        此时写入新文件再原子替换，已发出的快照仍读取旧文件（embeddings 为融合向量）
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.total_dim)
+        base = len(self.ids)
+        appended = []
+        replaced = []
+        for item_id, vector, metadata in zip(item_ids, vectors, metadatas):
+            row = self._rows.get(item_id)
+            if row is None:
+                self._rows[item_id] = len(self.ids)
+                self.ids.append(item_id)
+                self.metadatas.append(dict(metadata))
+                appended.append(vector)
+            elif row >= base:
+                appended[row - base] = vector
+                self.metadatas[row] = dict(metadata)
+            else:
+                replaced.append((row, vector))
+                self.metadatas[row] = dict(metadata)
+
+        for name, (start, end) in self.offsets.items():
+            if replaced:
+                vectors = np.array(self.blocks[name], dtype=np.float32)
+                for row, vector in replaced:
+                    vectors[row] = vector[start:end]
+                if appended:
+                    vectors = np.concatenate([vectors, np.stack(appended)[:, start:end]])
+                self._replace_vectors(name, vectors)
+            elif appended:
+                with open(self.paths[name], "ab") as f:
+                    f.write(np.ascontiguousarray(np.stack(appended)[:, start:end]).tobytes())
+        self._write_meta()
+        touched = [row for row, _ in replaced] + list(range(base, len(self.ids)))
+        self._remap(np.asarray(touched, dtype=np.int64))
+
+    def remove(self, item_id: int) -> bool:
+        """删除一行（最后一行移到空位，整体原子替换）"""
+        row = self._rows.get(item_id)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.metadatas[row] = self.metadatas[last]
+        self.ids.pop()
+        self.metadatas.pop()
+        for name in self.dims:
+            vectors = np.array(self.blocks[name], dtype=np.float32)
+            if row != last:
+                vectors[row] = vectors[last]
+            self._replace_vectors(name, vectors[:last])
+        self._write_meta()
+        self._remap(np.asarray([row] if row != last else [], dtype=np.int64))
+        return True
+
+    def _remap(self, touched: Optional[np.ndarray] = None):
+        """重新映射向量文件并生成新快照；touched 给出变化的行时只重算这些行的范数 / 量化码"""
+        rows = len(self.ids)
+        blocks = {}
+        for name, dim in self.dims.items():
+            if rows:
+                self.blocks[name] = np.memmap(self.paths[name], dtype=np.float32, mode="r", shape=(rows, dim))
+            else:
+                self.blocks[name] = np.empty((0, dim), dtype=np.float32)
+            if touched is None:
+                blocks[name] = self.blocks[name]
+            else:
+                blocks[name] = self.snapshot.blocks[name].updated(self.blocks[name], touched)
+        self.snapshot = IndexSnapshot(list(self.ids), list(self.metadatas), blocks, self.precision)
+        self._rows = dict(self.snapshot.rows)
+
+    def _replace_vectors(self, name: str, vectors: np.ndarray):
+        tmp_path = self.paths[name] + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        os.replace(tmp_path, self.paths[name])
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "dims": self.dims,
+                "rows": len(self.ids),
+                "generation": self.generation,
+                "ids": self.ids,
+                "metadatas": self.metadatas
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+
+    def file_paths(self) -> List[str]:
+        return list(self.paths.values()) + [self.meta_path]
+
+
+class VectorIndex:
+    """按用户懒加载的向量索引集合（线程安全，已加载的用户数有上限）"""
+
+    def __init__(
+        self,
+        root_dir: str,
+        dims: Dict[str, int],
+        loader: UserLoader,
+        max_users: int = 256,
+        precision: str = "float32",
+        rescore: int = 64
+    ):
+        """dims 为各模态维度，顺序即融合向量中的拼接顺序，例如 {"text": 768, "image": 768}"""
+        if precision not in PRECISIONS:
+            raise ValueError(f"不支持的向量精度: {precision}，可选 {PRECISIONS}")
+        self.root_dir = root_dir
+        self.dims = dict(dims)
+        self.total_dim = sum(self.dims.values())
+        self.loader = loader
+        self.max_users = max(1, max_users)
+        self.precision = precision
+        self.rescore = rescore
+        os.makedirs(root_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._users: "OrderedDict[int, UserVectorIndex]" = OrderedDict()
+        self._item_users: Dict[int, int] = {}
+        self.generation = read_generation(root_dir)
+        self._generation_stamp = self._stat_generation()
+
+        self.loads = 0
+        self.rebuilds = 0
+        self.searches = 0
+
+    def _new_index(self, user_id: int) -> UserVectorIndex:
+        return UserVectorIndex(
+            self.dims, os.path.join(self.root_dir, f"user_{user_id}"),
+            precision=self.precision, generation=self.generation
+        )
+
+    def _stat_generation(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.root_dir, GENERATION_FILE)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _sync_generation(self):
+        """代数文件有变化（离线重建了集合）时丢弃全部已加载的用户索引"""
+        stamp = self._stat_generation()
+        if stamp == self._generation_stamp:
+            return
+        self._generation_stamp = stamp
+        generation = read_generation(self.root_dir)
+        if generation != self.generation:
+            print(f"[VectorIndex] 索引代数 {self.generation} -> {generation}，已加载的用户索引失效")
+            self.generation = generation
+            self._users.clear()
+            self._item_users.clear()
+
+    def _get(self, user_id: int) -> UserVectorIndex:
+        self._sync_generation()
+        index = self._users.get(user_id)
+        if index is not None:
+            self._users.move_to_end(user_id)
+            return index
+
+        index = self._new_index(user_id)
+        if index.load():
+            self.loads += 1
+        else:
+            index.rebuild(*self.loader(user_id))
+            self.rebuilds += 1
+
+        self._users[user_id] = index
+        for item_id in index.ids:
+            self._item_users[item_id] = user_id
+        while len(self._users) > self.max_users:
+            _, evicted = self._users.popitem(last=False)
+            for item_id in evicted.ids:
+                self._item_users.pop(item_id, None)
+        return index
+
+    def snapshot(self, user_id: int) -> IndexSnapshot:
+        with self._lock:
+            self.searches += 1
+            return self._get(user_id).snapshot
+
+    def search(
+        self,
+        user_id: int,
+        queries: Dict[str, np.ndarray],
+        weights: Dict[str, float]
+    ) -> Tuple[List[int], np.ndarray, List[Dict[str, Any]]]:
+        """
+        检索该用户的全部衣物，返回 (item_ids, 后融合余弦得分, metadatas)，顺序与索引行一致。
+
+        queries 只需给出参与检索的模态（如纯文本查询只给 "text"），其余模态的矩阵不会被读取。
+        float32 时全部为精确得分；量化时最高的 rescore 个为精确得分，其余为量化估算值。
+        """
+        snapshot = self.snapshot(user_id)
+        if not snapshot.ids:
+            return [], np.empty(0, dtype=np.float32), []
+        return snapshot.ids, snapshot.scores(queries, weights, self.rescore), snapshot.metadatas
+
+    def vectors(self, user_id: int, name: str, item_ids: List[int]) -> Dict[int, np.ndarray]:
+        """读取已入库衣物某一模态的 float32 向量（不在索引中或该模态为零向量的衣物不返回）"""
+        with self._lock:
+            snapshot = self._get(user_id).snapshot
+        block = snapshot.blocks[name]
+        found = {}
+        for item_id in item_ids:
+            row = snapshot.rows.get(item_id)
+            if row is not None and block.norms[row] > 0:
+                found[item_id] = np.array(block.vectors[row], dtype=np.float32)
+        return found
+
+    def nearest(
+        self,
+        user_id: int,
+        name: str,
+        queries: np.ndarray,
+        top_k: int,
+        exclude_ids: Optional[List[Optional[int]]] = None,
+        min_score: float = 0.0
+    ) -> List[List[Tuple[int, float]]]:
+        """在该用户索引的某一模态上做批量近邻检索（见 IndexSnapshot.nearest）"""
+        snapshot = self.snapshot(user_id)
+        return snapshot.nearest(name, queries, top_k, exclude_ids, min_score)
+
+    def add(self, user_id: int, item_ids: List[int], embeddings: Any, metadatas: List[Dict[str, Any]]):
+        """向某个用户的索引批量追加 / 替换向量（融合向量，按 dims 切分到各模态）"""
+        with self._lock:
+            self._get(user_id).add(item_ids, embeddings, metadatas)
+            for item_id in item_ids:
+                self._item_users[item_id] = user_id
+
+    def remove(self, item_id: int, user_id: Optional[int] = None) -> bool:
+        with self._lock:
+            self._sync_generation()
+            if user_id is None:
+                user_id = self._item_users.get(item_id)
+            if user_id is None:
+                return False
+            self._item_users.pop(item_id, None)
+            return self._get(user_id).remove(item_id)
+
+    def invalidate(self, user_id: int):
+        """丢弃该用户的索引文件，下次访问时从 ChromaDB 重建"""
+        with self._lock:
+            index = self._users.pop(user_id, None)
+            if index is not None:
+                for item_id in index.ids:
+                    self._item_users.pop(item_id, None)
+            for path in self._new_index(user_id).file_paths():
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "precision": self.precision,
+                "rescore": self.rescore,
+                "loaded_users": len(self._users),
+                "loaded_items": sum(index.size for index in self._users.values()),
+                "resident_bytes": sum(index.snapshot.resident_bytes for index in self._users.values()),
+                "float32_bytes": sum(index.size * self.total_dim * 4 for index in self._users.values()),
+                "max_users": self.max_users,
+                "generation": self.generation,
+                "loads": self.loads,
+                "rebuilds": self.rebuilds,
+                "searches": self.searches
+            }
@@ -0,0 +1,142 @@
+"""
+拼接向量 L2 检索（图像部分补零）与文本 / 图像分开索引的加权后期融合检索对比
+
+旧做法：文本向量与图像向量拼接成 1536 维，纯文本查询的图像部分补零后整体算 L2 距离，
+没有图片的衣物（图像部分为零）与查询在图像维度上距离为 0，因而被系统性地排到前面。
+新做法：两个模态各自算余弦相似度再按权重相加，纯文本查询只扫描文本的 768 维。
+
+相关性以模拟数据的"风格簇"为准：与查询同簇的衣物视为相关。
+
+用法（在 backend 目录下执行）：
+    python benchmarks/late_fusion.py
+    python benchmarks/late_fusion.py --users 100 --items 500 --no-image-ratio 0.2
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.services.vector_index import IndexSnapshot
+
+
+TEXT_DIM = 768
+IMAGE_DIM = 768
+CLUSTERS = 16
+
+
+def synthetic_wardrobe(items: int, no_image_ratio: float, centers, rng: np.random.Generator):
+    """返回 (文本向量, 图像向量, 风格簇, 是否有图片)；无图片衣物的图像向量为零"""
+    text_centers, image_centers = centers
+    clusters = rng.integers(0, CLUSTERS, size=items)
+    text = text_centers[clusters] + rng.normal(0, 0.12, size=(items, TEXT_DIM))
+    image = image_centers[clusters] + rng.normal(0, 0.8, size=(items, IMAGE_DIM))
+    image /= np.linalg.norm(image, axis=1, keepdims=True)
+    has_image = rng.random(items) >= no_image_ratio
+    image[~has_image] = 0.0
+    return text.astype(np.float32), image.astype(np.float32), clusters, has_image
+
+
+def make_queries(count: int, centers, rng: np.random.Generator):
+    """一半纯文本查询，一半文本 + 图片查询；返回 [(风格簇, 文本向量, 图像向量或 None)]"""
+    text_centers, image_centers = centers
+    queries = []
+    for index in range(count):
+        cluster = int(rng.integers(0, CLUSTERS))
+        text = (text_centers[cluster] + rng.normal(0, 0.12, size=TEXT_DIM)).astype(np.float32)
+        image = None
+        if index >= count // 2:
+            image = image_centers[cluster] + rng.normal(0, 0.8, size=IMAGE_DIM)
+            image = (image / np.linalg.norm(image)).astype(np.float32)
+        queries.append((cluster, text, image))
+    return queries
+
+
+def concat_top_k(fused: np.ndarray, text: np.ndarray, image, k: int) -> np.ndarray:
+    """旧路径：拼接向量，纯文本查询图像部分补零，按 L2 距离取前 k"""
+    query = np.zeros(fused.shape[1], dtype=np.float32)
+    query[:TEXT_DIM] = text
+    if image is not None:
+        query[TEXT_DIM:] = image
+    distances = np.linalg.norm(fused - query, axis=1)
+    k = min(k, len(distances))
+    top = np.argpartition(distances, k - 1)[:k]
+    return top[np.argsort(distances[top])]
+
+
+def fusion_top_k(snapshot: IndexSnapshot, text: np.ndarray, image, weights, k: int) -> np.ndarray:
+    """新路径：各模态余弦相似度加权求和，按得分取前 k"""
+    queries = {"text": text}
+    if image is not None:
+        queries["image"] = image
+    scores = snapshot.scores(queries, weights)
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="拼接 L2 检索与加权后期融合检索对比")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--items", type=int, default=300, help="每个用户的衣物数")
+    parser.add_argument("--queries", type=int, default=20, help="每个用户的查询数")
+    parser.add_argument("--no-image-ratio", type=float, default=0.1, help="没有图片的衣物比例")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--text-weight", type=float, default=0.5)
+    parser.add_argument("--image-weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = (rng.normal(0, 0.25, size=(CLUSTERS, TEXT_DIM)), rng.normal(0, 1.0, size=(CLUSTERS, IMAGE_DIM)))
+    weights = {"text": args.text_weight, "image": args.image_weight}
+
+    # 按查询类型累计：[耗时, 命中数, 无图片衣物数, 结果数]
+    results = {
+        method: {kind: [0.0, 0, 0, 0] for kind in ("text", "text+image")}
+        for method in ("concat_l2", "late_fusion")
+    }
+    no_image_total = 0
+    total_items = 0
+    for _ in range(args.users):
+        text, image, clusters, has_image = synthetic_wardrobe(args.items, args.no_image_ratio, centers, rng)
+        fused = np.concatenate([text, image], axis=1)
+        snapshot = IndexSnapshot(list(range(args.items)), [], {"text": text, "image": image}, "float32")
+        no_image_total += int((~has_image).sum())
+        total_items += args.items
+
+        for cluster, query_text, query_image in make_queries(args.queries, centers, rng):
+            kind = "text" if query_image is None else "text+image"
+            for method in results:
+                started = time.perf_counter()
+                if method == "concat_l2":
+                    top = concat_top_k(fused, query_text, query_image, args.k)
+                else:
+                    top = fusion_top_k(snapshot, query_text, query_image, weights, args.k)
+                bucket = results[method][kind]
+                bucket[0] += time.perf_counter() - started
+                bucket[1] += int((clusters[top] == cluster).sum())
+                bucket[2] += int((~has_image[top]).sum())
+                bucket[3] += len(top)
+
+    query_counts = {"text": args.users * (args.queries // 2), "text+image": args.users * (args.queries - args.queries // 2)}
+    print(
+        f"{args.users} 个用户，每人 {args.items} 件衣物（无图片 {no_image_total / total_items:.1%}），"
+        f"每人 {args.queries} 次查询，权重 文本 {args.text_weight} / 图像 {args.image_weight}\n"
+    )
+    header = f"{'方法':<14}{'查询类型':<12}{'耗时(ms/次)':>14}{f'precision@{args.k}':>16}{'前k中无图片占比':>16}"
+    print(header)
+    print("-" * len(header))
+    for method, kinds in results.items():
+        for kind, (seconds, hits, no_image, returned) in kinds.items():
+            print(
+                f"{method:<14}{kind:<12}{seconds * 1000 / max(query_counts[kind], 1):>14.3f}"
+                f"{hits / max(returned, 1):>16.4f}{no_image / max(returned, 1):>16.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
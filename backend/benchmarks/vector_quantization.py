@@ -0,0 +1,142 @@
+"""
+用户向量索引量化基准：float16 / int8（+ float32 精排）相对 float32 精确检索的召回率、内存与耗时
+
+用法（在 backend 目录下执行）：
+    python benchmarks/vector_quantization.py                      # 模拟数据
+    python benchmarks/vector_quantization.py --source chroma      # 使用 chroma_data 中的真实向量
+    python benchmarks/vector_quantization.py --items 500 --rescore 0 32 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.services.vector_index import IndexSnapshot, PRECISIONS
+
+
+TEXT_DIM = 768
+IMAGE_DIM = 768
+WEIGHTS = {"text": 0.5, "image": 0.5}
+
+
+def make_snapshot(wardrobe: np.ndarray, precision: str) -> IndexSnapshot:
+    blocks = {"text": wardrobe[:, :TEXT_DIM], "image": wardrobe[:, TEXT_DIM:]}
+    return IndexSnapshot(list(range(len(wardrobe))), [], blocks, precision)
+
+
+def query_parts(query: np.ndarray):
+    """图像部分为零的查询视为纯文本查询"""
+    parts = {"text": query[:TEXT_DIM]}
+    if np.any(query[TEXT_DIM:]):
+        parts["image"] = query[TEXT_DIM:]
+    return parts
+
+
+def synthetic_wardrobes(users: int, items: int, seed: int):
+    """
+    模拟融合向量：文本部分为少量"风格簇"加噪声（未归一化，与 sentence-transformers 输出量级相近），
+    图像部分为 L2 归一化向量，约 10% 的衣物没有图片（图像部分为零）
+    """
+    rng = np.random.default_rng(seed)
+    text_centers = rng.normal(0, 0.25, size=(16, TEXT_DIM))
+    image_centers = rng.normal(0, 1.0, size=(16, IMAGE_DIM))
+    wardrobes = []
+    for _ in range(users):
+        clusters = rng.integers(0, 16, size=items)
+        text = text_centers[clusters] + rng.normal(0, 0.12, size=(items, TEXT_DIM))
+        image = image_centers[clusters] + rng.normal(0, 0.8, size=(items, IMAGE_DIM))
+        image /= np.linalg.norm(image, axis=1, keepdims=True)
+        image[rng.random(items) < 0.1] = 0.0
+        wardrobes.append(np.concatenate([text, image], axis=1).astype(np.float32))
+    return wardrobes
+
+
+def chroma_wardrobes(min_items: int):
+    """按 user_id 分组读取 chroma_data 中的全部向量"""
+    import chromadb
+    from chromadb.config import Settings
+    from app.services.embedding_service import WARDROBE_COLLECTION, chroma_data_path
+
+    client = chromadb.PersistentClient(path=chroma_data_path(), settings=Settings(anonymized_telemetry=False))
+    results = client.get_collection(WARDROBE_COLLECTION).get(include=["embeddings", "metadatas"])
+    by_user = {}
+    for embedding, metadata in zip(results["embeddings"], results["metadatas"]):
+        by_user.setdefault((metadata or {}).get("user_id", "0"), []).append(embedding)
+    return [np.asarray(rows, dtype=np.float32) for rows in by_user.values() if len(rows) >= min_items]
+
+
+def make_queries(wardrobe: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    """一半是纯文本查询（图像维度为零，与推荐检索一致），一半是以图搜图式的整向量查询"""
+    picks = wardrobe[rng.integers(0, len(wardrobe), size=count)]
+    queries = picks + rng.normal(0, 0.05, size=picks.shape).astype(np.float32)
+    queries[: count // 2, TEXT_DIM:] = 0.0
+    return queries.astype(np.float32)
+
+
+def recall_at_k(truth: np.ndarray, approx: np.ndarray, k: int) -> float:
+    """两组得分（越高越相似）的前 k 名重合比例"""
+    exact_top = set(np.argsort(-truth, kind="stable")[:k].tolist())
+    approx_top = set(np.argsort(-approx, kind="stable")[:k].tolist())
+    return len(exact_top & approx_top) / k
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用户向量索引量化召回率基准")
+    parser.add_argument("--source", choices=["synthetic", "chroma"], default="synthetic")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--items", type=int, default=300, help="模拟数据每个用户的衣物数")
+    parser.add_argument("--queries", type=int, default=20, help="每个用户的查询数")
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--rescore", type=int, nargs="+", default=[0, 64])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.source == "chroma":
+        wardrobes = chroma_wardrobes(min_items=max(args.k))
+    else:
+        wardrobes = synthetic_wardrobes(args.users, args.items, args.seed)
+    if not wardrobes:
+        print("没有可用的向量数据")
+        return
+    rng = np.random.default_rng(args.seed + 1)
+    queries = [make_queries(wardrobe, args.queries, rng) for wardrobe in wardrobes]
+    total_items = sum(len(wardrobe) for wardrobe in wardrobes)
+    print(f"{len(wardrobes)} 个用户，共 {total_items} 件衣物，每个用户 {args.queries} 次查询\n")
+
+    queries = [[query_parts(query) for query in user_queries] for user_queries in queries]
+    baseline = [make_snapshot(wardrobe, "float32") for wardrobe in wardrobes]
+    truths = [
+        [snapshot.scores(query, WEIGHTS) for query in user_queries]
+        for snapshot, user_queries in zip(baseline, queries)
+    ]
+    baseline_bytes = sum(snapshot.resident_bytes for snapshot in baseline)
+
+    header = f"{'精度':<10}{'精排':>6}{'内存(MB)':>12}{'压缩比':>8}{'耗时(ms/次)':>14}" + "".join(
+        f"{f'recall@{k}':>12}" for k in args.k
+    )
+    print(header)
+    print("-" * len(header))
+    for precision in PRECISIONS:
+        snapshots = [make_snapshot(wardrobe, precision) for wardrobe in wardrobes]
+        resident = sum(snapshot.resident_bytes for snapshot in snapshots)
+        for rescore in (args.rescore if precision != "float32" else [0]):
+            recalls = {k: [] for k in args.k}
+            started = time.perf_counter()
+            for snapshot, user_queries, user_truths in zip(snapshots, queries, truths):
+                for query, truth in zip(user_queries, user_truths):
+                    approx = snapshot.scores(query, WEIGHTS, rescore)
+                    for k in args.k:
+                        recalls[k].append(recall_at_k(truth, approx, min(k, len(truth))))
+            elapsed_ms = (time.perf_counter() - started) * 1000 / sum(len(q) for q in queries)
+            print(
+                f"{precision:<10}{rescore:>6}{resident / 1024 ** 2:>12.2f}{baseline_bytes / resident:>8.2f}"
+                f"{elapsed_ms:>14.3f}" + "".join(f"{np.mean(recalls[k]):>12.4f}" for k in args.k)
+            )
+
+
+if __name__ == "__main__":
+    main()
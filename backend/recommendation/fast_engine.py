@@ -0,0 +1,308 @@
+"""
+快速推荐引擎（不调用大模型）
+
+直接用向量检索得到的分类候选拼装完整穿搭：
+  - 槽位规则与 LLM prompt 一致：至少一件上衣（可多层），下装或连体衣二选一，鞋子各一件，配饰可选
+  - 每个类别只保留单品得分最高的 MAX_CANDIDATES_PER_CATEGORY 件（组合数随候选数约 n^6 增长）
+  - 所有候选组合一次性展开为 NumPy 索引矩阵，向量化计算「检索相关度 + 季节/保暖匹配 + 颜色协调」得分
+  - 贪心挑选得分最高且互不重复的 2-3 套
+即使传入整个衣橱，组合数也不超过几万个，耗时在几十毫秒以内，可作为 mode=fast 的主路径或 LLM 失败时的兜底。
+"""
+import itertools
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+
+TOP_CATEGORIES = ['inner_top', 'mid_top', 'outer_top']
+MAX_CANDIDATES_PER_CATEGORY = 4
+OUTFIT_CATEGORIES = set(TOP_CATEGORIES + ['bottom', 'full_body', 'shoes', 'accessories'])
+
+# 各类别的基础保暖度
+CATEGORY_WARMTH = {
+  'inner_top': 1.0,
+  'mid_top': 2.0,
+  'outer_top': 3.0,
+  'bottom': 1.0,
+  'full_body': 1.5,
+}
+
+# 材质对保暖度的修正
+MATERIAL_WARMTH = {
+  'wool': 1.0, 'cashmere': 1.0, 'down': 1.5, 'fleece': 1.0, 'knit': 0.5,
+  'leather': 0.5, 'corduroy': 0.5, 'velvet': 0.5,
+  'linen': -0.5, 'silk': -0.5, 'chiffon': -0.5, 'mesh': -0.5,
+}
+
+# 颜色族：中性色与任何颜色都协调，其余按色相角度计算协调度
+NEUTRAL_COLORS = ['black', 'white', 'gray', 'grey', 'beige', 'cream', 'ivory', 'navy', 'denim', 'silver']
+EARTH_COLORS = ['brown', 'khaki', 'camel', 'tan', 'coffee', 'olive']
+HUE_COLORS = [
+  ('red', 0), ('burgundy', 0), ('wine', 0), ('pink', 340), ('orange', 30), ('yellow', 55),
+  ('gold', 50), ('green', 120), ('teal', 170), ('cyan', 185), ('blue', 220), ('purple', 280),
+]
+WARM_HUES = {'red', 'burgundy', 'wine', 'pink', 'orange', 'yellow', 'gold'}
+
+COLOR_NAMES = ['neutral', 'earth'] + [name for name, _ in HUE_COLORS]
+COLOR_INDEX = {name: i for i, name in enumerate(COLOR_NAMES)}
+
+
+def _build_color_matrix() -> np.ndarray:
+  n = len(COLOR_NAMES)
+  matrix = np.full((n, n), 0.4, dtype=np.float32)
+  hues = np.array([angle for _, angle in HUE_COLORS], dtype=np.float32)
+  diff = np.abs(hues[:, None] - hues[None, :])
+  diff = np.minimum(diff, 360 - diff)
+  hue_matrix = np.select(
+    [diff == 0, diff <= 40, diff >= 150, (diff >= 100) & (diff <= 140)],
+    [0.6, 0.8, 0.7, 0.5],
+    default=0.35
+  ).astype(np.float32)
+  matrix[2:, 2:] = hue_matrix
+  # 大地色与中性色、暖色更协调
+  warm_mask = np.array([name in WARM_HUES for name, _ in HUE_COLORS])
+  matrix[1, 2:] = np.where(warm_mask, 0.8, 0.6)
+  matrix[2:, 1] = matrix[1, 2:]
+  matrix[1, 1] = 0.8
+  matrix[0, :] = 1.0
+  matrix[:, 0] = 1.0
+  return matrix
+
+
+COLOR_COMPATIBILITY = _build_color_matrix()
+
+
+def _color_index(item: Dict[str, Any]) -> int:
+  color = (item.get('color_en') or '').lower()
+  for name in NEUTRAL_COLORS:
+    if name in color:
+      return COLOR_INDEX['neutral']
+  for name in EARTH_COLORS:
+    if name in color:
+      return COLOR_INDEX['earth']
+  for name, _ in HUE_COLORS:
+    if name in color:
+      return COLOR_INDEX[name]
+  return COLOR_INDEX['neutral']
+
+
+def _item_warmth(item: Dict[str, Any]) -> float:
+  warmth = CATEGORY_WARMTH.get(item.get('category'), 0.0)
+  material = (item.get('material_en') or '').lower()
+  for name, delta in MATERIAL_WARMTH.items():
+    if name in material:
+      warmth += delta
+      break
+  return warmth
+
+
+def _weather_profile(weather: Dict[str, Any]) -> Dict[str, Any]:
+  """根据平均气温确定目标保暖度、当前季节和天气提示"""
+  temp_max = weather.get('temp_max', 25)
+  temp_min = weather.get('temp_min', 15)
+  try:
+    avg_temp = (float(temp_max) + float(temp_min)) / 2
+  except (TypeError, ValueError):
+    avg_temp = 20.0
+
+  if avg_temp >= 26:
+    profile = {"target_warmth": 2.0, "seasons": ["summer"], "allow_outer": False, "hint": "天气炎热，以轻薄透气为主"}
+  elif avg_temp >= 18:
+    profile = {"target_warmth": 3.0, "seasons": ["spring", "fall"], "allow_outer": True, "hint": "气温舒适，单层或薄外套即可"}
+  elif avg_temp >= 10:
+    profile = {"target_warmth": 5.0, "seasons": ["fall", "spring"], "allow_outer": True, "hint": "早晚偏凉，建议叠穿"}
+  else:
+    profile = {"target_warmth": 6.5, "seasons": ["winter"], "allow_outer": True, "hint": "天气寒冷，注意保暖"}
+
+  profile["rainy"] = (weather.get('rain_prob', 0) or 0) > 50
+  return profile
+
+
+def _season_fit(item: Dict[str, Any], seasons: List[str]) -> float:
+  item_seasons = (item.get('season') or '').lower().replace('/', ',').split(',')
+  item_seasons = [s.strip() for s in item_seasons if s.strip()]
+  if not item_seasons:
+    return 0.0
+  return 1.0 if any(s in item_seasons for s in seasons) else -1.0
+
+
+def _relevance_scores(items: List[Dict[str, Any]], relevance: Optional[Dict[int, float]]) -> np.ndarray:
+  """未提供检索得分时，按类别内的检索顺序给出 1.0 → 0.5 的递减得分"""
+  if relevance:
+    return np.array([relevance.get(item.get('id'), 0.0) for item in items], dtype=np.float32)
+  scores = np.zeros(len(items), dtype=np.float32)
+  rank_in_category: Dict[str, int] = {}
+  counts: Dict[str, int] = {}
+  for item in items:
+    counts[item.get('category')] = counts.get(item.get('category'), 0) + 1
+  for i, item in enumerate(items):
+    category = item.get('category')
+    rank = rank_in_category.get(category, 0)
+    rank_in_category[category] = rank + 1
+    scores[i] = 1.0 - 0.5 * rank / max(counts[category] - 1, 1)
+  return scores
+
+
+def _color_preference_bonus(color_indices: np.ndarray, color_preference: Optional[str]) -> np.ndarray:
+  if not color_preference:
+    return np.zeros(len(color_indices), dtype=np.float32)
+  preference = color_preference.lower()
+  warm = np.array([name in WARM_HUES or name == 'earth' for name in COLOR_NAMES])
+  cool = np.array([name not in WARM_HUES and name not in ('neutral', 'earth') for name in COLOR_NAMES])
+  neutral = np.array([name == 'neutral' for name in COLOR_NAMES])
+  if preference.startswith('warm'):
+    table = warm
+  elif preference.startswith('cool'):
+    table = cool
+  elif preference.startswith('neutral'):
+    table = neutral
+  else:
+    return np.zeros(len(color_indices), dtype=np.float32)
+  return table[color_indices].astype(np.float32) * 0.3
+
+
+def _slot_options(indices_by_category: Dict[str, List[int]], allow_outer: bool) -> Dict[str, List[tuple]]:
+  """各槽位的可选取值（索引元组；空元组表示该槽位不选）"""
+  inner = [(i,) for i in indices_by_category.get('inner_top', [])]
+  mid = [(i,) for i in indices_by_category.get('mid_top', [])]
+  outer = [(i,) for i in indices_by_category.get('outer_top', [])] if allow_outer else []
+
+  tops = []
+  for combo in itertools.product([()] + inner, [()] + mid, [()] + outer):
+    selected = tuple(i for part in combo for i in part)
+    if selected:
+      tops.append(selected)
+
+  lowers = [(i,) for i in indices_by_category.get('bottom', [])]
+  lowers += [(i,) for i in indices_by_category.get('full_body', [])]
+
+  shoes = [(i,) for i in indices_by_category.get('shoes', [])] or [()]
+  accessories = [()] + [(i,) for i in indices_by_category.get('accessories', [])]
+  return {"tops": tops, "lowers": lowers, "shoes": shoes, "accessories": accessories}
+
+
+def _describe(outfit_items: List[Dict[str, Any]], profile: Dict[str, Any]) -> str:
+  names = [item.get('name') or item.get('name_en') or '单品' for item in outfit_items]
+  description = "、".join(names) + "。" + profile["hint"]
+  if profile["rainy"]:
+    description += "，降水概率较高，记得带伞"
+  return description
+
+
+def _missing_items(indices_by_category: Dict[str, List[int]], profile: Dict[str, Any]) -> List[Dict[str, str]]:
+  missing = []
+  if not any(indices_by_category.get(c) for c in TOP_CATEGORIES) and not indices_by_category.get('full_body'):
+    missing.append({"category": "上衣", "reason": "衣橱中缺少可搭配的上衣，建议添置一件百搭的白色或黑色T恤"})
+  if not indices_by_category.get('bottom') and not indices_by_category.get('full_body'):
+    missing.append({"category": "下装", "reason": "衣橱中缺少下装，建议添置一条深蓝色直筒牛仔裤"})
+  if not indices_by_category.get('shoes'):
+    missing.append({"category": "鞋子", "reason": "衣橱中缺少鞋子，建议添置一双白色休闲运动鞋"})
+  if profile["target_warmth"] >= 5.0 and not indices_by_category.get('outer_top'):
+    missing.append({"category": "外套", "reason": "当前气温偏低，建议添置一件保暖的深色外套"})
+  return missing
+
+
+def recommend_outfits(
+    wardrobe_items: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]] = None,
+    relevance: Optional[Dict[int, float]] = None,
+    max_outfits: int = 3,
+    max_per_category: int = MAX_CANDIDATES_PER_CATEGORY
+) -> Dict[str, Any]:
+  """
+  根据候选衣物直接拼装穿搭，返回结构与 LLM 推荐一致：
+    {"outfits": [{"items": [衣物字典...], "description": "..."}], "missing_items": [...]}
+
+  Args:
+    wardrobe_items: 候选衣物（同类别内按检索相关度排序）
+    relevance: 可选的 {item_id: 检索得分}，未提供时按类别内排序位置计算
+    max_per_category: 每个类别参与组合的候选上限（按单品得分取前几件）
+  """
+  preferences = preferences or {}
+  profile = _weather_profile(weather)
+  items = [item for item in wardrobe_items if item.get('category') in OUTFIT_CATEGORIES]
+
+  indices_by_category: Dict[str, List[int]] = {}
+  for i, item in enumerate(items):
+    indices_by_category.setdefault(item.get('category'), []).append(i)
+
+  missing_items = _missing_items(indices_by_category, profile)
+
+  # ---- 单品得分（向量化） ----
+  color_indices = np.array([_color_index(item) for item in items], dtype=np.int64)
+  warmth = np.array([_item_warmth(item) for item in items], dtype=np.float32)
+  unary = (
+    _relevance_scores(items, relevance)
+    + 0.3 * np.array([_season_fit(item, profile["seasons"]) for item in items], dtype=np.float32)
+    + _color_preference_bonus(color_indices, preferences.get('color_preference'))
+  )
+
+  # 每个类别只保留得分最高的几件参与组合（同分时保持检索顺序）
+  candidates = {
+    category: sorted(indices, key=lambda i: -unary[i])[:max(1, max_per_category)]
+    for category, indices in indices_by_category.items()
+  }
+  slots = _slot_options(candidates, profile["allow_outer"])
+  if not slots["tops"] and not candidates.get('full_body'):
+    return {"outfits": [], "missing_items": missing_items}
+  if not slots["lowers"]:
+    return {"outfits": [], "missing_items": missing_items}
+
+  # ---- 展开所有组合为索引矩阵（-1 表示空位） ----
+  max_slots = 3 + 1 + 1 + 1
+  combos = []
+  core_counts = []
+  for tops, lower, shoes, accessory in itertools.product(
+      slots["tops"] + [()], slots["lowers"], slots["shoes"], slots["accessories"]
+  ):
+    is_full_body = items[lower[0]].get('category') == 'full_body'
+    # 连体衣可以不搭上衣（或只加外套）；下装必须搭至少一件上衣
+    if not tops and not is_full_body:
+      continue
+    if is_full_body and any(items[i].get('category') != 'outer_top' for i in tops):
+      continue
+    selected = list(tops + lower + shoes + accessory)
+    combos.append(selected + [-1] * (max_slots - len(selected)))
+    core_counts.append(len(tops) + 1)
+
+  if not combos:
+    return {"outfits": [], "missing_items": missing_items}
+
+  combo_matrix = np.array(combos, dtype=np.int64)            # (N, S)
+  valid = combo_matrix >= 0
+  safe = np.where(valid, combo_matrix, 0)
+  # 上衣和下装/连体衣为核心单品，鞋子和配饰允许在多套之间复用
+  core = np.arange(max_slots)[None, :] < np.array(core_counts)[:, None]
+
+  unary_total = np.where(valid, unary[safe], 0.0).sum(axis=1)
+  item_counts = valid.sum(axis=1)
+
+  warmth_total = np.where(valid, warmth[safe], 0.0).sum(axis=1)
+  warmth_penalty = np.abs(warmth_total - profile["target_warmth"]) * 0.4
+
+  colors = color_indices[safe]                                # (N, S)
+  pair_scores = COLOR_COMPATIBILITY[colors[:, :, None], colors[:, None, :]]
+  pair_mask = valid[:, :, None] & valid[:, None, :] & ~np.eye(max_slots, dtype=bool)[None]
+  pair_count = np.maximum(pair_mask.sum(axis=(1, 2)), 1)
+  color_harmony = np.where(pair_mask, pair_scores, 0.0).sum(axis=(1, 2)) / pair_count
+
+  # 平均单品得分，避免单纯堆叠件数拉高总分
+  scores = unary_total / item_counts + 1.5 * color_harmony - warmth_penalty
+
+  # ---- 贪心挑选互不重复的高分组合 ----
+  outfits = []
+  used = np.zeros(len(items), dtype=bool)
+  for _ in range(max_outfits):
+    # 与已选穿搭共用的核心单品越多，扣分越多
+    overlap = core & used[safe]
+    penalized = scores - 0.6 * overlap.sum(axis=1)
+    best = int(np.argmax(penalized))
+    selected = [int(i) for i in combo_matrix[best] if i >= 0]
+    outfit_items = [items[i] for i in selected]
+    if any(o["items"] == outfit_items for o in outfits):
+      break
+    outfits.append({"items": outfit_items, "description": _describe(outfit_items, profile)})
+    used[selected] = True
+
+  return {"outfits": outfits, "missing_items": missing_items}
@@ -1,6 +1,9 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator
 from ml.inference import get_recommendations as ml_get_recommendations
 from ml.inference import adjust_recommendations_with_conversation as ml_adjust_recommendations
+from ml.inference import stream_recommendations as ml_stream_recommendations
+from ml.inference import stream_adjust_recommendations_with_conversation as ml_stream_adjust_recommendations
+from ml.inference import release_session_cache as ml_release_session_cache
 
 
 def get_recommendations(
@@ -12,6 +15,15 @@ def get_recommendations(
   return ml_get_recommendations(user, wardrobe, weather, preferences)
 
 
+def stream_recommendations(
+    user: Dict[str, Any],
+    wardrobe: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+  return ml_stream_recommendations(user, wardrobe, weather, preferences)
+
+
 def adjust_recommendations_with_conversation(
     session_id: str,
     adjustment_request: str,
@@ -32,3 +44,29 @@ def adjust_recommendations_with_conversation(
     conversation_history=conversation_history,
     current_outfit=current_outfit
   )
+
+
+def stream_adjust_recommendations_with_conversation(
+    session_id: str,
+    adjustment_request: str,
+    user: Dict[str, Any],
+    wardrobe: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]],
+    conversation_history: List[Dict[str, Any]],
+    current_outfit: List[int]
+) -> Iterator[Dict[str, Any]]:
+  return ml_stream_adjust_recommendations(
+    session_id=session_id,
+    adjustment_request=adjustment_request,
+    user=user,
+    wardrobe=wardrobe,
+    weather=weather,
+    preferences=preferences,
+    conversation_history=conversation_history,
+    current_outfit=current_outfit
+  )
+
+
+def release_session_cache(session_id: str):
+  ml_release_session_cache(session_id)
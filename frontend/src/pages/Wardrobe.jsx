@@ -320,6 +320,9 @@ useEffect(() => {
         if (finalResult.failed.length > 0) {
           const failedNames = finalResult.failed.map(f => f.filename).join(", ");
           setError(`部分失败：${failedNames}`);
+        } else if (finalResult.duplicates && finalResult.duplicates.length > 0) {
+          const duplicateNames = finalResult.duplicates.map(d => d.filename).join(", ");
+          setError(`衣橱中已有相同的衣物，已跳过：${duplicateNames}`);
         }
         
         if (finalResult.success.length > 0) {
@@ -339,6 +342,8 @@ useEffect(() => {
         if (result && result.item_id) {
           uploadedIdsRef.current = [result.item_id];
           setCurrentUploadIds([result.item_id]);
+        } else if (result && result.duplicate) {
+          setError(`衣橱中已有相同的衣物「${result.duplicate.name || result.duplicate.filename}」，已跳过`);
         }
         setUploadProgress({ current: 1, total: 1, tick: Date.now() });
         
@@ -113,6 +113,54 @@ export const adjustOutfit = async (sessionId, adjustmentRequest, userId) => {
   return response.data;
 };
 
+// --- 流式接口（SSE）：每生成完一套穿搭即回调 onEvent，返回 complete 事件 ---
+const readSSE = async (response, onEvent) => {
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`);
+  }
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let completeEvent = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop(); // 保留未完成的行
+
+    for (const line of lines) {
+      if (!line.startsWith('data: ')) continue;
+      const data = JSON.parse(line.substring(6));
+      if (data.type === 'complete') completeEvent = data;
+      if (onEvent) onEvent(data);
+    }
+  }
+  return completeEvent;
+};
+
+export const streamOutfitRecommendations = async (userId, preferences = {}, onEvent, signal) => {
+  const params = new URLSearchParams({ user_id: userId, ...preferences });
+  const response = await fetch(`${API_BASE_URL}/recommend/outfits/stream?${params}`, { signal });
+  return readSSE(response, onEvent);
+};
+
+export const streamAdjustOutfit = async (sessionId, adjustmentRequest, userId, onEvent, signal) => {
+  const response = await fetch(`${API_BASE_URL}/recommend/adjust/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      session_id: sessionId,
+      adjustment_request: adjustmentRequest,
+      user_id: userId
+    }),
+    signal
+  });
+  return readSSE(response, onEvent);
+};
+
 export const selectOutfit = async (sessionId, outfitIndex, outfitData, userId) => {
   const response = await api.post('/recommend/select-outfit', {
     session_id: sessionId,
@@ -1,9 +1,5 @@
 
-import glob
 import os
-from random import randint
-import shutil
-import time
 
 import cv2
 import numpy as np
@@ -40,6 +36,7 @@ class DensePose:
         self.cfg = self.setup_config()
         self.predictor = DefaultPredictor(self.cfg)
         self.predictor.model.to(self.device)
+        self.context = self.create_context(self.cfg)
 
     def setup_config(self):
         opts = ["MODEL.ROI_HEADS.SCORE_THRESH_TEST", str(self.min_score)]
@@ -51,18 +48,7 @@ class DensePose:
         cfg.freeze()
         return cfg
 
-    @staticmethod
-    def _get_input_file_list(input_spec: str):
-        if os.path.isdir(input_spec):
-            file_list = [os.path.join(input_spec, fname) for fname in os.listdir(input_spec)
-                         if os.path.isfile(os.path.join(input_spec, fname))]
-        elif os.path.isfile(input_spec):
-            file_list = [input_spec]
-        else:
-            file_list = glob.glob(input_spec)
-        return file_list
-
-    def create_context(self, cfg, output_path):
+    def create_context(self, cfg):
         vis_specs = self.visualizations
         visualizers = []
         extractors = []
@@ -82,12 +68,11 @@ class DensePose:
         context = {
             "extractor": extractor,
             "visualizer": visualizer,
-            "out_fname": output_path,
             "entry_idx": 0,
         }
         return context
 
-    def execute_on_outputs(self, context, entry, outputs):
+    def execute_on_outputs(self, context, entry, outputs) -> np.ndarray:
         extractor = context["extractor"]
 
         data = extractor(outputs)
@@ -99,59 +84,66 @@ class DensePose:
         x, y, w, h = [int(_) for _ in box[0].cpu().numpy()]
         i_array = data[0].labels[None].cpu().numpy()[0]
         result[y:y + h, x:x + w] = i_array
-        result = Image.fromarray(result)
-        result.save(context["out_fname"])
+        return result
 
-    def __call__(self, image_or_path, resize=512) -> Image.Image:
-        """
-        :param image_or_path: Path of the input image.
-        :param resize: Resize the input image if its max size is larger than this value.
-        :return: Dense pose image.
-        """
-        # random tmp path with timestamp
-        tmp_path = f"./densepose_/tmp/"
-        if not os.path.exists(tmp_path):
-            os.makedirs(tmp_path)
-
-        image_path = os.path.join(tmp_path, f"{int(time.time())}-{self.device}-{randint(0, 100000)}.png")
+    @staticmethod
+    def _to_bgr(image_or_path) -> np.ndarray:
+        """Load a path / PIL image / RGB ndarray (HxWx3 or HxW) as the BGR uint8 array the predictor expects."""
         if isinstance(image_or_path, str):
             assert image_or_path.split(".")[-1] in ["jpg", "png"], "Only support jpg and png images."
-            shutil.copy(image_or_path, image_path)
-        elif isinstance(image_or_path, Image.Image):
-            image_or_path.save(image_path)
+            return read_image(image_or_path, format="BGR")
+        if isinstance(image_or_path, Image.Image):
+            image = np.asarray(image_or_path.convert("RGB"))
+        elif isinstance(image_or_path, np.ndarray):
+            image = image_or_path
+            if image.ndim == 2:
+                image = np.stack([image] * 3, axis=-1)
         else:
-            shutil.rmtree(tmp_path)
-            raise TypeError("image_path must be str or PIL.Image.Image")
-
-        output_path = image_path.replace(".png", "_dense.png").replace(".jpg", "_dense.png")
-        w, h = Image.open(image_path).size
-
-        file_list = self._get_input_file_list(image_path)
-        assert len(file_list), "No input images found!"
-        context = self.create_context(self.cfg, output_path)
-        for file_name in file_list:
-            img = read_image(file_name, format="BGR")  # predictor expects BGR image.
+            raise TypeError("image_or_path must be str, PIL.Image.Image or np.ndarray")
+        return np.ascontiguousarray(image[:, :, ::-1])
+
+    def _predict(self, images):
+        """Run the detector on a list of BGR images in one forward pass (same preprocessing as DefaultPredictor)."""
+        inputs = []
+        for image in images:
+            original_image = image[:, :, ::-1] if self.predictor.input_format == "RGB" else image
+            height, width = original_image.shape[:2]
+            transformed = self.predictor.aug.get_transform(original_image).apply_image(original_image)
+            transformed = torch.as_tensor(transformed.astype("float32").transpose(2, 0, 1))
+            inputs.append({"image": transformed, "height": height, "width": width})
+        with torch.no_grad():
+            return [prediction["instances"] for prediction in self.predictor.model(inputs)]
+
+    def __call__(self, image_or_path, resize=512):
+        """
+        :param image_or_path: Path, PIL image or RGB ndarray of the input image, or a list of them
+            (predicted as one batch).
+        :param resize: Resize the input image if its max size is larger than this value.
+        :return: Dense pose label map (uint8 ndarray of the input size), or a list of them.
+        """
+        batched = isinstance(image_or_path, list)
+        originals = [self._to_bgr(image) for image in (image_or_path if batched else [image_or_path])]
+        images = []
+        for img in originals:
             # resize
             if (_ := max(img.shape)) > resize:
                 scale = resize / _
                 img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
-
-            with torch.no_grad():
-                outputs = self.predictor(img)["instances"]
-                try:
-                    self.execute_on_outputs(context, {"file_name": file_name, "image": img}, outputs)
-                except Exception as e:
-                    null_gray = Image.new('L', (1, 1))
-                    null_gray.save(output_path)
-
-        dense_gray = Image.open(output_path).convert("L")
-        dense_gray = dense_gray.resize((w, h), Image.NEAREST)
-        # remove image_path and output_path
-        os.remove(image_path)
-        os.remove(output_path)
-
-
-        return dense_gray
+            images.append(img)
+
+        results = []
+        for original, img, outputs in zip(originals, images, self._predict(images)):
+            h, w = original.shape[:2]
+            try:
+                dense = self.execute_on_outputs(self.context, {"image": img}, outputs)
+            except Exception as e:
+                # No person detected
+                results.append(np.zeros((h, w), dtype=np.uint8))
+                continue
+            dense = Image.fromarray(dense).resize((w, h), Image.NEAREST)
+            results.append(np.asarray(dense))
+
+        return results if batched else results[0]
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
 from model.SCHP import networks
-from model.SCHP.utils.transforms import get_affine_transform, transform_logits
+from model.SCHP.utils.transforms import get_affine_transform, transform_logits, transform_logits_argmax
 
 from collections import OrderedDict
 import torch
@@ -53,7 +53,7 @@ dataset_settings = {
 }
 
 class SCHP:
-    def __init__(self, ckpt_path, device):
+    def __init__(self, ckpt_path, device, device_warp=True):
         dataset_type = None
         if 'lip' in ckpt_path:
             dataset_type = 'lip'
@@ -63,6 +63,8 @@ class SCHP:
             dataset_type = 'pascal'
         assert dataset_type is not None, 'Dataset type not found in checkpoint path'
         self.device = device
+        # Warp logits back to image size and take the argmax on the model device (False: per-channel cv2 on CPU)
+        self.device_warp = device_warp
         self.num_classes = dataset_settings[dataset_type]['num_classes']
         self.input_size = dataset_settings[dataset_type]['input_size']
         self.aspect_ratio = self.input_size[1] * 1.0 / self.input_size[0]
@@ -149,6 +151,7 @@ class SCHP:
         return input, meta
 
 
+    @torch.no_grad()
     def __call__(self, image_or_path):
         if isinstance(image_or_path, list):
             image_list = []
@@ -165,13 +168,17 @@ class SCHP:
         output = self.model(image)
         # upsample_outputs = self.upsample(output[0][-1])
         upsample_outputs = self.upsample(output)
-        upsample_outputs = upsample_outputs.permute(0, 2, 3, 1)  # BCHW -> BHWC
 
         output_img_list = []
         for upsample_output, meta in zip(upsample_outputs, meta_list):
             c, s, w, h = meta['center'], meta['scale'], meta['width'], meta['height']
-            logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=self.input_size)
-            parsing_result = np.argmax(logits_result, axis=2)
+            if self.device_warp:
+                # Only the uint8 label map leaves the device
+                parsing_result = transform_logits_argmax(upsample_output, c, s, w, h, input_size=self.input_size).cpu().numpy()
+            else:
+                upsample_output = upsample_output.permute(1, 2, 0)  # CHW -> HWC
+                logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=self.input_size)
+                parsing_result = np.argmax(logits_result, axis=2)
             output_img = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
             output_img.putpalette(self.palette)
             output_img_list.append(output_img)
@@ -96,6 +96,31 @@ def transform_logits(logits, center, scale, width, height, input_size):
 
     return target_logits
 
+def transform_logits_argmax(logits, center, scale, width, height, input_size):
+    """
+    Device-side equivalent of `transform_logits` followed by argmax over classes.
+
+    logits: (C, H, W) tensor at input_size, on any device. All channels are warped back to
+    the (height, width) image in a single grid_sample call (bilinear, zero border, like the
+    cv2 path) and the argmax is taken on the same device. Returns a (height, width) uint8 tensor.
+    """
+    # warpAffine with the inverse transform samples the source at forward(x, y),
+    # i.e. the image -> input_size mapping
+    trans = get_affine_transform(center, scale, 0, input_size)
+    trans = torch.as_tensor(trans, dtype=torch.float32, device=logits.device)
+    ys, xs = torch.meshgrid(
+        torch.arange(int(height), dtype=torch.float32, device=logits.device),
+        torch.arange(int(width), dtype=torch.float32, device=logits.device),
+        indexing='ij')
+    src_x = trans[0, 0] * xs + trans[0, 1] * ys + trans[0, 2]
+    src_y = trans[1, 0] * xs + trans[1, 1] * ys + trans[1, 2]
+    # align_corners=True: -1 / 1 are the centers of the first / last source pixel, as in cv2
+    in_h, in_w = logits.shape[-2:]
+    grid = torch.stack([src_x * 2 / (in_w - 1) - 1, src_y * 2 / (in_h - 1) - 1], dim=-1)
+    warped = torch.nn.functional.grid_sample(
+        logits[None].float(), grid[None], mode='bilinear', padding_mode='zeros', align_corners=True)
+    return warped[0].argmax(dim=0).to(torch.uint8)
+
 
 def get_affine_transform(center,
                          scale,
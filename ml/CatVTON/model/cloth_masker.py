@@ -1,6 +1,9 @@
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 from PIL import Image
-from typing import Union
+from typing import Dict, List, Optional, Union
 import numpy as np
 import cv2
 from diffusers.image_processor import VaeImageProcessor
@@ -152,12 +155,63 @@ def hull_mask(mask_area: np.ndarray):
     return hull_mask
     
 
+def image_hash(image: Image.Image) -> str:
+    """Content hash of the decoded pixels (same photo -> same key regardless of file encoding)."""
+    digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    return digest.hexdigest()
+
+
+class PreprocessCache:
+    """
+    LRU cache of person-image parses keyed by image hash.
+    Each entry holds the densepose / schp_atr / schp_lip label maps as uint8 arrays
+    (about 3 bytes per pixel in total, ~2.4 MB at 768x1024).
+    """
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: Dict[str, np.ndarray]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes': sum(array.nbytes for entry in self._entries.values() for array in entry.values()),
+            }
+
+
 class AutoMasker:
     def __init__(
         self, 
         densepose_ckpt='./Models/DensePose', 
         schp_ckpt='./Models/SCHP', 
-        device='cuda'):
+        device='cuda',
+        cache_size=0):
         np.random.seed(0)
         torch.manual_seed(0)
         torch.cuda.manual_seed(0)
@@ -167,6 +221,8 @@ class AutoMasker:
         self.schp_processor_lip = SCHP(ckpt_path=os.path.join(schp_ckpt, 'exp-schp-201908261155-lip.pth'), device=device)
         
         self.mask_processor = VaeImageProcessor(vae_scale_factor=8, do_normalize=False, do_binarize=True, do_convert_grayscale=True)
+        # Parses of recently seen person images (disabled when cache_size == 0)
+        self.cache = PreprocessCache(cache_size)
 
     def process_densepose(self, image_or_path):
         return self.densepose_processor(image_or_path, resize=1024)
@@ -183,17 +239,57 @@ class AutoMasker:
             'schp_atr': self.schp_processor_atr(image_or_path),
             'schp_lip': self.schp_processor_lip(image_or_path)
         }
+
+    def parse(self, image_or_path) -> Dict[str, np.ndarray]:
+        """
+        DensePose + SCHP (ATR, LIP) label maps as uint8 arrays, served from the cache
+        when the same person image was parsed before.
+        """
+        return self.parse_batch([image_or_path])[0]
+
+    def parse_batch(self, images: List[Union[str, Image.Image]]) -> List[Dict[str, np.ndarray]]:
+        """Parse several person images; those missing from the cache go through each model as one batch."""
+        use_cache = self.cache.max_entries > 0
+        # hashing also pays off without the cache: a batch often repeats the same person photo
+        hashed = use_cache or len(images) > 1
+        keys = [
+            image_hash(Image.open(image) if isinstance(image, str) else image) if hashed else None
+            for image in images
+        ]
+        entries = [self.cache.get(key) if use_cache else None for key in keys]
+        # cache misses grouped by key, so each distinct image is parsed once
+        missing: Dict[Union[str, int], List[int]] = {}
+        for i, entry in enumerate(entries):
+            if entry is None:
+                missing.setdefault(keys[i] if hashed else i, []).append(i)
+        if missing:
+            groups = list(missing.values())
+            results = self.preprocess_image([images[group[0]] for group in groups])
+            # SCHP returns a bare image for a single input
+            results = {name: result if isinstance(result, list) else [result] for name, result in results.items()}
+            for n, group in enumerate(groups):
+                entry = {name: np.array(result[n], dtype=np.uint8) for name, result in results.items()}
+                for array in entry.values():
+                    array.setflags(write=False)  # shared between calls, never modified in place
+                if use_cache:
+                    self.cache.put(keys[group[0]], entry)
+                for i in group:
+                    entries[i] = entry
+        return entries
     
     @staticmethod
     def cloth_agnostic_mask(
-        densepose_mask: Image.Image,
-        schp_lip_mask: Image.Image,
-        schp_atr_mask: Image.Image,
+        densepose_mask: Union[Image.Image, np.ndarray],
+        schp_lip_mask: Union[Image.Image, np.ndarray],
+        schp_atr_mask: Union[Image.Image, np.ndarray],
         part: str='overall',
         **kwargs
     ):
         assert part in ['upper', 'lower', 'overall', 'inner', 'outer'], f"part should be one of ['upper', 'lower', 'overall', 'inner', 'outer'], but got {part}"
-        w, h = densepose_mask.size
+        if isinstance(densepose_mask, np.ndarray):
+            h, w = densepose_mask.shape[:2]
+        else:
+            w, h = densepose_mask.size
         
         dilate_kernel = max(w, h) // 250
         dilate_kernel = dilate_kernel if dilate_kernel % 2 == 1 else dilate_kernel + 1
@@ -202,9 +298,9 @@ class AutoMasker:
         kernal_size = max(w, h) // 25
         kernal_size = kernal_size if kernal_size % 2 == 1 else kernal_size + 1
         
-        densepose_mask = np.array(densepose_mask)
-        schp_lip_mask = np.array(schp_lip_mask)
-        schp_atr_mask = np.array(schp_atr_mask)
+        densepose_mask = np.asarray(densepose_mask)
+        schp_lip_mask = np.asarray(schp_lip_mask)
+        schp_atr_mask = np.asarray(schp_atr_mask)
         
         # Strong Protect Area (Hands, Face, Accessory, Feet)
         hands_protect_area = part_mask_of(['hands', 'feet'], densepose_mask, DENSE_INDEX_MAP)
@@ -255,18 +351,22 @@ class AutoMasker:
         mask_type: str = "upper",
     ):
         assert mask_type in ['upper', 'lower', 'overall', 'inner', 'outer'], f"mask_type should be one of ['upper', 'lower', 'overall', 'inner', 'outer'], but got {mask_type}"
-        preprocess_results = self.preprocess_image(image)
+        parse = self.parse(image)
         mask = self.cloth_agnostic_mask(
-            preprocess_results['densepose'], 
-            preprocess_results['schp_lip'], 
-            preprocess_results['schp_atr'], 
+            parse['densepose'], 
+            parse['schp_lip'], 
+            parse['schp_atr'], 
             part=mask_type,
         )
+        schp_lip = Image.fromarray(parse['schp_lip'])
+        schp_lip.putpalette(self.schp_processor_lip.palette)
+        schp_atr = Image.fromarray(parse['schp_atr'])
+        schp_atr.putpalette(self.schp_processor_atr.palette)
         return {
             'mask': mask,
-            'densepose': preprocess_results['densepose'],
-            'schp_lip': preprocess_results['schp_lip'],
-            'schp_atr': preprocess_results['schp_atr']
+            'densepose': Image.fromarray(parse['densepose']),
+            'schp_lip': schp_lip,
+            'schp_atr': schp_atr
         }
 
 
@@ -1,6 +1,6 @@
 import inspect
 import os
-from typing import Union
+from typing import List, Union
 
 import PIL
 import numpy as np
@@ -81,6 +81,12 @@ class CatVTONPipeline:
     def check_inputs(self, image, condition_image, mask, width, height):
         if isinstance(image, torch.Tensor) and isinstance(condition_image, torch.Tensor) and isinstance(mask, torch.Tensor):
             return image, condition_image, mask
+        if isinstance(image, (list, tuple)):
+            # Batch of (person, garment, mask) triples
+            assert len(image) == len(condition_image) == len(mask), "image, condition_image and mask must have the same batch size"
+            checked = [self.check_inputs(*inputs, width, height) for inputs in zip(image, condition_image, mask)]
+            image, condition_image, mask = (list(column) for column in zip(*checked))
+            return image, condition_image, mask
         assert image.size == mask.size, "Image and mask must have the same size"
         image = resize_and_crop(image, (width, height))
         mask = resize_and_crop(mask, (width, height))
@@ -111,17 +117,28 @@ class CatVTONPipeline:
     @torch.no_grad()
     def __call__(
         self, 
-        image: Union[PIL.Image.Image, torch.Tensor],
-        condition_image: Union[PIL.Image.Image, torch.Tensor],
-        mask: Union[PIL.Image.Image, torch.Tensor],
+        image: Union[PIL.Image.Image, List[PIL.Image.Image], torch.Tensor],
+        condition_image: Union[PIL.Image.Image, List[PIL.Image.Image], torch.Tensor],
+        mask: Union[PIL.Image.Image, List[PIL.Image.Image], torch.Tensor],
         num_inference_steps: int = 50,
         guidance_scale: float = 2.5,
         height: int = 1024,
         width: int = 768,
         generator=None,
         eta=1.0,
+        callback=None,
+        callback_steps: int = 1,
         **kwargs
     ):
+        """
+        image / condition_image / mask may be lists of equal length to run a batch of try-ons
+        with one UNet forward per timestep; `generator` may then be a list with one generator
+        per sample, which makes each sample reproduce its single-image result.
+        Returns one PIL image per sample.
+
+        callback(step, timestep, latents) is called every `callback_steps` denoising steps
+        (step counts from 0); raising inside the callback aborts the run.
+        """
         concat_dim = -2  # FIXME: y axis concat
         # Prepare inputs to Tensor
         image, condition_image, mask = self.check_inputs(image, condition_image, mask, width, height)
@@ -138,6 +155,9 @@ class CatVTONPipeline:
         # Concatenate latents
         masked_latent_concat = torch.cat([masked_latent, condition_latent], dim=concat_dim)
         mask_latent_concat = torch.cat([mask_latent, torch.zeros_like(mask_latent)], dim=concat_dim)
+        batch_size = masked_latent.shape[0]
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(f"Got {len(generator)} generators for a batch of {batch_size} samples")
         # Prepare noise
         latents = randn_tensor(
             masked_latent_concat.shape,
@@ -192,6 +212,8 @@ class CatVTONPipeline:
                     and (i + 1) % self.noise_scheduler.order == 0
                 ):
                     progress_bar.update()
+                    if callback is not None and i % callback_steps == 0:
+                        callback(i, t, latents)
 
         # Decode the final latents
         latents = latents.split(latents.shape[concat_dim] // 2, dim=concat_dim)[0]
@@ -256,6 +278,9 @@ class CatVTONPix2PixPipeline(CatVTONPipeline):
         del image, condition_image
         # Concatenate latents
         condition_latent_concat = torch.cat([image_latent, condition_latent], dim=concat_dim)
+        batch_size = masked_latent.shape[0]
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(f"Got {len(generator)} generators for a batch of {batch_size} samples")
         # Prepare noise
         latents = randn_tensor(
             condition_latent_concat.shape,
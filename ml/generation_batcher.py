@@ -0,0 +1,187 @@
+"""
+跨请求微批处理调度器
+
+所有 FastAPI 工作线程共享同一个 FashionQwenModel 单例，原先每次 generate 只处理一条 prompt。
+GenerationBatcher 在单例前面收集几毫秒内到达的请求，按生成参数分组后合并为一个左填充批次，
+只调用一次 generate，再把各自解码后的输出交还给调用方。
+"""
+import queue
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+
+@dataclass
+class GenerationRequest:
+  messages: List[Dict[str, Any]]
+  generate_kwargs: Dict[str, Any]
+  enqueued_at: float = field(default_factory=time.perf_counter)
+  done: threading.Event = field(default_factory=threading.Event)
+  output: Optional[str] = None
+  error: Optional[BaseException] = None
+
+  def batch_key(self) -> Tuple:
+    """生成参数完全相同的请求才能合并到同一个批次"""
+    return tuple(sorted(self.generate_kwargs.items()))
+
+
+class GenerationBatcher:
+  """微批处理调度器（单工作线程，串行执行 generate）"""
+
+  def __init__(
+      self,
+      generate_fn: Callable[..., List[str]],
+      max_batch_size: int = 4,
+      max_wait_ms: float = 10.0,
+      name: str = "qwen-batcher"
+  ):
+    """
+    Args:
+      generate_fn: generate_fn(messages_batch, **generate_kwargs) -> 每条请求的解码文本
+      max_batch_size: 单个批次最多合并的请求数
+      max_wait_ms: 第一个请求到达后最多等待多久以凑批
+    """
+    self._generate_fn = generate_fn
+    self.max_batch_size = max(1, max_batch_size)
+    self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+    self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+    # 参数不同、暂时无法并入当前批次的请求，留给下一轮
+    self._backlog: Deque[GenerationRequest] = deque()
+
+    self._stats_lock = threading.Lock()
+    self._total_requests = 0
+    self._total_batches = 0
+    self._failed_batches = 0
+    self._batch_sizes: Counter = Counter()
+    self._queue_wait_total = 0.0
+    self._queue_wait_max = 0.0
+    self._generate_time_total = 0.0
+    self._recent_waits: Deque[float] = deque(maxlen=1000)
+
+    self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+    self._worker.start()
+
+  def submit(self, messages: List[Dict[str, Any]], **generate_kwargs) -> str:
+    """提交一条生成请求并阻塞等待结果"""
+    request = GenerationRequest(messages=messages, generate_kwargs=generate_kwargs)
+    self._queue.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.output
+
+  def submit_many(self, messages_batch: List[List[Dict[str, Any]]], **generate_kwargs) -> List[str]:
+    """一次提交多条请求（例如同一批上传的多张衣物图片），同时入队以便合并进同一批次"""
+    requests = [
+      GenerationRequest(messages=messages, generate_kwargs=generate_kwargs)
+      for messages in messages_batch
+    ]
+    for request in requests:
+      self._queue.put(request)
+    for request in requests:
+      request.done.wait()
+    for request in requests:
+      if request.error is not None:
+        raise request.error
+    return [request.output for request in requests]
+
+  def _collect_batch(self) -> List[GenerationRequest]:
+    first = self._backlog.popleft() if self._backlog else self._queue.get()
+    batch = [first]
+    key = first.batch_key()
+
+    # 先从积压队列中挑出参数相同的请求
+    remaining: Deque[GenerationRequest] = deque()
+    while self._backlog and len(batch) < self.max_batch_size:
+      request = self._backlog.popleft()
+      if request.batch_key() == key:
+        batch.append(request)
+      else:
+        remaining.append(request)
+    remaining.extend(self._backlog)
+    self._backlog = remaining
+
+    # 以第一个请求的入队时间计算截止时间：工作线程繁忙时不再额外等待，直接合并已到达的请求
+    deadline = first.enqueued_at + self.max_wait
+    while len(batch) < self.max_batch_size:
+      try:
+        timeout = deadline - time.perf_counter()
+        if timeout > 0:
+          request = self._queue.get(timeout=timeout)
+        else:
+          request = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      if request.batch_key() == key:
+        batch.append(request)
+      else:
+        self._backlog.append(request)
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._collect_batch()
+      started_at = time.perf_counter()
+      waits = [started_at - request.enqueued_at for request in batch]
+
+      failed = False
+      try:
+        outputs = self._generate_fn(
+          [request.messages for request in batch],
+          **batch[0].generate_kwargs
+        )
+        for request, output in zip(batch, outputs):
+          request.output = output
+      except BaseException as e:
+        failed = True
+        for request in batch:
+          request.error = e
+      finally:
+        elapsed = time.perf_counter() - started_at
+        self._record(len(batch), waits, elapsed, failed)
+        for request in batch:
+          request.done.set()
+
+  def _record(self, batch_size: int, waits: List[float], elapsed: float, failed: bool):
+    with self._stats_lock:
+      self._total_batches += 1
+      self._total_requests += batch_size
+      self._batch_sizes[batch_size] += 1
+      self._generate_time_total += elapsed
+      if failed:
+        self._failed_batches += 1
+      for wait in waits:
+        self._queue_wait_total += wait
+        self._queue_wait_max = max(self._queue_wait_max, wait)
+        self._recent_waits.append(wait)
+
+  def stats(self) -> Dict[str, Any]:
+    """批大小与排队等待指标，用于在吞吐与延迟之间调参"""
+    with self._stats_lock:
+      recent = sorted(self._recent_waits)
+      total_requests = self._total_requests
+      total_batches = self._total_batches
+
+      def percentile(p: float) -> float:
+        if not recent:
+          return 0.0
+        return recent[min(len(recent) - 1, int(p * len(recent)))] * 1000
+
+      return {
+        "max_batch_size": self.max_batch_size,
+        "max_wait_ms": self.max_wait * 1000,
+        "pending": self._queue.qsize() + len(self._backlog),
+        "total_requests": total_requests,
+        "total_batches": total_batches,
+        "failed_batches": self._failed_batches,
+        "avg_batch_size": total_requests / total_batches if total_batches else 0.0,
+        "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+        "avg_queue_wait_ms": self._queue_wait_total / total_requests * 1000 if total_requests else 0.0,
+        "p50_queue_wait_ms": percentile(0.5),
+        "p95_queue_wait_ms": percentile(0.95),
+        "max_queue_wait_ms": self._queue_wait_max * 1000,
+        "avg_generate_ms": self._generate_time_total / total_batches * 1000 if total_batches else 0.0,
+      }
@@ -1,17 +1,230 @@
+import hashlib
 import json
 import os
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator
 from pathlib import Path
 import threading
+from dataclasses import dataclass
 
 # 设置 HuggingFace 镜像加速
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 
 import torch
-from transformers import AutoModelForImageTextToText, AutoProcessor
+from transformers import AutoModelForImageTextToText, AutoProcessor, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 from qwen_vl_utils import process_vision_info
 from PIL import Image
 
+from ml.generation_batcher import GenerationBatcher
+from ml.json_stream import OutfitStreamParser
+from ml.json_constraint import JsonConstraintFactory, json_array, json_integer, json_object, json_string
+from ml.prefix_cache import PrefixHint, PrefixKVCache, SessionKVCache, common_prefixes
+
+
+# 衣物属性分析 prompt
+CLOTHING_ANALYSIS_PROMPT = """Analyze this clothing item and return JSON with both Chinese and English descriptions.
+
+RULES:
+1. name: Output in CHINESE (中文) - 颜色+材质+类型 (e.g., "黑色棉质T恤")
+2. name_en: Output in ENGLISH - color+material+type (e.g., "Black Cotton T-shirt")
+3. color: Output in CHINESE (中文) - 主色调中文名 (e.g., "黑色", "白色")
+4. color_en: Output in ENGLISH - main color (e.g., "black", "white")
+5. material: Output in CHINESE (中文) - 面料中文名 (e.g., "棉", "牛仔布")
+6. material_en: Output in ENGLISH - fabric type (e.g., "cotton", "denim")
+7. category: Classify tops by SLEEVES FIRST, then by structure:
+   
+   DECISION TREE:
+   Step 1 - Check sleeves:
+   - NO sleeves (tank/camisole/vest) → inner_top
+   - HAS sleeves → Continue to Step 2
+   
+   Step 2 - Check structure:
+   - Thin/casual (T-shirt, thin top) → inner_top
+   - Structured/standalone (shirt, sweater, polo, hoodie) → mid_top
+   - Outerwear (jacket, coat, blazer) → outer_top
+   
+   EXAMPLES:
+   - inner_top: T-shirt, tank top, camisole, sleeveless shirt
+   - mid_top: Dress shirt, sweater, polo, hoodie, cardigan
+   - outer_top: Jacket, coat, blazer, windbreaker
+   
+   OTHER CATEGORIES:
+   - underwear: Undergarments (bra, underwear)
+   - bottom: Pants, shorts, skirts
+   - full_body: One-piece garments (dress, jumpsuit, romper)
+   - shoes: All footwear
+   - socks: All socks and hosiery
+   - accessories: Bags, hats, scarves, gloves, jewelry
+
+8. season: Select ALL applicable from [spring, summer, fall, winter]
+   - Thin/short items: [spring, summer, fall]
+   - Thick/warm items: [fall, winter]
+   - Mid-weight: [spring, fall, winter] or [spring, summer, fall]
+
+JSON:
+{
+  "name": "黑色棉质T恤",
+  "name_en": "Black Cotton T-shirt",
+  "category": "inner_top",
+  "color": "黑色",
+  "color_en": "black",
+  "season": ["spring", "summer", "fall"],
+  "material": "棉",
+  "material_en": "cotton"
+}"""
+
+ANALYSIS_GENERATE_KWARGS = {
+  "max_new_tokens": 256,
+  "temperature": 0.3,
+  "top_p": 0.9,
+}
+
+# 启动预热时生成的 token 数（只为触发一次完整的 prefill + decode，不需要完整输出）
+WARMUP_MAX_NEW_TOKENS = 8
+
+# prompt 或生成参数变化时版本号随之变化，属性缓存中的旧结果自动失效
+ANALYSIS_PROMPT_VERSION = hashlib.sha1(
+  (CLOTHING_ANALYSIS_PROMPT + json.dumps(ANALYSIS_GENERATE_KWARGS, sort_keys=True)).encode("utf-8")
+).hexdigest()[:12]
+
+RECOMMENDATION_GENERATE_KWARGS = {
+  "max_new_tokens": 1024,
+  "temperature": 1.0,
+  "top_p": 0.9,
+  "do_sample": True,
+}
+
+ADJUSTMENT_GENERATE_KWARGS = {
+  "max_new_tokens": 1024,
+  "temperature": 0.8,
+  "top_p": 0.9,
+  "do_sample": True,
+}
+
+CLOTHING_CATEGORIES = [
+  'inner_top', 'mid_top', 'outer_top', 'bottom', 'full_body',
+  'shoes', 'socks', 'accessories', 'underwear'
+]
+
+# 衣物属性输出的 JSON schema（键顺序与 prompt 示例一致），用于约束解码
+ATTRIBUTE_SCHEMA = json_object(
+  ("name", json_string(max_length=96)),
+  ("name_en", json_string(max_length=96)),
+  ("category", json_string(enum=CLOTHING_CATEGORIES)),
+  ("color", json_string(max_length=48)),
+  ("color_en", json_string(max_length=48)),
+  ("season", json_array(json_string(enum=["spring", "summer", "fall", "winter"]), 1, 4)),
+  ("material", json_string(max_length=48)),
+  ("material_en", json_string(max_length=48)),
+)
+
+
+def outfits_schema(num_items: int, max_outfits: int) -> tuple:
+  """推荐/调整输出的 JSON schema：衣物编号限定在 1..num_items"""
+  return json_object(
+    ("outfits", json_array(
+      json_object(
+        ("items", json_array(json_integer(1, num_items), 1, 8)),
+        ("description", json_string(max_length=600)),
+      ),
+      1, max_outfits
+    )),
+    ("missing_items", json_array(
+      json_object(
+        ("category", json_string(max_length=60)),
+        ("reason", json_string(max_length=300)),
+      ),
+      0, 5
+    )),
+  )
+
+
+# 推荐/调整 prompt 的固定部分放在最前面，衣物列表其次，每次都变化的用户/天气/请求放在最后，
+# 这样前两段的 KV 可以被前缀缓存复用（见 ml/prefix_cache.py）。
+# 各段以空行结尾、下一段以字母开头，保证分段边界恰好落在 token 边界上。
+RECOMMENDATION_INSTRUCTIONS = """Create outfit recommendations from the wardrobe below, based on the user, weather and preferences given after it.
+
+RULES:
+1. Generate 2-3 complete outfits
+2. Use item numbers from wardrobe list ONLY
+3. SELECTION RULES:
+   - TOPS: Must include at least one (can select multiple from different layers)
+   - BOTTOM: Exactly one if available
+   - SHOES: Exactly one if available
+   - ACCESSORIES: Optional
+   - FULL BODY: Replaces top and bottom
+4. For missing_items: Suggest SPECIFIC items with colors and styles, NOT generic categories
+
+JSON:
+{
+  "outfits": [
+    {
+      "items": [1, 3, 5, 8],
+      "description": "<outfit description in Chinese>"
+    }
+  ],
+  "missing_items": [
+    {
+      "category": "<item category in Chinese>",
+      "reason": "<reason in Chinese>"
+    }
+  ]
+}
+
+"""
+
+ADJUSTMENT_INSTRUCTIONS = """Adjust the outfit recommendation based on user feedback. The wardrobe comes first; the user, weather, current outfit, conversation and request follow it.
+
+RULES:
+1. If user changes ONE category, keep others from current outfit
+2. ALWAYS include: BOTTOM or FULL_BODY, SHOES, at least one TOP
+3. Return 1-2 outfits, description in Chinese
+4. Use item numbers from wardrobe list ONLY
+
+JSON:
+{
+  "outfits": [
+    {
+      "items": [1, 3, 5, 8],
+      "description": "<Chinese description>"
+    }
+  ],
+  "missing_items": []
+}
+
+"""
+
+# 衣物列表中的类别顺序和标签
+WARDROBE_CATEGORY_ORDER = [
+  ('inner_top', 'INNER LAYER'),
+  ('mid_top', 'MID LAYER'),
+  ('outer_top', 'OUTER LAYER'),
+  ('bottom', 'BOTTOM'),
+  ('full_body', 'FULL BODY'),
+  ('shoes', 'SHOES'),
+  ('socks', 'SOCKS'),
+  ('accessories', 'ACCESSORIES'),
+  ('underwear', 'UNDERWEAR')
+]
+
+
+@dataclass
+class OutfitPrompt:
+  """推荐/调整 prompt：messages 送入模型，items 为 prompt 中编号 1..N 对应的衣物"""
+  messages: List[Dict[str, Any]]
+  items: List[Dict[str, Any]]
+  prefix_texts: tuple = ()
+  json_schema: Optional[tuple] = None
+
+
+class StopOnEvent(StoppingCriteria):
+  """事件置位后停止整批生成（流式请求的客户端断开时，不再占用调度器一路解码到 max_new_tokens）"""
+
+  def __init__(self, event: threading.Event):
+    self.event = event
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+    return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
 
 class FashionQwenModel:
   def __init__(self, model_name: str = None):
@@ -70,6 +283,13 @@ class FashionQwenModel:
       if self.device == "cpu":
         self.model = self.model.to(self.device)
       
+      # 批量生成时必须左填充，保证每条序列的生成位置对齐
+      self.processor.tokenizer.padding_side = "left"
+      
+      # 前缀缓存键中的模型版本：snapshot 提交哈希（或目录名）+ 精度
+      revision = getattr(self.model.config, "_commit_hash", None) or Path(model_name).name
+      self.model_revision = f"{revision}:{self.model.dtype}"
+      
       print("✅ 模型加载成功！")
       
     except Exception as e:
@@ -87,80 +307,57 @@ class FashionQwenModel:
       print(f"      export QWEN_MODEL_PATH=/root/qwen_model")
       raise
 
+    # 跨请求微批处理：所有调用方共享同一个调度线程
+    self.batcher = GenerationBatcher(
+      self._generate_batch,
+      max_batch_size=int(os.getenv('QWEN_BATCH_SIZE', '4')),
+      max_wait_ms=float(os.getenv('QWEN_BATCH_WAIT_MS', '10')),
+    )
 
+    # 按 JSON schema 约束解码（QWEN_JSON_CONSTRAINED=0 关闭，恢复自由生成 + 事后解析）
+    self.json_constraints = None
+    if os.getenv('QWEN_JSON_CONSTRAINED', '1') != '0':
+      self.json_constraints = JsonConstraintFactory(self.processor.tokenizer)
+
+    # 推荐 prompt 的 KV 前缀缓存（QWEN_PREFIX_CACHE=0 关闭）
+    self.prefix_cache = None
+    if os.getenv('QWEN_PREFIX_CACHE', '1') != '0':
+      self.prefix_cache = PrefixKVCache(
+        self.model_revision,
+        max_entries=int(os.getenv('QWEN_PREFIX_CACHE_ENTRIES', '32')),
+        max_bytes=int(os.getenv('QWEN_PREFIX_CACHE_MB', '2048')) * 1024 * 1024,
+      )
 
-  def analyze_clothing_image(self, image_path: str) -> Dict[str, Any]:
-    messages = [
-      {
-        "role": "user",
-        "content": [
-          {
-            "type": "image",
-            "image": image_path,
-          },
-          {
-            "type": "text",
-            "text": """Analyze this clothing item and return JSON with both Chinese and English descriptions.
-
-RULES:
-1. name: Output in CHINESE (中文) - 颜色+材质+类型 (e.g., "黑色棉质T恤")
-2. name_en: Output in ENGLISH - color+material+type (e.g., "Black Cotton T-shirt")
-3. color: Output in CHINESE (中文) - 主色调中文名 (e.g., "黑色", "白色")
-4. color_en: Output in ENGLISH - main color (e.g., "black", "white")
-5. material: Output in CHINESE (中文) - 面料中文名 (e.g., "棉", "牛仔布")
-6. material_en: Output in ENGLISH - fabric type (e.g., "cotton", "denim")
-7. category: Classify tops by SLEEVES FIRST, then by structure:
-   
-   DECISION TREE:
-   Step 1 - Check sleeves:
-   - NO sleeves (tank/camisole/vest) → inner_top
-   - HAS sleeves → Continue to Step 2
-   
-   Step 2 - Check structure:
-   - Thin/casual (T-shirt, thin top) → inner_top
-   - Structured/standalone (shirt, sweater, polo, hoodie) → mid_top
-   - Outerwear (jacket, coat, blazer) → outer_top
-   
-   EXAMPLES:
-   - inner_top: T-shirt, tank top, camisole, sleeveless shirt
-   - mid_top: Dress shirt, sweater, polo, hoodie, cardigan
-   - outer_top: Jacket, coat, blazer, windbreaker
-   
-   OTHER CATEGORIES:
-   - underwear: Undergarments (bra, underwear)
-   - bottom: Pants, shorts, skirts
-   - full_body: One-piece garments (dress, jumpsuit, romper)
-   - shoes: All footwear
-   - socks: All socks and hosiery
-   - accessories: Bags, hats, scarves, gloves, jewelry
+    # 多轮调整的会话级 KV 缓存（QWEN_SESSION_CACHE=0 关闭）
+    self.session_cache = None
+    if os.getenv('QWEN_SESSION_CACHE', '1') != '0':
+      self.session_cache = SessionKVCache(
+        max_sessions=int(os.getenv('QWEN_SESSION_CACHE_SESSIONS', '64')),
+        max_bytes=int(os.getenv('QWEN_SESSION_CACHE_MB', '1024')) * 1024 * 1024,
+      )
 
-8. season: Select ALL applicable from [spring, summer, fall, winter]
-   - Thin/short items: [spring, summer, fall]
-   - Thick/warm items: [fall, winter]
-   - Mid-weight: [spring, fall, winter] or [spring, summer, fall]
+  def _generate_batch(self, messages_batch: List[List[Dict[str, Any]]], **generate_kwargs) -> List[str]:
+    """对一批对话执行一次左填充的 generate，返回每条对话各自的解码文本"""
+    prefix_hint = generate_kwargs.pop("prefix_hint", None)
+    json_schema = generate_kwargs.pop("json_schema", None)
+    stop_event = generate_kwargs.pop("stop_event", None)
+    if json_schema is not None and self.json_constraints is not None:
+      generate_kwargs.update(self.json_constraints.generate_kwargs(json_schema, len(messages_batch)))
+    if stop_event is not None:
+      generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+        list(generate_kwargs.get("stopping_criteria") or []) + [StopOnEvent(stop_event)]
+      )
+    # 带前缀提示的请求按对象身份分组，总是单独成批
+    if prefix_hint is not None and len(messages_batch) == 1:
+      return [self._generate_with_prefix_cache(messages_batch[0], prefix_hint, **generate_kwargs)]
 
-JSON:
-{
-  "name": "黑色棉质T恤",
-  "name_en": "Black Cotton T-shirt",
-  "category": "inner_top",
-  "color": "黑色",
-  "color_en": "black",
-  "season": ["spring", "summer", "fall"],
-  "material": "棉",
-  "material_en": "cotton"
-}"""
-          }
-        ],
-      }
+    texts = [
+      self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+      for messages in messages_batch
     ]
-
-    text = self.processor.apply_chat_template(
-      messages, tokenize=False, add_generation_prompt=True
-    )
-    image_inputs, video_inputs = process_vision_info(messages)
+    image_inputs, video_inputs = process_vision_info(messages_batch)
     inputs = self.processor(
-      text=[text],
+      text=texts,
       images=image_inputs,
       videos=video_inputs,
       padding=True,
@@ -169,22 +366,129 @@ JSON:
     inputs = inputs.to(self.device)
 
     with torch.no_grad():
-      generated_ids = self.model.generate(
-        **inputs,
-        max_new_tokens=256,
-        temperature=0.3,
-        top_p=0.9,
-      )
+      generated_ids = self.model.generate(**inputs, **generate_kwargs)
 
-    generated_ids_trimmed = [
-      out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = self.processor.batch_decode(
+    # 左填充后所有输入长度一致，直接按输入长度截掉 prompt 部分
+    generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+    return self.processor.batch_decode(
       generated_ids_trimmed,
       skip_special_tokens=True,
       clean_up_tokenization_spaces=False
-    )[0]
+    )
+
+  def _reset_text_rope_deltas(self):
+    """
+    纯文本输入的 M-RoPE 位置与普通一维位置相同（rope_deltas 为 0）。
+    从缓存的中间位置继续 prefill/generate 时模型会沿用 rope_deltas，必须清掉上一批图片请求留下的值。
+    """
+    for module in (self.model, getattr(self.model, "model", None)):
+      if module is not None and hasattr(module, "rope_deltas"):
+        module.rope_deltas = torch.zeros((1, 1), dtype=torch.long, device=self.device)
+
+  def _generate_with_prefix_cache(
+      self,
+      messages: List[Dict[str, Any]],
+      prefix_hint: PrefixHint,
+      **generate_kwargs
+  ) -> str:
+    """
+    复用缓存的 KV，只对 prompt 剩余部分做 prefill 后生成（仅支持纯文本 prompt）。
+
+    会话缓存与上一轮 prompt 的公共前缀比共享前缀缓存更长时优先使用会话缓存；
+    生成结束后把本轮 prompt 的 KV 存回会话，供下一轮调整复用。
+    """
+    tokenizer = self.processor.tokenizer
+    text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    inputs = tokenizer([text], return_tensors="pt", add_special_tokens=False)
+    full_ids = inputs.input_ids[0].tolist()
+    prefixes = common_prefixes(tokenizer, text, full_ids, prefix_hint.prefix_texts)
+    inputs = inputs.to(self.device)
+
+    session_id = prefix_hint.session_id if self.session_cache is not None else None
+    past_key_values = None
+    self._reset_text_rope_deltas()
+
+    if session_id:
+      entry = self.session_cache.take(session_id)
+      if entry is not None:
+        reuse = entry.common_prefix_length(full_ids)
+        if reuse > max((length for _, length in prefixes), default=0):
+          entry.cache.crop(reuse)
+          past_key_values = entry.cache
+          self.session_cache.record_reuse(reuse)
+
+    if past_key_values is None and self.prefix_cache is not None:
+      past_key_values, _ = self.prefix_cache.build(self.model, inputs.input_ids, prefixes)
+
+    if past_key_values is not None:
+      generate_kwargs["past_key_values"] = past_key_values
+      self._reset_text_rope_deltas()
 
+    try:
+      with torch.no_grad():
+        outputs = self.model.generate(**inputs, return_dict_in_generate=True, **generate_kwargs)
+    except BaseException:
+      if session_id:
+        self.session_cache.abandon(session_id)
+      raise
+
+    if session_id and outputs.past_key_values is not None:
+      # 缓存中还包含本轮生成的 token，裁剪到 prompt 长度后再保存
+      session_kv = outputs.past_key_values
+      session_kv.crop(len(full_ids))
+      self.session_cache.put(session_id, full_ids, session_kv)
+    elif session_id:
+      # 没有可保存的缓存，也要清除 take() 设置的使用标记
+      self.session_cache.abandon(session_id)
+
+    return tokenizer.decode(
+      outputs.sequences[0, inputs.input_ids.shape[1]:],
+      skip_special_tokens=True,
+      clean_up_tokenization_spaces=False
+    )
+
+  def release_session_cache(self, session_id: str):
+    if self.session_cache is not None:
+      self.session_cache.release(session_id)
+
+  def _generate(self, messages: List[Dict[str, Any]], **generate_kwargs) -> str:
+    """经由微批调度器生成单条输出"""
+    return self.batcher.submit(messages, **generate_kwargs)
+
+  def warmup(self) -> float:
+    """
+    用一张合成图片跑一次衣物分析 generate：触发 CUDA kernel 选择、显存池分配、JSON 约束编译和微批调度线程启动，
+    避免这些一次性开销落在部署后的第一个真实请求上。返回耗时（秒）
+    """
+    import time
+    started = time.time()
+    image = Image.new("RGB", (448, 448), (200, 200, 200))
+    self._generate(
+      self._analysis_messages(image),
+      **self._schema_kwargs(ATTRIBUTE_SCHEMA),
+      **{**ANALYSIS_GENERATE_KWARGS, "max_new_tokens": WARMUP_MAX_NEW_TOKENS}
+    )
+    return time.time() - started
+
+  def _analysis_messages(self, image_path: Any) -> List[Dict[str, Any]]:
+    return [
+      {
+        "role": "user",
+        "content": [
+          {
+            "type": "image",
+            "image": image_path,
+          },
+          {
+            "type": "text",
+            "text": CLOTHING_ANALYSIS_PROMPT
+          }
+        ],
+      }
+    ]
+
+  @staticmethod
+  def _parse_clothing_attributes(output_text: str) -> Dict[str, Any]:
     try:
       output_text = output_text.strip()
       if output_text.startswith("```json"):
@@ -214,14 +518,33 @@ JSON:
         "material_en": "unknown"
       }
 
-  def generate_outfit_recommendation(
-      self,
-      wardrobe_items: List[Dict[str, Any]],
-      weather: Dict[str, Any],
-      user_profile: Dict[str, Any],
-      preferences: Optional[Dict[str, Any]] = None
-  ) -> Dict[str, Any]:
-    # 按类别分组衣物（减少LLM搜索成本）
+  def analyze_clothing_image(self, image_path: str) -> Dict[str, Any]:
+    output_text = self._generate(
+      self._analysis_messages(image_path),
+      **self._schema_kwargs(ATTRIBUTE_SCHEMA),
+      **ANALYSIS_GENERATE_KWARGS
+    )
+    return self._parse_clothing_attributes(output_text)
+
+  def analyze_clothing_images(self, image_paths: List[str]) -> List[Dict[str, Any]]:
+    """批量分析多张衣物图片：所有图片在同一个批次中完成视觉编码和生成"""
+    if not image_paths:
+      return []
+    output_texts = self.batcher.submit_many(
+      [self._analysis_messages(image_path) for image_path in image_paths],
+      **self._schema_kwargs(ATTRIBUTE_SCHEMA),
+      **ANALYSIS_GENERATE_KWARGS
+    )
+    return [self._parse_clothing_attributes(output_text) for output_text in output_texts]
+
+  @staticmethod
+  def _format_wardrobe(wardrobe_items: List[Dict[str, Any]]):
+    """
+    按类别分组展示衣物（减少LLM搜索成本），返回 (衣物列表文本, 按编号顺序排列的衣物)。
+
+    模型输出的编号对应的是 prompt 中的展示顺序，解析时必须用返回的列表映射，不能用原始顺序。
+    同一类别内按 id 排序，同一批衣物生成的文本完全一致，便于前缀缓存命中。
+    """
     categorized = {}
     for item in wardrobe_items:
       category = item.get('category', 'unknown')
@@ -229,36 +552,31 @@ JSON:
         categorized[category] = []
       categorized[category].append(item)
     
-    # 构建分类展示的衣物列表
     wardrobe_sections = []
-    item_counter = 0
-    
-    # 定义类别顺序和标签
-    category_order = [
-      ('inner_top', 'INNER LAYER'),
-      ('mid_top', 'MID LAYER'),
-      ('outer_top', 'OUTER LAYER'),
-      ('bottom', 'BOTTOM'),
-      ('full_body', 'FULL BODY'),
-      ('shoes', 'SHOES'),
-      ('socks', 'SOCKS'),
-      ('accessories', 'ACCESSORIES'),
-      ('underwear', 'UNDERWEAR')
-    ]
+    numbered_items = []
     
-    for category_key, category_label in category_order:
-      items = categorized.get(category_key, [])
+    for category_key, category_label in WARDROBE_CATEGORY_ORDER:
+      items = sorted(categorized.get(category_key, []), key=lambda item: item.get('id') or 0)
       if items:
         items_text = []
         for item in items:
-          item_counter += 1
+          numbered_items.append(item)
           items_text.append(
-            f"{item_counter}. {item.get('name_en', 'Unknown')} "
+            f"{len(numbered_items)}. {item.get('name_en', 'Unknown')} "
             f"({item.get('color_en', 'unknown')}, {item.get('material_en', 'unknown')})"
           )
         wardrobe_sections.append(f"{category_label}:\n" + "\n".join(items_text))
     
-    wardrobe_text = "\n\n".join(wardrobe_sections)
+    return "\n\n".join(wardrobe_sections), numbered_items
+
+  def _recommendation_messages(
+      self,
+      wardrobe_items: List[Dict[str, Any]],
+      weather: Dict[str, Any],
+      user_profile: Dict[str, Any],
+      preferences: Optional[Dict[str, Any]] = None
+  ) -> OutfitPrompt:
+    wardrobe_text, numbered_items = self._format_wardrobe(wardrobe_items)
 
     # 构建天气信息文本（使用正确的字段名）
     temp_max = weather.get('temp_max', 'N/A')
@@ -316,39 +634,13 @@ JSON:
       if pref_parts:
         pref_text = f"\n\nUser Preferences:\n" + "\n".join(pref_parts)
 
-    prompt = f"""Create outfit recommendations based on:
+    instructions = RECOMMENDATION_INSTRUCTIONS
+    wardrobe_block = f"""WARDROBE:
+{wardrobe_text}
 
-USER: {user_text}
-WEATHER: {weather_text}
-WARDROBE:
-{wardrobe_text}{pref_text}
-
-RULES:
-1. Generate 2-3 complete outfits
-2. Use item numbers from wardrobe list ONLY
-3. SELECTION RULES:
-   - TOPS: Must include at least one (can select multiple from different layers)
-   - BOTTOM: Exactly one if available
-   - SHOES: Exactly one if available
-   - ACCESSORIES: Optional
-   - FULL BODY: Replaces top and bottom
-4. For missing_items: Suggest SPECIFIC items with colors and styles, NOT generic categories
-
-JSON:
-{{
-  "outfits": [
-    {{
-      "items": [1, 3, 5, 8],
-      "description": "<outfit description in Chinese>"
-    }}
-  ],
-  "missing_items": [
-    {{
-      "category": "<item category in Chinese>",
-      "reason": "<reason in Chinese>"
-    }}
-  ]
-}}"""
+"""
+    prompt = instructions + wardrobe_block + f"""USER: {user_text}
+WEATHER: {weather_text}{pref_text}"""
 
     messages = [
       {
@@ -357,72 +649,42 @@ JSON:
       }
     ]
 
-    text = self.processor.apply_chat_template(
-      messages, tokenize=False, add_generation_prompt=True
-    )
-    inputs = self.processor(
-      text=[text],
-      padding=True,
-      return_tensors="pt",
+    return OutfitPrompt(
+      messages=messages,
+      items=numbered_items,
+      prefix_texts=(instructions, instructions + wardrobe_block),
+      json_schema=outfits_schema(len(numbered_items), 3) if numbered_items else None
     )
-    inputs = inputs.to(self.device)
-
-    with torch.no_grad():
-      generated_ids = self.model.generate(
-        **inputs,
-        max_new_tokens=1024,
-        temperature=1.0,
-        top_p=0.9,
-        do_sample=True,
-        pad_token_id=self.processor.tokenizer.pad_token_id,
-      )
-
-    generated_ids_trimmed = [
-      out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = self.processor.batch_decode(
-      generated_ids_trimmed,
-      skip_special_tokens=True,
-      clean_up_tokenization_spaces=False
-    )[0]
-
-    try:
-      output_text = output_text.strip()
-      if output_text.startswith("```json"):
-        output_text = output_text[7:]
-      if output_text.startswith("```"):
-        output_text = output_text[3:]
-      if output_text.endswith("```"):
-        output_text = output_text[:-3]
-
-      result = json.loads(output_text.strip())
-
-      outfits_with_items = []
-      for outfit in result.get("outfits", []):
-        item_indices = outfit.get("items", [])
-        outfit_items = []
-        for idx in item_indices:
-          if isinstance(idx, int) and 1 <= idx <= len(wardrobe_items):
-            outfit_items.append(wardrobe_items[idx - 1])
 
-        outfits_with_items.append({
-          "items": outfit_items,
-          "description": outfit.get("description", "")
-        })
-
-      return {
-        "outfits": outfits_with_items,
-        "missing_items": result.get("missing_items", [])
-      }
+  def generate_outfit_recommendation(
+      self,
+      wardrobe_items: List[Dict[str, Any]],
+      weather: Dict[str, Any],
+      user_profile: Dict[str, Any],
+      preferences: Optional[Dict[str, Any]] = None
+  ) -> Dict[str, Any]:
+    prompt = self._recommendation_messages(wardrobe_items, weather, user_profile, preferences)
+    output_text = self._generate(
+      prompt.messages,
+      pad_token_id=self.processor.tokenizer.pad_token_id,
+      **self._prefix_kwargs(prompt),
+      **self._schema_kwargs(prompt.json_schema),
+      **RECOMMENDATION_GENERATE_KWARGS
+    )
+    return self._parse_outfits_output(output_text, prompt.items, label="recommendation")
 
-    except json.JSONDecodeError:
-      print(f"Failed to parse recommendation JSON: {output_text}")
-      return {
-        "outfits": [],
-        "missing_items": []
-      }
+  def stream_outfit_recommendation(
+      self,
+      wardrobe_items: List[Dict[str, Any]],
+      weather: Dict[str, Any],
+      user_profile: Dict[str, Any],
+      preferences: Optional[Dict[str, Any]] = None
+  ) -> Iterator[Dict[str, Any]]:
+    """流式生成穿搭推荐：每套穿搭的 JSON 对象一闭合就产出 outfit 事件"""
+    prompt = self._recommendation_messages(wardrobe_items, weather, user_profile, preferences)
+    yield from self._stream_outfits(prompt, RECOMMENDATION_GENERATE_KWARGS, label="recommendation")
 
-  def adjust_outfit_with_conversation(
+  def _adjustment_messages(
       self,
       adjustment_request: str,
       wardrobe_items: List[Dict[str, Any]],
@@ -431,45 +693,8 @@ JSON:
       preferences: Optional[Dict[str, Any]],
       conversation_history: List[Dict[str, Any]],
       current_outfit: List[int]
-  ) -> Dict[str, Any]:
-    """根据对话历史调整穿搭方案"""
-    # 按类别分组衣物
-    categorized = {}
-    for item in wardrobe_items:
-      category = item.get('category', 'unknown')
-      if category not in categorized:
-        categorized[category] = []
-      categorized[category].append(item)
-    
-    # 构建分类展示的衣物列表
-    wardrobe_sections = []
-    item_counter = 0
-    
-    category_order = [
-      ('inner_top', 'INNER LAYER'),
-      ('mid_top', 'MID LAYER'),
-      ('outer_top', 'OUTER LAYER'),
-      ('bottom', 'BOTTOM'),
-      ('full_body', 'FULL BODY'),
-      ('shoes', 'SHOES'),
-      ('socks', 'SOCKS'),
-      ('accessories', 'ACCESSORIES'),
-      ('underwear', 'UNDERWEAR')
-    ]
-    
-    for category_key, category_label in category_order:
-      items = categorized.get(category_key, [])
-      if items:
-        items_text = []
-        for item in items:
-          item_counter += 1
-          items_text.append(
-            f"{item_counter}. {item.get('name_en', 'Unknown')} "
-            f"({item.get('color_en', 'unknown')}, {item.get('material_en', 'unknown')})"
-          )
-        wardrobe_sections.append(f"{category_label}:\n" + "\n".join(items_text))
-    
-    wardrobe_text = "\n\n".join(wardrobe_sections)
+  ) -> OutfitPrompt:
+    wardrobe_text, numbered_items = self._format_wardrobe(wardrobe_items)
 
     # 构建天气信息
     temp_max = weather.get('temp_max', 'N/A')
@@ -545,8 +770,12 @@ JSON:
     conversation_text = ""
     if conversation_history:
       history_lines = []
-      # 只保留最近3轮对话（最多6条消息）
-      recent_messages = conversation_history[-6:]
+      # 保留最近6~9条消息：窗口起点每2轮才前移一次，
+      # 相邻两轮的 prompt 共享对话前缀，会话 KV 缓存只需 prefill 新增部分
+      start = 0
+      if len(conversation_history) > 6:
+        start = (len(conversation_history) - 6) // 4 * 4
+      recent_messages = conversation_history[start:]
       for msg in recent_messages:
         role = msg.get('role', 'unknown')
         content = msg.get('content', '')
@@ -558,31 +787,18 @@ JSON:
       if history_lines:
         conversation_text = "\n\nCONVERSATION HISTORY:\n" + "\n".join(history_lines)
 
-    prompt = f"""Adjust the outfit recommendation based on user feedback:
+    instructions = ADJUSTMENT_INSTRUCTIONS
+    wardrobe_block = f"""WARDROBE:
+{wardrobe_text}
 
-USER: {user_text}{pref_text}
-WEATHER: {weather_text}
-{current_outfit_text}
-WARDROBE:
-{wardrobe_text}{conversation_text}
+"""
+    # 对话历史在当前穿搭之前：多轮之间只有末尾的当前穿搭和调整请求会变化
+    prompt = instructions + wardrobe_block + f"""USER: {user_text}{pref_text}
+WEATHER: {weather_text}{conversation_text}
 
-USER REQUEST: {adjustment_request}
+{current_outfit_text}
 
-RULES:
-1. If user changes ONE category, keep others from current outfit
-2. ALWAYS include: BOTTOM or FULL_BODY, SHOES, at least one TOP
-3. Return 1-2 outfits, description in Chinese
-
-JSON:
-{{
-  "outfits": [
-    {{
-      "items": [1, 3, 5, 8],
-      "description": "<Chinese description>"
-    }}
-  ],
-  "missing_items": []
-}}"""
+USER REQUEST: {adjustment_request}"""
 
     messages = [
       {
@@ -591,63 +807,124 @@ JSON:
       }
     ]
 
-    text = self.processor.apply_chat_template(
-      messages, tokenize=False, add_generation_prompt=True
+    return OutfitPrompt(
+      messages=messages,
+      items=numbered_items,
+      prefix_texts=(instructions, instructions + wardrobe_block),
+      json_schema=outfits_schema(len(numbered_items), 2) if numbered_items else None
     )
-    inputs = self.processor(
-      text=[text],
-      padding=True,
-      return_tensors="pt",
+
+  def adjust_outfit_with_conversation(
+      self,
+      adjustment_request: str,
+      wardrobe_items: List[Dict[str, Any]],
+      weather: Dict[str, Any],
+      user_profile: Dict[str, Any],
+      preferences: Optional[Dict[str, Any]],
+      conversation_history: List[Dict[str, Any]],
+      current_outfit: List[int],
+      session_id: Optional[str] = None
+  ) -> Dict[str, Any]:
+    """根据对话历史调整穿搭方案（传入 session_id 时复用该会话上一轮的 KV 缓存）"""
+    prompt = self._adjustment_messages(
+      adjustment_request, wardrobe_items, weather, user_profile,
+      preferences, conversation_history, current_outfit
+    )
+    output_text = self._generate(
+      prompt.messages,
+      pad_token_id=self.processor.tokenizer.pad_token_id,
+      **self._prefix_kwargs(prompt, session_id),
+      **self._schema_kwargs(prompt.json_schema),
+      **ADJUSTMENT_GENERATE_KWARGS
+    )
+    return self._parse_outfits_output(
+      output_text, prompt.items, current_outfit=current_outfit, label="adjustment"
     )
-    inputs = inputs.to(self.device)
 
-    with torch.no_grad():
-      generated_ids = self.model.generate(
-        **inputs,
-        max_new_tokens=1024,
-        temperature=0.8,
-        top_p=0.9,
-        do_sample=True,
-        pad_token_id=self.processor.tokenizer.pad_token_id,
+  def stream_outfit_adjustment(
+      self,
+      adjustment_request: str,
+      wardrobe_items: List[Dict[str, Any]],
+      weather: Dict[str, Any],
+      user_profile: Dict[str, Any],
+      preferences: Optional[Dict[str, Any]],
+      conversation_history: List[Dict[str, Any]],
+      current_outfit: List[int],
+      session_id: Optional[str] = None
+  ) -> Iterator[Dict[str, Any]]:
+    """流式调整穿搭方案"""
+    prompt = self._adjustment_messages(
+      adjustment_request, wardrobe_items, weather, user_profile,
+      preferences, conversation_history, current_outfit
+    )
+    yield from self._stream_outfits(
+      prompt, ADJUSTMENT_GENERATE_KWARGS, current_outfit=current_outfit,
+      session_id=session_id, label="adjustment"
+    )
+
+  def _schema_kwargs(self, json_schema: Optional[tuple]) -> Dict[str, Any]:
+    """开启约束解码时附带输出 schema（schema 相同的请求仍可合批）"""
+    if self.json_constraints is None or json_schema is None:
+      return {}
+    return {"json_schema": json_schema}
+
+  def _prefix_kwargs(self, prompt: OutfitPrompt, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """开启前缀/会话缓存时，为推荐/调整请求附带前缀提示"""
+    if session_id is None or self.session_cache is None:
+      session_id = None
+      if self.prefix_cache is None:
+        return {}
+    return {"prefix_hint": PrefixHint(prompt.prefix_texts, session_id=session_id)}
+
+  @staticmethod
+  def _strip_json_fences(output_text: str) -> str:
+    output_text = output_text.strip()
+    if output_text.startswith("```json"):
+      output_text = output_text[7:]
+    if output_text.startswith("```"):
+      output_text = output_text[3:]
+    if output_text.endswith("```"):
+      output_text = output_text[:-3]
+    return output_text.strip()
+
+  def _resolve_outfit(
+      self,
+      outfit: Dict[str, Any],
+      wardrobe_items: List[Dict[str, Any]],
+      current_outfit: Optional[List[int]] = None
+  ) -> Dict[str, Any]:
+    """把模型输出的衣物编号映射为衣物字典"""
+    item_indices = outfit.get("items", [])
+    outfit_items = []
+    for idx in item_indices:
+      if isinstance(idx, int) and 1 <= idx <= len(wardrobe_items):
+        outfit_items.append(wardrobe_items[idx - 1])
+
+    if current_outfit is not None:
+      # 验证并修复缺失的必需品类
+      outfit_items = self._ensure_required_categories(
+        outfit_items, current_outfit, wardrobe_items
       )
 
-    generated_ids_trimmed = [
-      out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = self.processor.batch_decode(
-      generated_ids_trimmed,
-      skip_special_tokens=True,
-      clean_up_tokenization_spaces=False
-    )[0]
+    return {
+      "items": outfit_items,
+      "description": outfit.get("description", "")
+    }
 
+  def _parse_outfits_output(
+      self,
+      output_text: str,
+      wardrobe_items: List[Dict[str, Any]],
+      current_outfit: Optional[List[int]] = None,
+      label: str = "recommendation"
+  ) -> Dict[str, Any]:
     try:
-      output_text = output_text.strip()
-      if output_text.startswith("```json"):
-        output_text = output_text[7:]
-      if output_text.startswith("```"):
-        output_text = output_text[3:]
-      if output_text.endswith("```"):
-        output_text = output_text[:-3]
+      result = json.loads(self._strip_json_fences(output_text))
 
-      result = json.loads(output_text.strip())
-
-      outfits_with_items = []
-      for outfit in result.get("outfits", []):
-        item_indices = outfit.get("items", [])
-        outfit_items = []
-        for idx in item_indices:
-          if isinstance(idx, int) and 1 <= idx <= len(wardrobe_items):
-            outfit_items.append(wardrobe_items[idx - 1])
-        
-        # 验证并修复缺失的必需品类
-        outfit_items = self._ensure_required_categories(
-          outfit_items, current_outfit, wardrobe_items
-        )
-
-        outfits_with_items.append({
-          "items": outfit_items,
-          "description": outfit.get("description", "")
-        })
+      outfits_with_items = [
+        self._resolve_outfit(outfit, wardrobe_items, current_outfit)
+        for outfit in result.get("outfits", [])
+      ]
 
       return {
         "outfits": outfits_with_items,
@@ -655,12 +932,82 @@ JSON:
       }
 
     except json.JSONDecodeError:
-      print(f"Failed to parse adjustment JSON: {output_text}")
+      print(f"Failed to parse {label} JSON: {output_text}")
       return {
         "outfits": [],
         "missing_items": []
       }
 
+  def _stream_generate(self, messages: List[Dict[str, Any]], **generate_kwargs) -> Iterator[str]:
+    """
+    逐段产出生成文本；generate 仍经由微批调度器执行（带 streamer 的请求单独成批）。
+    调用方提前关闭生成器（SSE 客户端断开）时置位 stop_event，generate 在下一步停止
+    """
+    streamer = TextIteratorStreamer(
+      self.processor.tokenizer,
+      skip_prompt=True,
+      skip_special_tokens=True,
+      clean_up_tokenization_spaces=False,
+    )
+    errors = []
+    stop_event = threading.Event()
+
+    def run():
+      try:
+        self._generate(messages, streamer=streamer, stop_event=stop_event, **generate_kwargs)
+      except BaseException as e:
+        errors.append(e)
+        streamer.end()  # 生成失败时结束迭代，避免调用方永久阻塞
+
+    thread = threading.Thread(target=run, name="qwen-stream", daemon=True)
+    thread.start()
+    try:
+      for text in streamer:
+        if text:
+          yield text
+    finally:
+      stop_event.set()
+    thread.join()
+    if errors:
+      raise errors[0]
+
+  def _stream_outfits(
+      self,
+      prompt: OutfitPrompt,
+      generate_kwargs: Dict[str, Any],
+      current_outfit: Optional[List[int]] = None,
+      session_id: Optional[str] = None,
+      label: str = "recommendation"
+  ) -> Iterator[Dict[str, Any]]:
+    """
+    流式推荐事件：
+      {"type": "outfit", "index": i, "outfit": {...}}  每套穿搭闭合时立即产出
+      {"type": "complete", "outfits": [...], "missing_items": [...]}  生成结束后产出完整结果
+    """
+    parser = OutfitStreamParser()
+    streamed = []
+    chunks = self._stream_generate(
+      prompt.messages,
+      pad_token_id=self.processor.tokenizer.pad_token_id,
+      **self._prefix_kwargs(prompt, session_id),
+      **self._schema_kwargs(prompt.json_schema),
+      **generate_kwargs
+    )
+    try:
+      for chunk in chunks:
+        for outfit in parser.feed(chunk):
+          resolved = self._resolve_outfit(outfit, prompt.items, current_outfit)
+          streamed.append(resolved)
+          yield {"type": "outfit", "index": len(streamed) - 1, "outfit": resolved}
+    finally:
+      chunks.close()  # 调用方提前关闭时立即停止生成，而不是等垃圾回收
+
+    result = self._parse_outfits_output(parser.text, prompt.items, current_outfit, label)
+    # 完整解析失败时保留已经流式产出的穿搭
+    if not result["outfits"] and streamed:
+      result["outfits"] = streamed
+    yield {"type": "complete", **result}
+
   def _ensure_required_categories(
       self,
       outfit_items: List[Dict[str, Any]],
@@ -702,41 +1049,48 @@ JSON:
 # Thread-safe singleton pattern
 _model_instance: Optional[FashionQwenModel] = None
 _model_lock = threading.Lock()
-_model_loading = False
 
 
 def get_model() -> FashionQwenModel:
   """Get or create the model instance (thread-safe singleton)"""
-  global _model_instance, _model_loading
+  global _model_instance
   
   # Fast path: model already loaded
   if _model_instance is not None:
     return _model_instance
   
-  # Slow path: need to load model
+  # Slow path: the loading thread holds the lock for the whole load,
+  # so concurrent callers simply block on it instead of polling
   with _model_lock:
     # Double-check: maybe another thread loaded it while we were waiting
     if _model_instance is not None:
       return _model_instance
     
-    # Prevent multiple concurrent loads
-    if _model_loading:
-      print("Model is already being loaded by another thread, waiting...")
-      # Wait for the other thread to finish loading
-      while _model_loading:
-        import time
-        time.sleep(1)
-      return _model_instance
-    
-    # We are the thread that will load the model
-    _model_loading = True
-    try:
-      print("Loading Qwen model (this may take 1-2 minutes)...")
-      _model_instance = FashionQwenModel()
-      print("Model ready for inference!")
-      return _model_instance
-    finally:
-      _model_loading = False
+    print("Loading Qwen model (this may take 1-2 minutes)...")
+    _model_instance = FashionQwenModel()
+    print("Model ready for inference!")
+    return _model_instance
+
+
+def is_model_loaded() -> bool:
+  return _model_instance is not None
+
+
+def warmup_model() -> float:
+  """加载模型（如尚未加载）并用合成图片跑一次 generate，返回预热耗时（秒）"""
+  return get_model().warmup()
+
+
+def get_generation_stats() -> Dict[str, Any]:
+  """微批调度器与前缀/会话缓存的指标（模型未加载时返回空字典）"""
+  if _model_instance is None:
+    return {}
+  stats = _model_instance.batcher.stats()
+  if _model_instance.prefix_cache is not None:
+    stats["prefix_cache"] = _model_instance.prefix_cache.stats()
+  if _model_instance.session_cache is not None:
+    stats["session_cache"] = _model_instance.session_cache.stats()
+  return stats
 
 
 def predict(image_path: str) -> Dict[str, Any]:
@@ -744,6 +1098,11 @@ def predict(image_path: str) -> Dict[str, Any]:
   return model.analyze_clothing_image(image_path)
 
 
+def predict_batch(image_paths: List[str]) -> List[Dict[str, Any]]:
+  model = get_model()
+  return model.analyze_clothing_images(image_paths)
+
+
 def get_recommendations(
     user: Dict[str, Any],
     wardrobe: List[Dict[str, Any]],
@@ -754,6 +1113,16 @@ def get_recommendations(
   return model.generate_outfit_recommendation(wardrobe, weather, user, preferences)
 
 
+def stream_recommendations(
+    user: Dict[str, Any],
+    wardrobe: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+  model = get_model()
+  return model.stream_outfit_recommendation(wardrobe, weather, user, preferences)
+
+
 def adjust_recommendations_with_conversation(
     session_id: str,
     adjustment_request: str,
@@ -773,5 +1142,36 @@ def adjust_recommendations_with_conversation(
     user_profile=user,
     preferences=preferences,
     conversation_history=conversation_history,
-    current_outfit=current_outfit
-  )
\ No newline at end of file
+    current_outfit=current_outfit,
+    session_id=session_id
+  )
+
+
+def stream_adjust_recommendations_with_conversation(
+    session_id: str,
+    adjustment_request: str,
+    user: Dict[str, Any],
+    wardrobe: List[Dict[str, Any]],
+    weather: Dict[str, Any],
+    preferences: Optional[Dict[str, Any]],
+    conversation_history: List[Dict[str, Any]],
+    current_outfit: List[int]
+) -> Iterator[Dict[str, Any]]:
+  """流式调整穿搭方案"""
+  model = get_model()
+  return model.stream_outfit_adjustment(
+    adjustment_request=adjustment_request,
+    wardrobe_items=wardrobe,
+    weather=weather,
+    user_profile=user,
+    preferences=preferences,
+    conversation_history=conversation_history,
+    current_outfit=current_outfit,
+    session_id=session_id
+  )
+
+
+def release_session_cache(session_id: str):
+  """会话删除/过期时释放其 KV 缓存（模型未加载时无需处理）"""
+  if _model_instance is not None:
+    _model_instance.release_session_cache(session_id)
@@ -0,0 +1,524 @@
+"""
+按 JSON schema 约束解码
+
+模型输出属性/推荐 JSON 时，JsonSchemaLogitsProcessor 只允许能让输出保持为「符合 schema 的 JSON 前缀」的 token，
+因此输出一定能被 json.loads 解析（不会再出现 ```json 围栏、多余解释文字或缺字段）；
+JsonCompleteCriteria 在根对象闭合的那一步立即停止生成，不再一路跑到 max_new_tokens。
+
+实现要点：
+  - schema 用 json_object / json_array / json_string / json_integer 描述，均为可哈希的元组，
+    可以直接作为生成参数进入微批调度器的分组键；对象的键按声明顺序固定输出
+  - 约束在字节层面进行：词表中每个 token 还原为 UTF-8 字节串，按字节排序后做类似 trie 的前缀剪枝扫描
+  - 普通字符串内容（不含引号、反斜杠、控制字符）的 token 用预先计算好的掩码一次放行，
+    只有包含这些特殊字节的少量 token 需要逐个检查
+  - 每种解析状态的可选 token 集合会被缓存，同一 schema 的后续请求直接复用
+"""
+import bisect
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+
+# ---------- schema 描述 ----------
+
+def json_object(*fields: Tuple[str, Any]) -> Tuple:
+  """对象，fields 为 (键, 子 schema)，按给定顺序输出"""
+  return ("object", tuple(fields))
+
+
+def json_array(item: Tuple, min_items: int = 0, max_items: Optional[int] = None) -> Tuple:
+  return ("array", item, min_items, max_items)
+
+
+def json_string(enum: Optional[Sequence[str]] = None, max_length: int = 256) -> Tuple:
+  """字符串；max_length 为 UTF-8 字节数上限（中文约 3 字节/字）"""
+  return ("string", tuple(enum) if enum else None, max_length)
+
+
+def json_integer(minimum: int = 0, maximum: Optional[int] = None) -> Tuple:
+  """非负整数"""
+  return ("integer", minimum, maximum)
+
+
+# ---------- 字节级下推自动机 ----------
+
+WHITESPACE = frozenset(b" \t\n\r")
+MAX_WHITESPACE = 32  # 连续空白的上限（足够输出带缩进的 JSON，又不会无限输出空白）
+ESCAPES = frozenset(b'"\\/bfnrt')
+QUOTE, BACKSLASH = ord('"'), ord("\\")
+
+
+def _integer_viable(value: int, minimum: int, maximum: Optional[int]) -> bool:
+  """已输出数字 value 之后继续追加数字（或就此结束）能否落在 [minimum, maximum] 内"""
+  if value == 0:
+    # JSON 不允许前导零，0 之后不能再接数字
+    return minimum <= 0
+  low = high = value
+  while maximum is None or low <= maximum:
+    if high >= minimum:
+      return True
+    low, high = low * 10, high * 10 + 9
+  return False
+
+
+def _string_cost(data: bytes) -> int:
+  """token 在自由字符串中消耗的长度（到闭合引号为止，转义序列计 1）"""
+  cost = 0
+  escaped = False
+  for b in data:
+    if escaped:
+      escaped = False
+      continue
+    if b == QUOTE:
+      break
+    cost += 1
+    escaped = b == BACKSLASH
+  return cost
+
+
+class JsonSchemaAutomaton:
+  """
+  解析状态为帧的元组（栈顶在末尾），所有帧都是不可变元组，便于复制和作为缓存键：
+    ('R', stage, ws)                      根：stage 0 等待值，1 已完成
+    ('O', node, key_index, stage, pos, ws) 对象：1 键前 / 2 键内 / 3 冒号前 / 4 值前 / 5 值后
+    ('A', node, count, stage, ws)          数组：1 '[' 之后 / 2 元素之后 / 3 ',' 之后
+    ('S', node, stage, length, buf)        字符串：1 内容 / 2 转义；buf 仅枚举字符串记录已输出内容
+    ('I', node, value, digits)             整数
+  """
+
+  def __init__(self, schema: Tuple):
+    self.nodes: List[Tuple] = []
+    self.enum_values: Dict[int, frozenset] = {}
+    self.enum_prefixes: Dict[int, frozenset] = {}
+    self.root = self._compile(schema)
+    self.initial = (("R", 0, 0),)
+
+  def _compile(self, schema: Tuple) -> int:
+    kind = schema[0]
+    if kind == "object":
+      fields = tuple((key.encode("utf-8"), self._compile(child)) for key, child in schema[1])
+      node = ("object", fields)
+    elif kind == "array":
+      node = ("array", self._compile(schema[1]), schema[2], schema[3])
+    elif kind == "string":
+      node = ("string", schema[1] is not None, schema[2])
+    elif kind == "integer":
+      node = ("integer", schema[1], schema[2])
+    else:
+      raise ValueError(f"不支持的 schema 类型: {kind}")
+
+    self.nodes.append(node)
+    node_id = len(self.nodes) - 1
+    if kind == "string" and schema[1] is not None:
+      values = [value.encode("utf-8") for value in schema[1]]
+      self.enum_values[node_id] = frozenset(values)
+      self.enum_prefixes[node_id] = frozenset(
+        value[:i] for value in values for i in range(len(value) + 1)
+      )
+    return node_id
+
+  def is_complete(self, stack: Tuple) -> bool:
+    return stack[-1] == ("R", 1, 0)
+
+  def _start_value(self, node_id: int, b: int) -> Optional[Tuple]:
+    node = self.nodes[node_id]
+    kind = node[0]
+    if kind == "object":
+      return ("O", node_id, 0, 1, 0, 0) if b == ord("{") else None
+    if kind == "array":
+      return ("A", node_id, 0, 1, 0) if b == ord("[") else None
+    if kind == "string":
+      if b != QUOTE:
+        return None
+      return ("S", node_id, 1, 0, b"" if node[1] else None)
+    # integer
+    digit = b - 48
+    if not 0 <= digit <= 9:
+      return None
+    if not _integer_viable(digit, node[1], node[2]):
+      return None
+    return ("I", node_id, digit, 1)
+
+  def step(self, stack: Tuple, b: int) -> Optional[Tuple]:
+    """消费一个字节，返回新状态；不合法时返回 None"""
+    top = stack[-1]
+    kind = top[0]
+
+    if kind == "S":
+      _, node_id, stage, length, buf = top
+      max_length = self.nodes[node_id][2]
+      if stage == 2:
+        if b in ESCAPES:
+          return stack[:-1] + (("S", node_id, 1, length + 1, buf),)
+        return None
+      if b == QUOTE:
+        if buf is not None and buf not in self.enum_values[node_id]:
+          return None
+        return stack[:-1]
+      if b < 0x20 or length >= max_length:
+        return None
+      if b == BACKSLASH:
+        if buf is not None:
+          return None
+        return stack[:-1] + (("S", node_id, 2, length, buf),)
+      if buf is not None:
+        buf = buf + bytes((b,))
+        if buf not in self.enum_prefixes[node_id]:
+          return None
+      return stack[:-1] + (("S", node_id, 1, length + 1, buf),)
+
+    if kind == "I":
+      _, node_id, value, digits = top
+      _, minimum, maximum = self.nodes[node_id]
+      digit = b - 48
+      if 0 <= digit <= 9:
+        extended = value * 10 + digit
+        # JSON 不允许前导零
+        if value == 0 or not _integer_viable(extended, minimum, maximum):
+          return None
+        return stack[:-1] + (("I", node_id, extended, digits + 1),)
+      if value < minimum:
+        return None
+      # 整数由后面的非数字字节结束，该字节交给父帧处理
+      stack = stack[:-1]
+      top = stack[-1]
+      kind = top[0]
+
+    if kind == "R":
+      _, stage, ws = top
+      if stage == 1:
+        return None
+      if b in WHITESPACE:
+        return (("R", 0, ws + 1),) if ws < MAX_WHITESPACE else None
+      frame = self._start_value(self.root, b)
+      if frame is None:
+        return None
+      return (("R", 1, 0), frame)
+
+    if kind == "O":
+      _, node_id, index, stage, pos, ws = top
+      fields = self.nodes[node_id][1]
+      if stage == 2:
+        key = fields[index][0]
+        if pos < len(key):
+          return stack[:-1] + (("O", node_id, index, 2, pos + 1, 0),) if b == key[pos] else None
+        return stack[:-1] + (("O", node_id, index, 3, 0, 0),) if b == QUOTE else None
+      if b in WHITESPACE:
+        if ws >= MAX_WHITESPACE:
+          return None
+        return stack[:-1] + (("O", node_id, index, stage, pos, ws + 1),)
+      if stage == 1:
+        return stack[:-1] + (("O", node_id, index, 2, 0, 0),) if b == QUOTE else None
+      if stage == 3:
+        return stack[:-1] + (("O", node_id, index, 4, 0, 0),) if b == ord(":") else None
+      if stage == 4:
+        frame = self._start_value(fields[index][1], b)
+        if frame is None:
+          return None
+        return stack[:-1] + (("O", node_id, index, 5, 0, 0), frame)
+      # stage 5：值之后
+      if b == ord(",") and index < len(fields) - 1:
+        return stack[:-1] + (("O", node_id, index + 1, 1, 0, 0),)
+      if b == ord("}") and index == len(fields) - 1:
+        return stack[:-1]
+      return None
+
+    # 数组
+    _, node_id, count, stage, ws = top
+    _, item_id, min_items, max_items = self.nodes[node_id]
+    if b in WHITESPACE:
+      if ws >= MAX_WHITESPACE:
+        return None
+      return stack[:-1] + (("A", node_id, count, stage, ws + 1),)
+    if b == ord("]") and stage != 3 and count >= min_items:
+      return stack[:-1]
+    if stage == 2:
+      if b == ord(",") and (max_items is None or count < max_items):
+        return stack[:-1] + (("A", node_id, count, 3, 0),)
+      return None
+    if max_items is not None and count >= max_items:
+      return None
+    frame = self._start_value(item_id, b)
+    if frame is None:
+      return None
+    return stack[:-1] + (("A", node_id, count + 1, 2, 0), frame)
+
+  def advance(self, stack: Optional[Tuple], data: bytes) -> Optional[Tuple]:
+    for b in data:
+      if stack is None:
+        return None
+      stack = self.step(stack, b)
+    return stack
+
+  def in_free_string(self, stack: Tuple) -> bool:
+    top = stack[-1]
+    return top[0] == "S" and top[2] == 1 and top[4] is None
+
+
+# ---------- 词表索引 ----------
+
+def _next_prefix(prefix: bytes) -> bytes:
+  """大于所有以 prefix 开头的字节串的最小字节串"""
+  while prefix and prefix[-1] == 0xFF:
+    prefix = prefix[:-1]
+  if not prefix:
+    return b"\xff" * 64
+  return prefix[:-1] + bytes((prefix[-1] + 1,))
+
+
+class _SortedTokens:
+  def __init__(self, entries: List[Tuple[bytes, int]]):
+    entries.sort()
+    self.keys = [key for key, _ in entries]
+    self.ids = [token_id for _, token_id in entries]
+
+
+class TokenVocabulary:
+  """把 tokenizer 词表还原为字节串，并预先计算字符串内容的快速放行掩码"""
+
+  def __init__(self, tokenizer: Any):
+    try:
+      from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+      byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+    except ImportError:
+      byte_decoder = {}
+
+    special_ids = set(tokenizer.all_special_ids)
+    special_ids.update(getattr(tokenizer, "added_tokens_decoder", {}).keys())
+
+    self.token_bytes: Dict[int, bytes] = {}
+    for token_id in range(len(tokenizer)):
+      if token_id in special_ids:
+        continue
+      token = tokenizer.convert_ids_to_tokens(token_id)
+      if token is None:
+        continue
+      if byte_decoder and all(c in byte_decoder for c in token):
+        data = bytes(byte_decoder[c] for c in token)
+      else:
+        data = tokenizer.convert_tokens_to_string([token]).encode("utf-8")
+      if data:
+        self.token_bytes[token_id] = data
+
+    entries = list((data, token_id) for token_id, data in self.token_bytes.items())
+    self.all_tokens = _SortedTokens(entries)
+    # 含引号、反斜杠或控制字符的 token：在字符串内部需要逐个检查
+    self.special_string_tokens = _SortedTokens([
+      (data, token_id) for data, token_id in entries
+      if any(b == QUOTE or b == BACKSLASH or b < 0x20 for b in data)
+    ])
+    self.string_costs = {
+      token_id: _string_cost(data) for token_id, data in zip(self.special_string_tokens.ids, self.special_string_tokens.keys)
+    }
+
+    eos = tokenizer.eos_token_id
+    self.eos_ids = [eos] if isinstance(eos, int) else list(eos or [])
+    im_end = tokenizer.convert_tokens_to_ids("<|im_end|>")
+    if isinstance(im_end, int) and im_end != tokenizer.unk_token_id and im_end not in self.eos_ids:
+      self.eos_ids.append(im_end)
+
+    self._tensors: Dict[Tuple[int, str], Tuple[torch.Tensor, torch.Tensor]] = {}
+
+  def string_tensors(self, vocab_size: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    """(普通字符串 token 掩码, 每个 token 的字节长度)，按 logits 维度和设备缓存"""
+    key = (vocab_size, str(device))
+    if key not in self._tensors:
+      plain = torch.zeros(vocab_size, dtype=torch.bool)
+      lengths = torch.full((vocab_size,), 1 << 30, dtype=torch.long)
+      for token_id, data in self.token_bytes.items():
+        if token_id >= vocab_size:
+          continue
+        lengths[token_id] = len(data)
+        if not any(b == QUOTE or b == BACKSLASH or b < 0x20 for b in data):
+          plain[token_id] = True
+      self._tensors[key] = (plain.to(device), lengths.to(device))
+    return self._tensors[key]
+
+
+class ConstrainedSchema:
+  """编译后的 schema + 状态到可选 token 的缓存（同一 schema 的请求共享）"""
+
+  def __init__(self, schema: Tuple, vocab: TokenVocabulary, max_cached_states: int = 4096):
+    self.automaton = JsonSchemaAutomaton(schema)
+    self.vocab = vocab
+    self.max_cached_states = max_cached_states
+    self._allowed: "OrderedDict[Tuple, List[int]]" = OrderedDict()
+
+  def _scan(self, stack: Tuple, tokens: _SortedTokens) -> List[int]:
+    """按字节序遍历 token，公共前缀只推进一次，前缀不合法时整段跳过"""
+    keys, ids = tokens.keys, tokens.ids
+    allowed = []
+    path = b""
+    states = [stack]
+    i = 0
+    while i < len(keys):
+      token = keys[i]
+      common = 0
+      limit = min(len(path), len(token))
+      while common < limit and path[common] == token[common]:
+        common += 1
+      del states[common + 1:]
+
+      dead_at = -1
+      for depth in range(common, len(token)):
+        state = self.automaton.step(states[-1], token[depth])
+        if state is None:
+          dead_at = depth
+          break
+        states.append(state)
+      path = token[:len(states) - 1]
+
+      if dead_at >= 0:
+        i = bisect.bisect_left(keys, _next_prefix(token[:dead_at + 1]), i + 1)
+        continue
+      allowed.append(ids[i])
+      i += 1
+    return allowed
+
+  def allowed_tokens(self, stack: Tuple) -> List[int]:
+    """结构位置/枚举/整数状态下允许的 token；自由字符串内部只返回含特殊字节的 token"""
+    if self.automaton.in_free_string(stack):
+      # 长度只影响普通内容 token（由掩码按剩余长度过滤），缓存键中去掉长度
+      top = stack[-1]
+      key = stack[:-1] + (("S", top[1], 1, 0, None),)
+      tokens = self.vocab.special_string_tokens
+    else:
+      key = stack
+      tokens = self.vocab.all_tokens
+
+    allowed = self._allowed.get(key)
+    if allowed is None:
+      allowed = self._scan(key, tokens)
+      self._allowed[key] = allowed
+      if len(self._allowed) > self.max_cached_states:
+        self._allowed.popitem(last=False)
+    else:
+      self._allowed.move_to_end(key)
+
+    if key is not stack:
+      # 缓存按长度 0 扫描，这里按实际剩余长度过滤（闭合引号之前的内容也计入 max_length）
+      top = stack[-1]
+      remaining = self.automaton.nodes[top[1]][2] - top[3]
+      string_costs = self.vocab.string_costs
+      allowed = [token_id for token_id in allowed if string_costs[token_id] <= remaining]
+    return allowed
+
+
+# ---------- generate 接口 ----------
+
+class JsonStateTracker:
+  """逐行跟踪已生成 token 对应的解析状态（logits processor 与 stopping criteria 共享）"""
+
+  def __init__(self, schema: ConstrainedSchema, batch_size: int):
+    self.schema = schema
+    self.states: List[Optional[Tuple]] = [schema.automaton.initial] * batch_size
+    self.prompt_length: Optional[int] = None
+    self.consumed = 0
+
+  def update(self, input_ids: torch.LongTensor):
+    if self.prompt_length is None:
+      self.prompt_length = input_ids.shape[1]
+      self.consumed = self.prompt_length
+      return
+    if input_ids.shape[1] <= self.consumed:
+      return
+    new_tokens = input_ids[:, self.consumed:].tolist()
+    self.consumed = input_ids.shape[1]
+    automaton = self.schema.automaton
+    token_bytes = self.schema.vocab.token_bytes
+    for row, tokens in enumerate(new_tokens):
+      for token_id in tokens:
+        state = self.states[row]
+        # 已完成（后续只是 EOS / 填充）或约束失效的行不再推进
+        if state is None or automaton.is_complete(state):
+          break
+        data = token_bytes.get(token_id)
+        self.states[row] = automaton.advance(state, data) if data else None
+
+  def complete(self) -> List[bool]:
+    automaton = self.schema.automaton
+    return [state is not None and automaton.is_complete(state) for state in self.states]
+
+  def finished(self) -> List[bool]:
+    """已完成或约束失效（不会再产生合法输出）的行"""
+    automaton = self.schema.automaton
+    return [state is None or automaton.is_complete(state) for state in self.states]
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+  def __init__(self, tracker: JsonStateTracker):
+    self.tracker = tracker
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+    self.tracker.update(input_ids)
+    schema = self.tracker.schema
+    automaton = schema.automaton
+    vocab_size = scores.shape[-1]
+
+    eos_ids = torch.tensor([t for t in schema.vocab.eos_ids if t < vocab_size], dtype=torch.long, device=scores.device)
+    mask = torch.zeros_like(scores, dtype=torch.bool)
+    for row, state in enumerate(self.tracker.states):
+      if state is None:
+        # 约束失效（理论上不会发生）时只允许结束，不退化为自由生成
+        mask[row, eos_ids] = True
+        continue
+      if automaton.is_complete(state):
+        allowed = schema.vocab.eos_ids
+      else:
+        allowed = schema.allowed_tokens(state)
+        if automaton.in_free_string(state):
+          top = state[-1]
+          remaining = automaton.nodes[top[1]][2] - top[3]
+          plain, lengths = schema.vocab.string_tensors(vocab_size, scores.device)
+          mask[row] = plain & (lengths <= remaining)
+      if allowed:
+        mask[row, torch.tensor([t for t in allowed if t < vocab_size], dtype=torch.long, device=scores.device)] = True
+      if not mask[row].any():
+        # 没有合法的下一个 token：结束该行，由调用方按解析失败处理
+        mask[row, eos_ids] = True
+
+    return scores.masked_fill(~mask, float("-inf"))
+
+
+class JsonCompleteCriteria(StoppingCriteria):
+  """根 JSON 值闭合（或约束失效）后立即停止该行"""
+
+  def __init__(self, tracker: JsonStateTracker):
+    self.tracker = tracker
+
+  def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+    self.tracker.update(input_ids)
+    return torch.tensor(self.tracker.finished(), dtype=torch.bool, device=input_ids.device)
+
+
+class JsonConstraintFactory:
+  """按 schema 缓存编译结果，为每次 generate 创建 logits processor 与 stopping criteria"""
+
+  def __init__(self, tokenizer: Any, max_schemas: int = 32):
+    self.tokenizer = tokenizer
+    self.max_schemas = max_schemas
+    self._vocab: Optional[TokenVocabulary] = None
+    self._schemas: "OrderedDict[Tuple, ConstrainedSchema]" = OrderedDict()
+
+  def _get_schema(self, schema: Tuple) -> ConstrainedSchema:
+    if self._vocab is None:
+      self._vocab = TokenVocabulary(self.tokenizer)
+    compiled = self._schemas.get(schema)
+    if compiled is None:
+      compiled = ConstrainedSchema(schema, self._vocab)
+      self._schemas[schema] = compiled
+      if len(self._schemas) > self.max_schemas:
+        self._schemas.popitem(last=False)
+    else:
+      self._schemas.move_to_end(schema)
+    return compiled
+
+  def generate_kwargs(self, schema: Tuple, batch_size: int) -> Dict[str, Any]:
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+    tracker = JsonStateTracker(self._get_schema(schema), batch_size)
+    return {
+      "logits_processor": LogitsProcessorList([JsonSchemaLogitsProcessor(tracker)]),
+      "stopping_criteria": StoppingCriteriaList([JsonCompleteCriteria(tracker)]),
+    }
@@ -0,0 +1,71 @@
+"""
+流式 JSON 增量解析
+
+模型逐 token 输出推荐结果 JSON 时，OutfitStreamParser 在 "outfits" 数组中的每个对象闭合时立即把它解析出来，
+不必等整段 JSON（以及 missing_items）生成完毕。
+"""
+import json
+from typing import Any, Dict, List
+
+
+class OutfitStreamParser:
+  """增量扫描输出文本，返回新闭合的 outfits 数组元素"""
+
+  def __init__(self, array_key: str = "outfits"):
+    self.array_key = array_key
+    self.text = ""
+    self._pos = 0
+    self._depth = 0
+    self._in_string = False
+    self._escape = False
+    self._string_start = -1
+    self._last_string = None
+    self._array_depth = None  # outfits 数组内部的嵌套深度
+    self._object_start = -1
+
+  def feed(self, chunk: str) -> List[Dict[str, Any]]:
+    """追加一段新文本，返回本次新完成的数组元素（已解析为 dict）"""
+    self.text += chunk
+    completed = []
+    text = self.text
+
+    while self._pos < len(text):
+      ch = text[self._pos]
+
+      if self._in_string:
+        if self._escape:
+          self._escape = False
+        elif ch == "\\":
+          self._escape = True
+        elif ch == '"':
+          self._in_string = False
+          if self._depth == 1:
+            self._last_string = text[self._string_start + 1:self._pos]
+      elif ch == '"':
+        self._in_string = True
+        self._string_start = self._pos
+      elif ch in "{[":
+        if (
+          ch == "[" and self._depth == 1 and self._array_depth is None
+          and self._last_string == self.array_key
+        ):
+          self._array_depth = self._depth + 1
+        elif ch == "{" and self._array_depth is not None and self._depth == self._array_depth:
+          self._object_start = self._pos
+        self._depth += 1
+      elif ch in "}]":
+        self._depth -= 1
+        if self._array_depth is not None:
+          if ch == "}" and self._depth == self._array_depth and self._object_start >= 0:
+            try:
+              completed.append(json.loads(text[self._object_start:self._pos + 1]))
+            except json.JSONDecodeError:
+              pass
+            self._object_start = -1
+          elif ch == "]" and self._depth == self._array_depth - 1:
+            # outfits 数组已结束，之后的对象不再属于它
+            self._array_depth = -1
+
+      self._pos += 1
+
+    return completed
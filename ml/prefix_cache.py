@@ -0,0 +1,311 @@
+"""
+推荐 prompt 的 KV 前缀缓存
+
+推荐 / 调整 prompt 的组织方式为：
+  [聊天模板头 + 任务说明 + RULES + JSON 格式]  所有请求完全相同
+  [WARDROBE 衣物列表]                           同一用户、同一批衣物时相同
+  [用户信息 / 天气 / 偏好 / 调整请求]            每次请求都不同
+PrefixKVCache 以 (模型版本, 前缀文本哈希) 为键保存前两段的 past_key_values，
+命中后 generate 只需对剩余的 token 做 prefill。大衣橱在 CPU 上 prefill 占主要耗时，收益最明显。
+
+多轮调整时 SessionKVCache 按会话保存上一轮完整 prompt 的 KV，下一轮按最长公共 token 前缀裁剪后复用，
+只需 prefill 新增的对话和调整请求。
+
+所有方法都只在微批调度器的工作线程中调用（与 generate 串行执行），内部的锁仅用于保护统计读取。
+"""
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+@dataclass(eq=False)
+class PrefixHint:
+  """
+  随生成请求传入调度器的前缀提示（按对象身份比较，带提示的请求单独成批）。
+
+  prefix_texts 为用户消息内容的若干个递增前缀，例如 [说明+规则, 说明+规则+衣物列表]。
+  session_id 非空时同时使用该会话的 KV 缓存。
+  """
+  prefix_texts: Tuple[str, ...]
+  session_id: Optional[str] = None
+
+
+def cache_nbytes(cache: Any) -> int:
+  """统计 KV 缓存占用的字节数（兼容新旧两种 DynamicCache 结构）"""
+  total = 0
+  layers = getattr(cache, "layers", None)
+  if layers is not None:
+    for layer in layers:
+      for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None)):
+        if isinstance(tensor, torch.Tensor):
+          total += tensor.numel() * tensor.element_size()
+    return total
+  for tensors in (getattr(cache, "key_cache", []), getattr(cache, "value_cache", [])):
+    for tensor in tensors:
+      if isinstance(tensor, torch.Tensor):
+        total += tensor.numel() * tensor.element_size()
+  return total
+
+
+@dataclass
+class _CacheEntry:
+  cache: Any
+  num_tokens: int
+  nbytes: int
+
+
+class PrefixKVCache:
+  """前缀 KV 缓存（LRU，条目数和总字节数均有上限）"""
+
+  def __init__(self, model_revision: str, max_entries: int = 32, max_bytes: int = 2 * 1024 ** 3):
+    self.model_revision = model_revision
+    self.max_entries = max(1, max_entries)
+    self.max_bytes = max_bytes
+    self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+    self._total_bytes = 0
+
+    self._stats_lock = threading.Lock()
+    self.lookups = 0
+    self.full_hits = 0
+    self.partial_hits = 0
+    self.misses = 0
+    self.reused_tokens = 0
+    self.prefilled_tokens = 0
+    self.evictions = 0
+
+  def make_key(self, prefix_text: str) -> str:
+    digest = hashlib.sha1(prefix_text.encode("utf-8")).hexdigest()
+    return f"{self.model_revision}:{digest}"
+
+  def _get(self, key: str) -> Optional[_CacheEntry]:
+    entry = self._entries.get(key)
+    if entry is not None:
+      self._entries.move_to_end(key)
+    return entry
+
+  def _put(self, key: str, cache: Any, num_tokens: int):
+    if key in self._entries:
+      self._total_bytes -= self._entries.pop(key).nbytes
+    nbytes = cache_nbytes(cache)
+    if nbytes > self.max_bytes:
+      return
+    self._entries[key] = _CacheEntry(cache=cache, num_tokens=num_tokens, nbytes=nbytes)
+    self._total_bytes += nbytes
+    while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+      _, evicted = self._entries.popitem(last=False)
+      self._total_bytes -= evicted.nbytes
+      with self._stats_lock:
+        self.evictions += 1
+
+  def build(
+      self,
+      model: Any,
+      input_ids: torch.Tensor,
+      prefixes: Sequence[Tuple[str, int]]
+  ) -> Tuple[Optional[Any], int]:
+    """
+    返回可直接传给 generate 的 past_key_values（副本）及其覆盖的 token 数。
+
+    prefixes 为 common_prefixes 的结果。从最长的前缀开始查找；部分命中时只对缺失的那一段
+    做前向计算，并把新的前缀写回缓存。
+    """
+    levels = []
+    for text, length in prefixes:
+      if length > (levels[-1][1] if levels else 0):
+        levels.append((self.make_key(text), length))
+    if not levels:
+      return None, 0
+
+    hit_level = -1
+    hit_entry = None
+    for level in range(len(levels) - 1, -1, -1):
+      hit_entry = self._get(levels[level][0])
+      if hit_entry is not None:
+        hit_level = level
+        break
+
+    with self._stats_lock:
+      self.lookups += 1
+      if hit_level == len(levels) - 1:
+        self.full_hits += 1
+      elif hit_level >= 0:
+        self.partial_hits += 1
+      else:
+        self.misses += 1
+      if hit_entry is not None:
+        self.reused_tokens += hit_entry.num_tokens
+
+    if hit_entry is not None:
+      cache = copy.deepcopy(hit_entry.cache)
+      cached_tokens = hit_entry.num_tokens
+    else:
+      cache = DynamicCache()
+      cached_tokens = 0
+
+    # 逐级补齐缺失的前缀，每一级都存一份快照
+    for key, length in levels[hit_level + 1:]:
+      self._prefill(model, input_ids, cache, cached_tokens, length)
+      with self._stats_lock:
+        self.prefilled_tokens += length - cached_tokens
+      cached_tokens = length
+      self._put(key, copy.deepcopy(cache), length)
+
+    return cache, cached_tokens
+
+  @staticmethod
+  def _prefill(model: Any, input_ids: torch.Tensor, cache: Any, start: int, end: int):
+    with torch.no_grad():
+      model(
+        input_ids=input_ids[:, start:end],
+        attention_mask=torch.ones((1, end), dtype=torch.long, device=input_ids.device),
+        past_key_values=cache,
+        cache_position=torch.arange(start, end, device=input_ids.device),
+        use_cache=True,
+      )
+
+  def clear(self):
+    self._entries.clear()
+    self._total_bytes = 0
+
+  def stats(self) -> Dict[str, Any]:
+    with self._stats_lock:
+      return {
+        "model_revision": self.model_revision,
+        "entries": len(self._entries),
+        "bytes": self._total_bytes,
+        "max_entries": self.max_entries,
+        "max_bytes": self.max_bytes,
+        "lookups": self.lookups,
+        "full_hits": self.full_hits,
+        "partial_hits": self.partial_hits,
+        "misses": self.misses,
+        "reused_tokens": self.reused_tokens,
+        "prefilled_tokens": self.prefilled_tokens,
+        "evictions": self.evictions,
+      }
+
+
+@dataclass
+class SessionEntry:
+  token_ids: List[int]
+  cache: Any
+  nbytes: int
+
+  def common_prefix_length(self, token_ids: List[int]) -> int:
+    """与新 prompt 的最长公共 token 前缀（至少留一个 token 给 generate 做 prefill）"""
+    limit = min(len(self.token_ids), len(token_ids) - 1)
+    length = 0
+    while length < limit and self.token_ids[length] == token_ids[length]:
+      length += 1
+    return length
+
+
+class SessionKVCache:
+  """
+  多轮对话的会话级 KV 缓存（跨会话 LRU，总字节数有上限）。
+
+  工作线程用 take 取出条目独占使用，生成结束后用 put 放回；
+  期间会话被删除（release）时，put 不会再把它放回缓存。
+  """
+
+  def __init__(self, max_sessions: int = 64, max_bytes: int = 1024 ** 3):
+    self.max_sessions = max(1, max_sessions)
+    self.max_bytes = max_bytes
+    self._entries: "OrderedDict[str, SessionEntry]" = OrderedDict()
+    self._in_use: Dict[str, bool] = {}
+    self._total_bytes = 0
+    self._lock = threading.Lock()
+
+    self.lookups = 0
+    self.hits = 0
+    self.reused_tokens = 0
+    self.evictions = 0
+
+  def take(self, session_id: str) -> Optional[SessionEntry]:
+    with self._lock:
+      self.lookups += 1
+      entry = self._entries.pop(session_id, None)
+      if entry is not None:
+        self._total_bytes -= entry.nbytes
+      self._in_use[session_id] = True
+      return entry
+
+  def record_reuse(self, num_tokens: int):
+    with self._lock:
+      self.hits += 1
+      self.reused_tokens += num_tokens
+
+  def put(self, session_id: str, token_ids: List[int], cache: Any):
+    nbytes = cache_nbytes(cache)
+    with self._lock:
+      # 使用期间会话已被释放
+      if not self._in_use.pop(session_id, True):
+        return
+      if nbytes > self.max_bytes:
+        return
+      self._entries[session_id] = SessionEntry(token_ids=token_ids, cache=cache, nbytes=nbytes)
+      self._total_bytes += nbytes
+      while len(self._entries) > self.max_sessions or self._total_bytes > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self._total_bytes -= evicted.nbytes
+        self.evictions += 1
+
+  def abandon(self, session_id: str):
+    """生成失败时放弃已取出的条目（下一轮从共享前缀缓存重新开始）"""
+    with self._lock:
+      self._in_use.pop(session_id, None)
+
+  def release(self, session_id: str):
+    """会话删除或过期时释放其 KV 缓存"""
+    with self._lock:
+      entry = self._entries.pop(session_id, None)
+      if entry is not None:
+        self._total_bytes -= entry.nbytes
+      if session_id in self._in_use:
+        self._in_use[session_id] = False
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      return {
+        "sessions": len(self._entries),
+        "bytes": self._total_bytes,
+        "max_sessions": self.max_sessions,
+        "max_bytes": self.max_bytes,
+        "lookups": self.lookups,
+        "hits": self.hits,
+        "reused_tokens": self.reused_tokens,
+        "evictions": self.evictions,
+      }
+
+
+def common_prefixes(
+    tokenizer: Any,
+    full_text: str,
+    full_ids: List[int],
+    prefix_texts: Sequence[str]
+) -> List[Tuple[str, int]]:
+  """
+  把用户消息内容的前缀映射为（聊天模板文本前缀, token 数）。
+
+  前缀单独分词的结果必须恰好是完整序列的前缀（分段边界都在换行处，正常情况下成立），
+  否则该级 token 数为 0，表示不可缓存。
+  """
+  prefixes = []
+  for text in prefix_texts:
+    start = full_text.find(text)
+    if start < 0:
+      prefixes.append(("", 0))
+      continue
+    template_prefix = full_text[:start + len(text)]
+    prefix_ids = tokenizer(template_prefix, add_special_tokens=False)["input_ids"]
+    if len(prefix_ids) < len(full_ids) and full_ids[:len(prefix_ids)] == prefix_ids:
+      prefixes.append((template_prefix, len(prefix_ids)))
+    else:
+      prefixes.append((template_prefix, 0))
+  return prefixes
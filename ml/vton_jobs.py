@@ -0,0 +1,366 @@
+"""
+虚拟试衣任务队列 - 提交后立即返回 job_id，扩散推理在专用线程中进行，不再阻塞 FastAPI 事件循环
+
+  CPU 线程池：解码上传图片、缩放填充（预处理）；PNG 编码（后处理）
+  推理线程（1 个，独占 GPU）：AutoMasker 生成 mask + CatVTONPipeline 去噪，逐步上报进度；
+  同时到达的多个任务合并为一批，每个时间步只跑一次 UNet 前向
+
+排队中的任务数有上限（准入控制），队列满时提交直接被拒绝并给出预计等待时间；
+任务在排队或推理过程中都可以取消（推理中在下一个去噪步结束时生效）。
+"""
+import itertools
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# 推理函数上报进度：report(批内序号, 阶段, 已完成的去噪步数)，返回 False 表示该任务已被取消、结果不再需要
+ProgressReporter = Callable[[int, str, Optional[int]], bool]
+
+
+class JobCancelled(Exception):
+    """任务被取消（推理函数在一批任务全部取消时抛出，中断去噪循环）"""
+
+
+class QueueFull(Exception):
+    """排队任务数已达上限"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"试衣任务队列已满，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+@dataclass
+class TryOnJob:
+    job_id: str
+    garments: int
+    total_steps: int
+    seq: int = 0
+    status: str = QUEUED
+    stage: str = QUEUED  # queued / preprocessing / masking / denoising / postprocessing / 终态
+    step: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[bytes] = None
+    cancel_requested: bool = False
+    version: int = 0  # 每次状态 / 进度变化加一，供 SSE 判断是否需要推送
+    future: Future = field(default_factory=Future)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "stage": self.stage,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "progress": round(self.step / self.total_steps, 3) if self.total_steps else 0.0,
+            "garments": self.garments,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class TryOnJobQueue:
+    """
+    有界试衣任务队列（线程安全）
+
+    prepare(payload) 在 CPU 线程池中执行，返回推理输入；
+    infer(prepared_list, report) 在唯一的推理线程中执行，一次处理一批任务，
+    返回与输入对齐的结果列表（单个任务失败时对应位置为异常对象）；
+    finish(raw) 在 CPU 线程池中执行，返回 PNG 字节。
+    """
+
+    def __init__(
+        self,
+        prepare: Callable[[Any], Any],
+        infer: Callable[[List[Any], ProgressReporter], List[Any]],
+        finish: Callable[[Any], bytes],
+        max_queued: int = 8,
+        max_batch: int = 1,
+        batch_wait: float = 0.0,
+        cpu_workers: int = 2,
+        result_ttl: float = 600.0,
+        seconds_per_step: float = 0.2
+    ):
+        self.prepare = prepare
+        self.infer = infer
+        self.finish = finish
+        self.max_queued = max(1, max_queued)
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait
+        self.result_ttl = result_ttl
+
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, TryOnJob] = {}
+        self._seq = itertools.count()
+        self._ready: "queue.Queue[Any]" = queue.Queue()
+        self._cpu = ThreadPoolExecutor(max_workers=max(1, cpu_workers), thread_name_prefix="vton-cpu")
+        self._worker: Optional[threading.Thread] = None
+
+        # 每个去噪步的平均耗时（合批时按批内总步数摊薄，指数滑动平均），用于估算排队等待时间
+        self.seconds_per_step = seconds_per_step
+        self.batches = 0
+        self.batched_jobs = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def start(self):
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run, daemon=True, name="vton-gpu")
+            self._worker.start()
+
+    def shutdown(self):
+        self._ready.put(None)
+        self._cpu.shutdown(wait=False)
+
+    # --- 提交 / 查询 / 取消 ---
+
+    def submit(self, payload: Any, garments: int, steps_per_garment: int) -> TryOnJob:
+        """提交任务；队列已满时抛出 QueueFull"""
+        self._purge()
+        with self._lock:
+            queued = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            if queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull(self._wait_seconds_locked())
+            job = TryOnJob(
+                job_id=uuid.uuid4().hex,
+                garments=garments,
+                total_steps=garments * steps_per_garment,
+                seq=next(self._seq)
+            )
+            self._jobs[job.job_id] = job
+            self.submitted += 1
+        self._cpu.submit(self._prepare, job, payload)
+        return job
+
+    def get(self, job_id: str) -> Optional[TryOnJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job: TryOnJob) -> int:
+        """排在该任务之前、尚未完成的任务数（0 表示正在推理或下一个就轮到）"""
+        with self._lock:
+            if job.status != QUEUED:
+                return 0
+            return sum(
+                1 for other in self._jobs.values()
+                if other.status in (QUEUED, RUNNING) and other.seq < job.seq
+            )
+
+    def cancel(self, job_id: str) -> Optional[TryOnJob]:
+        """取消任务：排队中的立即结束，推理中的在下一个去噪步后结束；任务不存在返回 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return job
+            job.cancel_requested = True
+            if job.status == QUEUED:
+                self._finish_locked(job, CANCELLED)
+            else:
+                job.version += 1
+        return job
+
+    def snapshot(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态字典（含排队位置），任务不存在返回 None"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        position = self.position(job)
+        with self._lock:
+            info = job.to_dict()
+        info["position"] = position
+        return info
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queued": sum(1 for job in self._jobs.values() if job.status == QUEUED),
+                "running": sum(1 for job in self._jobs.values() if job.status == RUNNING),
+                "max_queued": self.max_queued,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "max_batch": self.max_batch,
+                "avg_batch_size": round(self.batched_jobs / self.batches, 2) if self.batches else 0.0,
+                "seconds_per_step": round(self.seconds_per_step, 3),
+                "estimated_wait_seconds": self._wait_seconds_locked()
+            }
+
+    # --- 内部 ---
+
+    def _wait_seconds_locked(self) -> int:
+        remaining = sum(
+            job.total_steps - job.step for job in self._jobs.values() if job.status in (QUEUED, RUNNING)
+        )
+        return max(1, int(remaining * self.seconds_per_step))
+
+    def _finish_locked(self, job: TryOnJob, status: str, error: Optional[str] = None):
+        job.status = status
+        job.stage = status
+        job.error = error
+        job.finished_at = time.time()
+        job.version += 1
+        if status == SUCCEEDED:
+            self.completed += 1
+            job.future.set_result(job.result)
+        elif status == FAILED:
+            self.failed += 1
+            job.future.set_exception(RuntimeError(error))
+        else:
+            self.cancelled += 1
+            job.future.set_exception(JobCancelled(job.job_id))
+
+    def _finish(self, job: TryOnJob, status: str, error: Optional[str] = None):
+        with self._lock:
+            if job.status not in FINISHED:
+                self._finish_locked(job, status, error)
+
+    def _set(self, job: TryOnJob, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.version += 1
+
+    def _prepare(self, job: TryOnJob, payload: Any):
+        with self._lock:
+            if job.status in FINISHED:
+                return
+            job.stage = "preprocessing"
+            job.version += 1
+        try:
+            prepared = self.prepare(payload)
+        except Exception as e:
+            print(f"[TryOnJobQueue] 任务 {job.job_id} 预处理失败: {e}")
+            self._finish(job, FAILED, f"图片预处理失败: {e}")
+            return
+        with self._lock:
+            # 预处理期间被取消的任务已是终态，不能再改回排队阶段，也不再交给推理线程
+            if job.status in FINISHED:
+                return
+            job.stage = QUEUED
+            job.version += 1
+            self._ready.put((job, prepared))
+
+    def _next_batch(self) -> Optional[List[Any]]:
+        """阻塞取出下一个任务，再在 batch_wait 内凑齐最多 max_batch 个；收到停止信号返回 None"""
+        first = self._ready.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self._ready.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if item is None:
+                self._ready.put(None)  # 处理完当前批后再退出
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        """推理线程：按提交顺序取出预处理完成的任务，合批后独占 GPU 执行"""
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            with self._lock:
+                batch = [(job, prepared) for job, prepared in batch if job.status not in FINISHED]
+                for job, _ in batch:
+                    job.status = RUNNING
+                    job.started_at = time.time()
+                    job.version += 1
+            if not batch:
+                continue
+            jobs = [job for job, _ in batch]
+
+            def report(index: int, stage: str, step: Optional[int] = None, jobs=jobs) -> bool:
+                job = jobs[index]
+                if job.cancel_requested:
+                    self._finish(job, CANCELLED)
+                    return False
+                if step is None:
+                    self._set(job, stage=stage)
+                else:
+                    self._set(job, stage=stage, step=min(step, job.total_steps))
+                return True
+
+            started = time.time()
+            try:
+                results = self.infer([prepared for _, prepared in batch], report)
+            except JobCancelled:
+                results = [JobCancelled(job.job_id) for job in jobs]
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                results = [e] * len(jobs)
+
+            elapsed = time.time() - started
+            with self._lock:
+                self.batches += 1
+                self.batched_jobs += len(jobs)
+                total_steps = sum(job.total_steps for job in jobs)
+                if total_steps and not any(isinstance(result, Exception) for result in results):
+                    self.seconds_per_step = 0.8 * self.seconds_per_step + 0.2 * elapsed / total_steps
+
+            for job, result in zip(jobs, results):
+                if isinstance(result, JobCancelled) or job.cancel_requested:
+                    print(f"[TryOnJobQueue] 任务 {job.job_id} 已取消")
+                    self._finish(job, CANCELLED)
+                elif isinstance(result, Exception):
+                    self._finish(job, FAILED, f"AI Error: {result}")
+                else:
+                    with self._lock:
+                        if job.status in FINISHED:
+                            continue
+                        job.step = job.total_steps
+                        job.stage = "postprocessing"
+                        job.version += 1
+                    self._cpu.submit(self._encode, job, result)
+
+    def _encode(self, job: TryOnJob, raw: Any):
+        try:
+            result = self.finish(raw)
+        except Exception as e:
+            self._finish(job, FAILED, f"结果编码失败: {e}")
+            return
+        with self._lock:
+            if job.status in FINISHED:
+                return
+            job.result = result
+            self._finish_locked(job, SUCCEEDED)
+
+    def _purge(self):
+        """丢弃超过保留时间的已完成任务（含结果图）"""
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired: List[str] = [
+                job_id for job_id, job in self._jobs.items()
+                if job.status in FINISHED and job.finished_at is not None and job.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -3,12 +3,13 @@ import os
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 import sys
 import io
+import asyncio
 import uvicorn
 import torch
 import numpy as np
 from PIL import Image, ImageFilter, ImageOps
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from typing import List
 import json
 from contextlib import asynccontextmanager
@@ -27,6 +28,8 @@ except ImportError as e:
     print(f"导入失败: {e}")
     sys.exit(1)
 
+from vton_jobs import TryOnJobQueue, QueueFull, JobCancelled, FINISHED, SUCCEEDED
+
 # --- 全局变量 ---
 pipeline = None
 automasker = None
@@ -51,6 +54,14 @@ CATEGORY_PRIORITY = {
     'full_body': 50,
 }
 
+# --- 推理参数 ---
+TARGET_SIZE = (768, 1024)
+NUM_INFERENCE_STEPS = 50
+MAX_GARMENTS = int(os.getenv("VTON_MAX_GARMENTS", "5"))  # 单个任务最多试穿的衣服数
+DEBUG_IMAGES = os.getenv("VTON_DEBUG", "0") != "0"  # 保存中间 mask / 结果到 output/debug_server
+EVENT_POLL_SECONDS = 0.5
+PARSE_CACHE_SIZE = int(os.getenv("VTON_PARSE_CACHE", "32"))  # 缓存的人像解析结果数（DensePose + SCHP），0 = 关闭
+
 # --- 核心辅助函数：防变形缩放 ---
 def resize_and_padding(image, target_size):
     width, height = target_size
@@ -65,6 +76,118 @@ def resize_and_padding(image, target_size):
     new_image.paste(image, (paste_x, paste_y))
     return new_image, (paste_x, paste_y, new_w, new_h)
 
+# --- 试穿任务：预处理（CPU）→ mask + 去噪（推理线程）→ PNG 编码（CPU）---
+def _debug_dir():
+    debug_dir = os.path.join(current_dir, "output", "debug_server")
+    os.makedirs(debug_dir, exist_ok=True)
+    return debug_dir
+
+
+def prepare_tryon(payload):
+    """解码上传图片并缩放填充到目标尺寸，按优先级排序（内层→外层→下装）"""
+    person_raw = Image.open(io.BytesIO(payload["person"])).convert("RGB")
+    person_resized, _ = resize_and_padding(person_raw, TARGET_SIZE)
+    items = []
+    for category, mask_type, cloth_bytes in zip(payload["categories"], payload["mask_types"], payload["cloths"]):
+        cloth_raw = Image.open(io.BytesIO(cloth_bytes)).convert("RGB")
+        cloth_resized, _ = resize_and_padding(cloth_raw, TARGET_SIZE)
+        items.append((category, mask_type, cloth_resized))
+    items.sort(key=lambda x: CATEGORY_PRIORITY.get(x[0], 99))
+    return person_resized, items
+
+
+def run_tryon(batch, report):
+    """
+    推理线程中执行一批任务：第 r 轮把所有还有第 r 件衣服的任务合成一个批次，
+    mask 逐张生成，去噪一次前向处理整批（每个样本独立的随机种子，结果与单独推理一致）。
+    mask 都从原始人像的解析结果派生：DensePose + SCHP 每个人像只跑一次（同一张照片重复试穿时直接命中缓存）。
+    report(i, ...) 上报进度并返回任务是否仍需要结果；整轮都被取消时中断去噪。
+    """
+    originals = [person for person, _ in batch]
+    people = list(originals)
+    results = [None] * len(batch)
+    debug_dir = _debug_dir() if DEBUG_IMAGES else None
+    # 整批人像一次解析（DensePose / SCHP 各一次批量前向，命中缓存的跳过），之后每件衣服的 mask 都从缓存派生
+    for i in range(len(batch)):
+        report(i, "masking", 0)
+    try:
+        parses = automasker.parse_batch(originals)
+    except Exception as e:
+        print(f"批量人像解析失败，逐张解析: {e}")
+        parses = [None] * len(batch)
+    for r in range(max(len(items) for _, items in batch)):
+        offset = r * NUM_INFERENCE_STEPS
+        active, masks = [], []
+        for i, (_, items) in enumerate(batch):
+            if r >= len(items) or results[i] is not None:
+                continue
+            category, mask_type, _ = items[r]
+            print(f"试穿第 {r+1}/{len(items)} 件: {category} (mask_type={mask_type})")
+            if not report(i, "masking", offset):
+                results[i] = JobCancelled()
+                continue
+            try:
+                parse = parses[i] or automasker.parse(originals[i])
+                masks.append(automasker.cloth_agnostic_mask(
+                    parse['densepose'], parse['schp_lip'], parse['schp_atr'], part=mask_type
+                ))
+            except Exception as e:
+                results[i] = e
+                continue
+            active.append(i)
+        if not active:
+            continue
+
+        def on_step(step, timestep, latents):
+            # 本轮任务全部取消时中断去噪，其余情况继续（已取消任务的结果会被丢弃）
+            wanted = [report(i, "denoising", offset + step + 1) for i in active]
+            if not any(wanted):
+                raise JobCancelled()
+
+        print(f"模型推理中... 批大小 {len(active)}")
+        try:
+            outputs = pipeline(
+                image=[people[i] for i in active],
+                condition_image=[batch[i][1][r][2] for i in active],
+                mask=[mask.filter(ImageFilter.GaussianBlur(radius=5)) for mask in masks],
+                num_inference_steps=NUM_INFERENCE_STEPS,
+                guidance_scale=2.5,
+                generator=[torch.Generator(device=device).manual_seed(42) for _ in active],
+                callback=on_step
+            )
+        except JobCancelled:
+            for i in active:
+                results[i] = JobCancelled()
+            continue
+
+        # Paste Back：只保留衣服区域，脸部和背景不会变糊
+        for i, mask, result_image in zip(active, masks, outputs):
+            mask_for_composite = mask.convert("L").filter(ImageFilter.GaussianBlur(radius=1))
+            people[i] = Image.composite(result_image, people[i], mask_for_composite)
+            if debug_dir:
+                category = batch[i][1][r][0]
+                mask.save(os.path.join(debug_dir, f"mask_{i+1}_{r+1}_{category}.png"))
+                people[i].save(os.path.join(debug_dir, f"step_{i+1}_{r+1}_{category}.png"))
+    return [result if result is not None else person for result, person in zip(results, people)]
+
+
+def encode_png(image):
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+job_queue = TryOnJobQueue(
+    prepare=prepare_tryon,
+    infer=run_tryon,
+    finish=encode_png,
+    max_queued=int(os.getenv("VTON_MAX_QUEUE", "8")),
+    max_batch=int(os.getenv("VTON_MAX_BATCH", "2")),
+    batch_wait=float(os.getenv("VTON_BATCH_WAIT_MS", "50")) / 1000,
+    cpu_workers=int(os.getenv("VTON_CPU_WORKERS", "2")),
+    result_ttl=float(os.getenv("VTON_RESULT_TTL", "600"))
+)
+
 # --- 生命周期 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -88,7 +211,8 @@ async def lifespan(app: FastAPI):
         automasker = AutoMasker(
             densepose_ckpt=os.path.join(current_dir, "CatVTON", "model", "DensePose"),
             schp_ckpt=os.path.join(current_dir, "CatVTON", "model", "SCHP"),
-            device=device
+            device=device,
+            cache_size=PARSE_CACHE_SIZE
         )
 
         # 3. (可选) 加载放大模型
@@ -96,6 +220,7 @@ async def lifespan(app: FastAPI):
         # print("Loading Upscaler...")
         # upscaler = StableDiffusionLatentUpscalePipeline.from_pretrained(...)
         
+        job_queue.start()
         print("服务启动成功！端口: 8001")
     except Exception as e:
         print(f"模型加载崩溃: {e}")
@@ -103,89 +228,136 @@ async def lifespan(app: FastAPI):
         traceback.print_exc()
     yield
     # 清理
+    job_queue.shutdown()
     del pipeline, automasker
     torch.cuda.empty_cache()
 
 app = FastAPI(lifespan=lifespan)
 
-@app.post("/process_tryon")
-async def process_tryon(
+def _job_payload(person_bytes: bytes, cloth_bytes: List[bytes], categories: List[str], mask_types: List[str]):
+    return {"person": person_bytes, "cloths": cloth_bytes, "categories": categories, "mask_types": mask_types}
+
+
+async def _submit_job(payload, garments: int):
+    if pipeline is None or automasker is None:
+        raise HTTPException(status_code=503, detail="模型尚未加载完成")
+    if garments > MAX_GARMENTS:
+        raise HTTPException(status_code=400, detail=f"单次最多试穿 {MAX_GARMENTS} 件衣服")
+    try:
+        return job_queue.submit(payload, garments, NUM_INFERENCE_STEPS)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+async def _wait_result(job) -> Response:
+    """兼容旧接口：等待任务完成（等待期间事件循环照常处理其他请求）"""
+    try:
+        result = await asyncio.wrap_future(job.future)
+    except JobCancelled:
+        raise HTTPException(status_code=409, detail="任务已取消")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return Response(content=result, media_type="image/png")
+
+
+def _get_job_or_404(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或结果已过期")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
     person_img: UploadFile = File(...),
-    cloth_img: UploadFile = File(...),
-    category: str = Form("upper_body") # 暂时只做上半身，通用性最强
+    cloth_imgs: List[UploadFile] = File(...),
+    categories: str = Form(...)
 ):
-    global pipeline, automasker
-    
-    # 调试目录
-    debug_dir = os.path.join(current_dir, "output", "debug_server")
-    os.makedirs(debug_dir, exist_ok=True)
-
+    """提交试穿任务，立即返回 job_id；categories 为 JSON 数组，与 cloth_imgs 一一对应"""
     try:
-        print(f"Processing Request: category={category}")
-        
-        # 1. 读取图片
-        person_raw = Image.open(io.BytesIO(await person_img.read())).convert("RGB")
-        cloth_raw = Image.open(io.BytesIO(await cloth_img.read())).convert("RGB")
-
-        # 2. 智能缩放 (768x1024)
-        target_size = (768, 1024)
-        person_resized, paste_info = resize_and_padding(person_raw, target_size)
-        cloth_resized, _ = resize_and_padding(cloth_raw, target_size)
-        
-        # 保存一下输入图，方便调试
-        person_resized.save(os.path.join(debug_dir, "input_person.png"))
+        category_list = json.loads(categories)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="categories 必须是 JSON 数组")
+    if not isinstance(category_list, list) or len(category_list) != len(cloth_imgs):
+        raise HTTPException(status_code=400, detail="categories 与衣服图片数量不一致")
 
-        # 3. 自动生成高质量 Mask
-        print("Generating Mask...")
-        mask_result = automasker(person_resized, mask_type='upper')
-        mask = mask_result['mask'] # 这是一个 PIL Image
-        
-        # [关键步骤] 保存 Mask 检查质量
-        mask.save(os.path.join(debug_dir, "generated_mask.png"))
-
-        # 4. Mask 边缘羽化
-        mask_blurred = mask.filter(ImageFilter.GaussianBlur(radius=5))
-
-        # 5. 模型推理
-        print("模型推理中...")
-        generator = torch.Generator(device=device).manual_seed(42)
-        result_image = pipeline(
-            image=person_resized,
-            condition_image=cloth_resized,
-            mask=mask_blurred,
-            num_inference_steps=50, # 保持 50 步
-            guidance_scale=2.5,
-            generator=generator
-        )[0]
-        
-        # 保存直出结果
-        result_image.save(os.path.join(debug_dir, "raw_output.png"))
+    cloth_bytes = [await cloth.read() for cloth in cloth_imgs]
+    payload = _job_payload(
+        await person_img.read(),
+        cloth_bytes,
+        category_list,
+        [CATEGORY_TO_MASK_TYPE.get(category, 'upper') for category in category_list]
+    )
+    job = await _submit_job(payload, len(cloth_bytes))
+    print(f"📦 收到试穿任务 {job.job_id}: {len(cloth_bytes)} 件衣服, 类别: {category_list}")
+    return job_queue.snapshot(job.job_id)
 
-        # 6. [核心技术] Paste Back (回贴)
-        # 将生成的衣服融合回原图 (person_resized)，只保留衣服区域
-        # 这样脸部和背景就绝对不会变糊
-        print("Pasting Back...")
-        
-        # 重新调整 mask 大小用于合成 (mask 也是 768x1024，不用动)
-        mask_for_composite = mask.convert("L")
-        # 稍微腐蚀一点 Mask，防止白边
-        mask_for_composite = mask_for_composite.filter(ImageFilter.GaussianBlur(radius=1))
-        
-        # 组合：Mask 白色区域用新图，黑色区域用原图
-        final_image = Image.composite(result_image, person_resized, mask_for_composite)
-        
-        # (可选) 如果需要还原回用户原始上传图片的尺寸，可以在这里做反向 Crop
-        # 但通常 Web 端展示 768x1024 就够了
 
-        # 7. 返回结果
-        img_byte_arr = io.BytesIO()
-        final_image.save(img_byte_arr, format='PNG')
-        return Response(content=img_byte_arr.getvalue(), media_type="image/png")
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    _get_job_or_404(job_id)
+    return job_queue.snapshot(job_id)
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """SSE 推送任务进度，任务结束后发送最后一条事件并关闭"""
+    job = _get_job_or_404(job_id)
+
+    async def stream():
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                info = job_queue.snapshot(job_id) or job.to_dict()
+                yield f"event: {info['status']}\ndata: {json.dumps(info, ensure_ascii=False)}\n\n"
+                if info["status"] in FINISHED:
+                    return
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = _get_job_or_404(job_id)
+    if job.status != SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"任务尚未完成: {job.status}")
+    return Response(content=job.result, media_type="image/png")
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    _get_job_or_404(job_id)
+    job_queue.cancel(job_id)
+    return job_queue.snapshot(job_id)
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok" if pipeline is not None and automasker is not None else "loading",
+        "device": device,
+        "queue": job_queue.stats(),
+        "parse_cache": automasker.cache.stats() if automasker is not None else None
+    }
+
+
+@app.post("/process_tryon")
+async def process_tryon(
+    person_img: UploadFile = File(...),
+    cloth_img: UploadFile = File(...),
+    category: str = Form("upper_body") # 暂时只做上半身，通用性最强
+):
+    print(f"Processing Request: category={category}")
+    payload = _job_payload(await person_img.read(), [await cloth_img.read()], [category], ['upper'])
+    job = await _submit_job(payload, 1)
+    return await _wait_result(job)
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"AI Error: {str(e)}")
 
 @app.post("/batch_tryon")
 async def batch_tryon(
@@ -194,81 +366,22 @@ async def batch_tryon(
     categories: str = Form(...)
 ):
     """批量试穿：按顺序依次试穿多件衣服"""
-    global pipeline, automasker
-    
-    debug_dir = os.path.join(current_dir, "output", "debug_batch")
-    os.makedirs(debug_dir, exist_ok=True)
-    
     try:
-        # 1. 解析类别列表
         category_list = json.loads(categories)
-        print(f"📦 收到批量试穿请求: {len(cloth_imgs)} 件衣服, 类别: {category_list}")
-        
-        # 2. 读取所有衣服图片
-        cloth_images = []
-        for cloth_file in cloth_imgs:
-            cloth_raw = Image.open(io.BytesIO(await cloth_file.read())).convert("RGB")
-            cloth_images.append(cloth_raw)
-        
-        # 3. 按优先级排序（内层→外层→下装）
-        items = list(zip(category_list, cloth_images))
-        items.sort(key=lambda x: CATEGORY_PRIORITY.get(x[0], 99))
-        
-        # 4. 读取人像
-        person_raw = Image.open(io.BytesIO(await person_img.read())).convert("RGB")
-        target_size = (768, 1024)
-        current_person, _ = resize_and_padding(person_raw, target_size)
-        
-        # 保存原始人像用于调试
-        current_person.save(os.path.join(debug_dir, "input_person.png"))
-        
-        # 5. 顺序推理
-        for i, (category, cloth_raw) in enumerate(items):
-            print(f"试穿第 {i+1}/{len(items)} 件: {category}")
-            
-            mask_type = CATEGORY_TO_MASK_TYPE.get(category, 'upper')
-            cloth_resized, _ = resize_and_padding(cloth_raw, target_size)
-            
-            # 保存衣服图片用于调试
-            cloth_resized.save(os.path.join(debug_dir, f"cloth_{i+1}_{category}.png"))
-            
-            # 生成 mask
-            print(f"生成 mask (type={mask_type})...")
-            mask_result = automasker(current_person, mask_type=mask_type)
-            mask = mask_result['mask']
-            mask.save(os.path.join(debug_dir, f"mask_{i+1}_{category}.png"))
-            mask_blurred = mask.filter(ImageFilter.GaussianBlur(radius=5))
-            
-            # 推理
-            print(f"模型推理中...")
-            generator = torch.Generator(device=device).manual_seed(42)
-            result_image = pipeline(
-                image=current_person,
-                condition_image=cloth_resized,
-                mask=mask_blurred,
-                num_inference_steps=50,
-                guidance_scale=2.5,
-                generator=generator
-            )[0]
-            
-            # Paste Back
-            mask_for_composite = mask.convert("L").filter(ImageFilter.GaussianBlur(radius=1))
-            current_person = Image.composite(result_image, current_person, mask_for_composite)
-            
-            # 保存中间结果
-            current_person.save(os.path.join(debug_dir, f"step_{i+1}_{category}.png"))
-            print(f"第 {i+1} 件完成")
-        
-        # 6. 返回最终结果
-        print(f"批量试穿完成！共 {len(items)} 件")
-        img_byte_arr = io.BytesIO()
-        current_person.save(img_byte_arr, format='PNG')
-        return Response(content=img_byte_arr.getvalue(), media_type="image/png")
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"批量试穿失败: {str(e)}")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="categories 必须是 JSON 数组")
+    if not isinstance(category_list, list) or len(category_list) != len(cloth_imgs):
+        raise HTTPException(status_code=400, detail="categories 与衣服图片数量不一致")
+    print(f"📦 收到批量试穿请求: {len(cloth_imgs)} 件衣服, 类别: {category_list}")
+    cloth_bytes = [await cloth.read() for cloth in cloth_imgs]
+    payload = _job_payload(
+        await person_img.read(),
+        cloth_bytes,
+        category_list,
+        [CATEGORY_TO_MASK_TYPE.get(category, 'upper') for category in category_list]
+    )
+    job = await _submit_job(payload, len(cloth_bytes))
+    return await _wait_result(job)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file